@@ -0,0 +1,135 @@
+import os
+import sys
+import glob
+import time
+import traceback
+import multiprocessing
+from collections import OrderedDict
+from argparse import ArgumentParser
+import numpy as np
+import synthesis_report
+
+'''
+Runs synthesis_report.py for a batch of clients, for example every client at the end of a survey window. pandas, the synthesis_report_vars module and
+the coreVars modules are loaded once in this process and shared with the worker processes instead of once per client. A client that fails is reported
+at the end and doesn't stop the rest of the batch.
+'''
+
+parser = ArgumentParser()
+parser.add_argument('-c', '--client_dirs', metavar = 'client', nargs = '+', help = 'top level report production dirs of the clients to run. Globs are expanded, so "clients/*/" runs every client in a dir.', required = False, default = [])
+parser.add_argument('-r', '--current_round', help = 'current round for the clients passed with -c', required = False)
+parser.add_argument('-l', '--client_list', metavar = 'client_list', help = 'text file with one "client_dir,round" line per client. Can be used with or instead of -c.', required = False)
+parser.add_argument('-o', '--outDir', metavar = 'outDir', help = "Use this if you want to write the jsons somewhere other than each client's directory.", required = False)
+parser.add_argument('-t', '--testing', help = 'names files with testing and writes over other testing files if in same outdir.', action = 'store_true', required = False)
+parser.add_argument('-d', '--district_report_only', help = 'only produce district-level reports', action = 'store_true', required = False)
+parser.add_argument('-w', '--workers', help = 'number of clients to run at once. Defaults to 1 (no pool).', type = int, default = 1, required = False)
+parser.add_argument('-q', '--queue_size', help = 'most clients waiting for a worker at once. Defaults to twice the number of workers.', type = int, required = False)
+parser.add_argument('--force', help = 'rebuild every report even if its inputs are unchanged since the last build.', action = 'store_true', required = False)
+parser.add_argument('--stream', help = 'write each report to its json as soon as it is made instead of keeping a whole client in memory.', action = 'store_true', required = False)
+parser.add_argument('--gzip', help = 'write gzip compressed jsons (.json.gz). Implies --stream.', action = 'store_true', required = False)
+parser.add_argument('--shard', help = 'write each report to its own json in a .shards dir with a manifest of the files.', action = 'store_true', required = False)
+parser.add_argument('--delta', help = "also write a delta json per client with the reports that were added, changed or removed since the json it replaces.", action = 'store_true', required = False)
+parser.add_argument('--prefetch', help = 'how many product levels (or schools) ahead to read csvs on background threads. Defaults to 2, 0 turns it off.', type = int, default = 2, required = False)
+parser.add_argument('--low_memory', help = "read one product level's csvs at a time in each client. Keeps memory down when big clients run side by side.", action = 'store_true', required = False)
+parser.add_argument('--no_sidecar', help = "don't read or write the columnar sidecar copies of CYAN csvs.", action = 'store_true', required = False)
+
+#options every client in the batch is run with. Set in each worker by init_batch
+batch_options = {}
+
+def get_clients(client_dirs, current_round, client_list):
+    #list of (client_dir, round) from the -c globs and the -l file, in the order given and without duplicates
+    clients = []
+    if client_dirs and not current_round:
+        sys.exit('Pass -r with -c so the clients have a round.')
+    for pattern in client_dirs:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for client_dir in matches:
+            clients.append((os.path.join(client_dir, ''), current_round))
+    if client_list:
+        with open(client_list) as f:
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    client_dir, rnd = [part.strip() for part in line.rsplit(',', 1)]
+                    clients.append((os.path.join(client_dir, ''), rnd))
+    return list(OrderedDict.fromkeys(clients))
+
+def preload(clients):
+    #import the vars and coreVars modules every client uses before the pool starts so forked workers already have them.
+    #Errors are left for the client's own run to report
+    for client_dir, rnd in clients:
+        vars_path = os.path.abspath(os.path.join(client_dir, '..', '..', 'data/synthesis_report_vars.py'))
+        try:
+            variables = synthesis_report.load_variables(vars_path)
+            synthesis_report.grab_factor_names(client_dir, variables.product_levels_list)
+        except (Exception, SystemExit):
+            pass
+
+def init_batch(options):
+    #set up a worker process to run clients with options
+    batch_options.clear()
+    batch_options.update(options)
+    synthesis_report.use_sidecars = not options['no_sidecar']
+    synthesis_report.prefetch_depth = options['prefetch']
+    synthesis_report.low_memory = options.get('low_memory', False)
+
+def run_client(client):
+    #build one client's json. Returns the client, how long it took and the error if it failed
+    client_dir, rnd = client
+    start = time.perf_counter()
+    error = None
+    try:
+        synthesis_report.build_synthesis_report(client_dir, rnd, batch_options['outDir'], batch_options['testing'], batch_options['district_report_only'], force = batch_options['force'],
+        stream = batch_options['stream'], compress = batch_options['gzip'], shard = batch_options['shard'], delta = batch_options.get('delta', False))
+    except (Exception, SystemExit):
+        error = traceback.format_exc()
+    return client, time.perf_counter() - start, error
+
+def run_batch(clients, options, workers = 1, queue_size = None):
+    #run every client on a pool of workers. At most queue_size clients are handed to the pool ahead of the workers so a long batch doesn't queue everything up front
+    #Returns (client, seconds, error) for each client in the order they finished
+    preload(clients)
+    if workers <= 1:
+        init_batch(options)
+        return [run_client(client) for client in clients]
+    queue_size = queue_size or 2 * workers
+    results = []
+    pending = []
+    pool = multiprocessing.Pool(workers, initializer = init_batch, initargs = (options,))
+    try:
+        for client in clients:
+            while len(pending) >= queue_size:
+                finished = [result for result in pending if result.ready()] or [pending[0]]
+                for result in finished:
+                    results.append(result.get())
+                    pending.remove(result)
+            pending.append(pool.apply_async(run_client, (client,)))
+        for result in pending:
+            results.append(result.get())
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def print_summary(results, seconds):
+    #print throughput, per-client times and any failures
+    times = [duration for client, duration, error in results]
+    failures = [(client, error) for client, duration, error in results if error]
+    print('\nBuilt {built} of {total} clients in {minutes:.1f} min ({rate:.2f} clients/min).'.format(built = len(results) - len(failures), total = len(results),
+    minutes = seconds / 60, rate = len(results) / (seconds / 60) if seconds else 0))
+    if times:
+        print('Per client: p50 {p50:.1f}s, p95 {p95:.1f}s, max {max:.1f}s.'.format(p50 = np.percentile(times, 50), p95 = np.percentile(times, 95), max = max(times)))
+    for (client_dir, rnd), error in failures:
+        print('\nFAILED {client_dir} ({rnd}):\n{error}'.format(client_dir = client_dir, rnd = rnd, error = error))
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    clients = get_clients(args.client_dirs, args.current_round, args.client_list)
+    if not clients:
+        sys.exit('No clients to run. Pass client dirs with -c or a client list with -l.')
+    options = {'outDir': args.outDir, 'testing': args.testing, 'district_report_only': args.district_report_only, 'force': args.force, 'no_sidecar': args.no_sidecar,
+    'prefetch': args.prefetch, 'low_memory': args.low_memory, 'stream': args.stream, 'gzip': args.gzip, 'shard': args.shard, 'delta': args.delta}
+    start = time.perf_counter()
+    results = run_batch(clients, options, args.workers, args.queue_size)
+    print_summary(results, time.perf_counter() - start)
+    if any(error for client, duration, error in results):
+        sys.exit(1)
@@ -13,6 +13,28 @@ from collections import OrderedDict
 import sys
 import warnings
 import copy
+import shutil
+import glob
+import multiprocessing
+import errno
+import hashlib
+import contextlib
+import tracemalloc
+import cProfile
+import gzip
+import re
+import concurrent.futures
+import io
+import threading
+from collections import deque
+import pickle
+import types
+try:
+    import pyarrow
+    from pyarrow import feather
+except ImportError:
+    #sidecars are optional. Without pyarrow every run just parses the csvs
+    pyarrow = None
 
 '''
 This script uses the data in a YouthTruth report production directory to create a "synthesis report", which gives a bird's eye view of the data 
@@ -27,16 +49,105 @@ parser.add_argument('-r', '--current_round', help = 'current round for your clie
 parser.add_argument('-o', '--outDir', metavar = 'outDir', help = 'Use this if you want to write the synthesis report json somewhere other than the client directory you entered for -c.', required = False)
 parser.add_argument('-t', '--testing', help = 'names file with testing and writes over other testing file if in same outdir.', action = 'store_true', required = False)
 parser.add_argument('-d', '--district_report_only', help = 'this arg will make the script only produce a district-level report', action = 'store_true', required = False)
+parser.add_argument('-w', '--workers', help = 'number of processes to build school and multilevel reports with. Defaults to 1 (no pool).', type = int, default = 1, required = False)
+parser.add_argument('--no_sidecar', help = "don't read or write the columnar sidecar copies of CYAN csvs. Use this if the client dir is read only.", action = 'store_true', required = False)
+parser.add_argument('--prefetch', help = 'how many product levels (or schools) ahead to read csvs on background threads. Defaults to 2, 0 turns it off.', type = int, default = 2, required = False)
+parser.add_argument('--low_memory', help = "read one product level's csvs at a time and let them go once the rows the reports need are taken out. Keeps memory down for big clients.", action = 'store_true', required = False)
+parser.add_argument('--purge_sidecars', help = 'delete all columnar sidecar copies of CYAN csvs under the client dir before running.', action = 'store_true', required = False)
+parser.add_argument('--profile', help = 'time each stage of the run (wall time, cpu time and peak memory) and write a timing report next to the json. Slows the run down.', action = 'store_true', required = False)
+parser.add_argument('--cprofile', help = 'with --profile, also dump cProfile stats for the slowest top level stage.', action = 'store_true', required = False)
+parser.add_argument('--force', help = 'rebuild every report even if its inputs are unchanged since the last build.', action = 'store_true', required = False)
+parser.add_argument('--stream', help = 'write each report to the json as soon as it is made instead of keeping them all in memory until the end.', action = 'store_true', required = False)
+parser.add_argument('--gzip', help = 'write a gzip compressed json (.json.gz). Implies --stream.', action = 'store_true', required = False)
+parser.add_argument('--shard', help = 'write each report to its own json in a .shards dir with a manifest of the files instead of one json. synthesis_shards.py merges them back.', action = 'store_true', required = False)
+parser.add_argument('--delta', metavar = 'previous_json', nargs = '?', const = True, help = "also write a delta json with only the reports that were added or changed since previous_json (the json this run replaces if it isn't passed), the ones that were removed and a summary of the changes.", required = False)
 parser.add_argument('-m', '--multi_dict', metavar = 'multi_dict', help = "Use this argument if you want to create multilevel school reports but for some reason the multi_dict isn't in the client's survey admin dir. Point directly to file, not just dir." , required = False)
 
+#synthesis_report_vars and coreVars modules by path. A batch of clients sharing a production dir imports each of them once
+variables_cache = {}
+core_vars_cache = {}
+
+def load_variables(vars_path):
+    #the synthesis_report_vars module at vars_path, or reuse it if it's already been loaded. It comes from the factor registry when there's a current one,
+    #which also fills in core_vars_cache so grab_factor_names doesn't import the coreVars modules either
+    if vars_path not in variables_cache:
+        registry = load_factor_registry(vars_path)
+        if registry is None:
+            variables_cache[vars_path] = varHelpers.importModule(vars_path, 'synthesis_report_vars')
+        else:
+            variables_cache[vars_path] = registry['variables']
+            for core_vars_path, core_vars in registry['factors'].items():
+                core_vars_cache.setdefault(core_vars_path, core_vars)
+    return variables_cache[vars_path]
+
+#the synthesis_report_vars module and the execsum factors of every product level's coreVars are snapshotted into one pickle next to them, so a run reads one
+#file instead of executing the modules. The size and mtime of every source module is in the registry and it's rebuilt when any of them change
+REGISTRY_VERSION = 1
+
+def registry_path(vars_path):
+    #where the factor registry of the production dir with vars_path goes
+    return os.path.join(os.path.dirname(vars_path), SIDECAR_DIR, 'factor_registry.pickle')
+
+def source_stamp(path):
+    #[size, mtime] of a source module, None if it doesn't exist
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def load_factor_registry(vars_path):
+    #the registry for vars_path if it's current, otherwise build and save a new one. None if the vars module can't be snapshotted, it's imported as before then
+    try:
+        with open(registry_path(vars_path), 'rb') as f:
+            registry = pickle.load(f)
+        if registry['version'] == REGISTRY_VERSION and all(source_stamp(path) == stamp for path, stamp in registry['sources'].items()):
+            return registry
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, KeyError, TypeError):
+        pass
+    return build_factor_registry(vars_path)
+
+def build_factor_registry(vars_path):
+    #import the vars module and the coreVars of every product level it lists and save them as a registry. coreVars that are missing or don't import are
+    #left out, grab_factor_names imports them itself if a client needs them and reports the error then
+    sources = {vars_path: source_stamp(vars_path)}
+    module = varHelpers.importModule(vars_path, 'synthesis_report_vars')
+    variables = types.SimpleNamespace(**{name: value for name, value in vars(module).items() if not name.startswith('_') and not isinstance(value, types.ModuleType)})
+    factors = {}
+    for product_level in getattr(module, 'product_levels_list', []):
+        core_vars_path = os.path.join(os.path.dirname(vars_path), product_level.upper(), 'coreVars.py')
+        sources[core_vars_path] = source_stamp(core_vars_path)
+        try:
+            core_vars = varHelpers.importModule(core_vars_path, 'coreVars')
+            factors[core_vars_path] = types.SimpleNamespace(factors = {'execsum': core_vars.factors['execsum']})
+        except Exception:
+            pass
+    registry = {'version': REGISTRY_VERSION, 'sources': sources, 'variables': variables, 'factors': factors}
+    try:
+        data = pickle.dumps(registry)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        #functions or other things that don't pickle in the vars module
+        return None
+    try:
+        os.makedirs(os.path.dirname(registry_path(vars_path)), exist_ok = True)
+        temp_path = registry_path(vars_path) + '.tmp{pid}'.format(pid = os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, registry_path(vars_path))
+    except OSError as e:
+        print("Couldn't save the factor registry for {vars_path} ({error}).".format(vars_path = vars_path, error = e))
+    return registry
+
 def grab_factor_names(client_dir, product_levels_list):
     #create a list of dictionaries where each dictionary has the factor variable name and the factor display name for every factor in the necessary reports
     factor_dict = {}
     factor_dict_by_product = {}
-    for product in next(os.walk(client_dir))[1]:
+    for product in list_product_levels(client_dir):
         if product in product_levels_list:
             core_vars_path = os.path.abspath(os.path.join(client_dir, "..", "..", 'data/{product_level}/coreVars.py'.format(product_level=product.upper())))
-            core_vars = varHelpers.importModule(core_vars_path, 'coreVars')
+            if core_vars_path not in core_vars_cache:
+                core_vars_cache[core_vars_path] = varHelpers.importModule(core_vars_path, 'coreVars')
+            core_vars = core_vars_cache[core_vars_path]
             for factor in core_vars.factors['execsum']:
                 factor_dict[factor[0]] = factor[1]
             factor_dict_by_product[product] = factor_dict
@@ -129,22 +240,205 @@ def get_schools_list(client_dir, product_level, client, current_round, multileve
     return school_list
 
 
-def read_in_csv(client_dir, client_dir_path, directory, csv_name):
-    #read in cyan csvs and print warning if none is found
+#parsed csvs are kept for the rest of the run so schools, multilevel reports and get_schools_list don't re-parse the same cyan files.
+#keyed on resolved path and mtime so a file CYAN rewrites mid-run is picked up. Least recently used entries go once there are more than CSV_CACHE_SIZE.
+CSV_CACHE_SIZE = 64
+csv_cache = OrderedDict()
+csv_cache_stats = {'hits': 0, 'misses': 0}
+target_index_cache = {}
+round_lookup_cache = {}
+#prefetch threads add to the cache too. Files are parsed outside the lock so reads overlap
+csv_cache_lock = threading.RLock()
+
+def load_csv(path, columns = None, nameStems = None):
+    #read a csv through the run cache. Frames that come back are shared between callers so they must not be modified in place.
+    #columns limits the frame to those columns (the ones present in the file, in file order) and reads genTarget and type as categoricals.
+    #nameStems limits it to rows whose target starts with one of them
+    resolved = os.path.realpath(path)
+    stat = os.stat(resolved)
+    key = (resolved, stat.st_mtime_ns, tuple(columns) if columns is not None else None, tuple(sorted(nameStems)) if nameStems is not None else None)
+    with csv_cache_lock:
+        if key in csv_cache:
+            csv_cache_stats['hits'] += 1
+            csv_cache.move_to_end(key)
+            return csv_cache[key]
+        csv_cache_stats['misses'] += 1
+    csv = read_csv_sidecar(resolved, stat, columns, nameStems)
+    with csv_cache_lock:
+        #drop anything cached for an older version of this file
+        for old_key in [k for k in csv_cache if k[0] == resolved and k[1] != stat.st_mtime_ns]:
+            evict_csv(old_key)
+        csv_cache[key] = csv
+        while len(csv_cache) > CSV_CACHE_SIZE:
+            evict_csv(next(iter(csv_cache)))
+    return csv
+
+#the allmean, highprop and pct csvs have a column for every survey item but reports only use the key columns and the variables named in the report
+#templates. set_cyan_schema works those out at the start of a build and the data cube reads only them, and only the rows of the client and its schools.
+#Metrics stay float64 since they are rounded for display and float32 would change the rounding. None reads everything
+CYAN_KEY_COLUMNS = ['target', 'genTarget', 'type']
+CATEGORY_COLUMNS = ['genTarget', 'type']
+CSV_CHUNK_ROWS = 50000
+cyan_schema = {'columns': None}
+
+def set_cyan_schema(*templates):
+    #set the columns the data cube reads to the key columns and every string in templates (dicts of template dfs or bar_dicts)
+    columns = set(CYAN_KEY_COLUMNS)
+    for template_dict in templates:
+        for template in template_dict.values():
+            if isinstance(template, pd.DataFrame):
+                for column in template.columns:
+                    columns.update(value for value in template[column].values if isinstance(value, str))
+            else:
+                columns.update(value for value in template.values() if isinstance(value, str))
+    cyan_schema['columns'] = frozenset(columns)
+    return cyan_schema['columns']
+
+def client_nameStems(client_dir, product_level):
+    #nameStems whose rows a report can use from a product level's agg csvs: the client's and every school schoolMeta lists for the client in any round.
+    #None (every row) if no schema is set or there's no schoolMeta to go on
+    if cyan_schema['columns'] is None:
+        return None
+    client = client_dir.strip('/').split('/')[-1]
+    try:
+        school_meta = load_csv(lookup_csv(os.path.join(client_dir, product_level), 'data', 'schoolMeta'))
+    except FileNotFoundError:
+        return None
+    if 'ClientName' not in school_meta.columns or 'genTarget' not in school_meta.columns:
+        return None
+    rows = ((school_meta['ClientName'] == client) | (school_meta['genTarget'] == client)).to_numpy()
+    return frozenset([client] + [str(nameStem) for nameStem in school_meta['genTarget'].values[rows]])
+
+#the first time a CYAN csv is read a typed feather copy of it is written to a hidden dir next to it, later runs load that instead of parsing text.
+#the csv's size and mtime are part of the sidecar's file name so a re-run CYAN file never matches an old sidecar.
+SIDECAR_DIR = '.synthesis_cache'
+use_sidecars = True
+
+def sidecar_path(path, stat):
+    #path of the feather sidecar for a csv as it is right now
+    directory, file_name = os.path.split(path)
+    return os.path.join(directory, SIDECAR_DIR, '{file_name}.{size}-{mtime}.feather'.format(file_name = file_name, size = stat.st_size, mtime = stat.st_mtime_ns))
+
+def read_csv_sidecar(path, stat, columns = None, nameStems = None):
+    #load a csv from its sidecar if there is a current one, otherwise parse the csv and write the sidecar for next time
+    if not use_sidecars or pyarrow is None:
+        return read_csv_text(path, columns, nameStems)
+    sidecar = sidecar_path(path, stat)
+    if os.path.exists(sidecar):
+        try:
+            if columns is not None:
+                #only the schema is read here, the file is closed again before the columns are loaded
+                with pyarrow.memory_map(sidecar) as source:
+                    available = pyarrow.ipc.open_file(source).schema.names
+                return compact_columns(filter_targets(feather.read_feather(sidecar, columns = [c for c in available if c in columns]), nameStems))
+            return filter_targets(feather.read_feather(sidecar), nameStems)
+        except (pyarrow.ArrowException, OSError, ValueError):
+            #unreadable sidecar (half written by a killed run, different pyarrow) so fall back to the csv and rewrite it
+            pass
+    #the sidecar has every column and row so any later read can use it
+    csv = pd.read_csv(path)
+    write_sidecar(csv, path, sidecar)
+    csv = filter_targets(select_columns(csv, columns), nameStems)
+    return compact_columns(csv) if columns is not None else csv
+
+def read_csv_text(path, columns = None, nameStems = None):
+    #parse a csv, only the columns asked for. With nameStems it's parsed CSV_CHUNK_ROWS rows at a time and each chunk is filtered before the next one
+    #is read, so a large agg file is never in memory whole
+    usecols = (lambda column: column in columns) if columns is not None else None
+    if nameStems is None:
+        csv = pd.read_csv(path, usecols = usecols)
+    else:
+        chunks = [filter_targets(chunk, nameStems) for chunk in pd.read_csv(path, usecols = usecols, chunksize = CSV_CHUNK_ROWS)]
+        csv = pd.concat(chunks, ignore_index = True) if chunks else pd.read_csv(path, usecols = usecols, nrows = 0)
+    return compact_columns(csv) if columns is not None else csv
+
+def select_columns(csv, columns):
+    #keep the requested columns that exist in csv, in the csv's order
+    if columns is None:
+        return csv
+    return csv[[c for c in csv.columns if c in columns]]
+
+def filter_targets(csv, nameStems):
+    #keep the rows whose target starts with one of nameStems. csv comes back as it is if nameStems is None or every row is kept
+    if nameStems is None or 'target' not in csv.columns:
+        return csv
+    keep = csv['target'].astype(str).str.split(':').str[0].isin(nameStems).to_numpy()
+    if keep.all():
+        return csv
+    return csv[keep].reset_index(drop = True)
+
+def compact_columns(csv):
+    #genTarget and type are the same few values all the way down an agg csv so they're kept as categoricals
+    categories = {column: 'category' for column in CATEGORY_COLUMNS if column in csv.columns and csv[column].dtype == object}
+    return csv.astype(categories) if categories else csv
+
+def write_sidecar(csv, path, sidecar):
+    #write the feather copy of a csv, replacing sidecars of older versions of it. Failing to write one is never fatal
+    try:
+        os.makedirs(os.path.dirname(sidecar), exist_ok = True)
+        for old_sidecar in glob.glob(os.path.join(os.path.dirname(sidecar), glob.escape(os.path.basename(path)) + '.*.feather')):
+            os.remove(old_sidecar)
+        temp_path = sidecar + '.tmp{pid}-{thread}'.format(pid = os.getpid(), thread = threading.get_ident())
+        feather.write_feather(csv, temp_path)
+        os.replace(temp_path, sidecar)
+    except (pyarrow.ArrowException, OSError, ValueError, TypeError) as e:
+        print("Couldn't write a sidecar for {path} ({error}). Reading the csv instead.".format(path = path, error = e))
+
+def purge_sidecars(client_dir):
+    #delete every sidecar dir under client_dir
+    removed = 0
+    for root, dirs, files in os.walk(client_dir):
+        if SIDECAR_DIR in dirs:
+            shutil.rmtree(os.path.join(root, SIDECAR_DIR))
+            dirs.remove(SIDECAR_DIR)
+            removed += 1
+    print('Removed {removed} sidecar dirs from {client_dir}.'.format(removed = removed, client_dir = client_dir))
+
+def evict_csv(key):
+    #remove a csv and its target index from the run cache
+    csv = csv_cache.pop(key)
+    target_index_cache.pop(id(csv), None)
+    round_lookup_cache.pop(id(csv), None)
+
+def clear_csv_cache():
+    #empty the run cache and reset the counters
+    csv_cache.clear()
+    target_index_cache.clear()
+    round_lookup_cache.clear()
+    csv_cache_stats['hits'] = 0
+    csv_cache_stats['misses'] = 0
+
+def evict_changed_csvs():
+    #drop cached csvs whose file changed or was removed since it was read. Returns how many were dropped.
+    #load_csv never hands out a stale frame anyway, this is so a process that stays up (synthesis_service.py) doesn't hold on to them
+    stale = []
+    for key in csv_cache:
+        try:
+            changed = os.stat(key[0]).st_mtime_ns != key[1]
+        except FileNotFoundError:
+            changed = True
+        if changed:
+            stale.append(key)
+    for key in stale:
+        evict_csv(key)
+    return len(stale)
+
+def read_in_csv(client_dir, client_dir_path, directory, csv_name, columns = None, nameStems = None):
+    #read in cyan csvs and print warning if none is found. columns and nameStems are passed on to load_csv
     if csv_name =='pct':
         #MDK: if we're looking for a pct file and it's not in top level agg then assume we're dealing with one school and get pct from school level agg
         #This also seems messy. 
         try:
-            csv = pd.read_csv('{product_level}/{directory}/{csv_name}.csv'.format(product_level = client_dir_path, directory = directory, csv_name = csv_name))
+            csv = load_csv(lookup_csv(client_dir_path, directory, csv_name), columns, nameStems)
         except FileNotFoundError:
             pass
             #MDK is below a useful warning? Commented it out bc of school-level stuff
             #print("Only 1 school in {product_level}. If that's not right check why there's no pct csv in {product_level}/{directory}.".format(product_level = client_dir.split('/')[2], directory=directory, csv_name=csv_name))
             pct_path = find('pct.csv', client_dir)
-            csv = pd.read_csv(pct_path)
+            csv = load_csv(pct_path, columns, nameStems)
     else:
         try:
-            csv = pd.read_csv('{product_level}/{directory}/{csv_name}.csv'.format(product_level = client_dir_path, directory = directory, csv_name = csv_name))
+            csv = load_csv(lookup_csv(client_dir_path, directory, csv_name), columns, nameStems)
         except FileNotFoundError:
             print("\nNot finding a {csv_name} file in {product_level}/{directory}. Make sure CYAN has been run completely.".format(product_level = client_dir, directory = directory, csv_name = csv_name))
             csv = pd.DataFrame()
@@ -152,10 +446,245 @@ def read_in_csv(client_dir, client_dir_path, directory, csv_name):
     return csv
 
 def find(name, path):
-    #search dir for a file and return the path to that file
-    for root, dirs, files in os.walk(path):
-        if name in files:
-            return os.path.join(root, name)   
+    #search dir for a file and return the path to that file. Inside the indexed client dir this is answered from the client index instead of walking the drive.
+    #If more than one file matches the first one is still used but all of them are listed so it's clear which one that was.
+    matches = indexed_files(name, path)
+    if matches is None:
+        matches = [os.path.join(root, name) for root, dirs, files in os.walk(path) if name in files]
+    if len(matches) > 1:
+        print("\nFound {count} {name} files under {path}. Using the first one:\n{matches}".format(count = len(matches), name = name, path = path, matches = '\n'.join(matches)))
+    if matches:
+        return matches[0]
+
+#the client dir is walked once at startup (build_client_index) and all path lookups under it are answered from here.
+#The client dirs are on a slow shared drive so nothing else should need to walk or list them.
+client_index = {}
+#csvs a report reads from a product level's dir and from a nameStem's dir under it
+LEVEL_INPUTS = [('agg', 'allmean.csv'), ('agg', 'highprop.csv'), ('agg', 'allcount.csv'), ('data', 'roundMeta.csv'), ('data', 'schoolMeta.csv')]
+SCHOOL_INPUTS = [('agg', 'pct.csv')]
+
+def build_client_index(client_dir):
+    #walk client_dir once and record every file by name, the product level dirs, and the agg csvs for each product_level/nameStem.
+    #Symlinked dirs are followed like open would follow them, files keep their path through the link. A link back to a dir above it isn't walked again
+    root = os.path.normpath(os.path.abspath(client_dir))
+    files = {}
+    paths = set()
+    agg_files = {}
+    report_inputs = {}
+    product_levels = []
+    for dir_path, dirs, file_names in os.walk(root, followlinks = True):
+        if SIDECAR_DIR in dirs:
+            dirs.remove(SIDECAR_DIR)
+        if os.path.islink(dir_path) and links_to_parent(dir_path, root):
+            del dirs[:]
+            continue
+        if dir_path == root:
+            product_levels = list(dirs)
+        relative = os.path.relpath(dir_path, root).split(os.sep)
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            files.setdefault(file_name, []).append(path)
+            paths.add(path)
+            #<product_level>/agg/x.csv is the product level's agg and <product_level>/<nameStem>/agg/x.csv a school's or the district's
+            if relative[-1] == 'agg' and len(relative) in (2, 3) and file_name.endswith('.csv'):
+                nameStem = relative[1] if len(relative) == 3 else ''
+                agg_files.setdefault((relative[0], nameStem), {})[file_name[:-len('.csv')]] = path
+            #the csvs reports read, by product_level/nameStem, for the input hashes of incremental builds
+            if (len(relative) == 2 and (relative[1], file_name) in LEVEL_INPUTS) or (len(relative) == 3 and (relative[2], file_name) in SCHOOL_INPUTS):
+                report_inputs.setdefault((relative[0], relative[1] if len(relative) == 3 else ''), []).append(path)
+    client_index.clear()
+    client_index.update({'root': root, 'files': files, 'paths': paths, 'product_levels': product_levels, 'agg': agg_files, 'inputs': report_inputs})
+    return client_index
+
+def links_to_parent(dir_path, root):
+    #whether dir_path resolves to itself or one of the dirs above it, up to root, so walking into it would go round in a loop
+    real = os.path.realpath(dir_path)
+    parent = dir_path
+    while parent != root and os.path.dirname(parent) != parent:
+        parent = os.path.dirname(parent)
+        if os.path.realpath(parent) == real:
+            return True
+    return False
+
+def indexed_root(path):
+    #normalized path if it's inside the indexed client dir, otherwise False
+    if not client_index:
+        return False
+    path = os.path.normpath(os.path.abspath(path))
+    if path == client_index['root'] or path.startswith(client_index['root'] + os.sep):
+        return path
+    return False
+
+def indexed_files(name, path):
+    #paths of files called name under path, in os.walk order. None if path isn't inside the indexed client dir
+    path = indexed_root(path)
+    if not path:
+        return None
+    return [match for match in client_index['files'].get(name, []) if match.startswith(path + os.sep)]
+
+def list_product_levels(client_dir):
+    #names of the dirs at the top of client_dir, in the order os.scandir lists them
+    if indexed_root(client_dir) == client_index.get('root'):
+        return list(client_index['product_levels'])
+    return [f.name for f in os.scandir(client_dir) if f.is_dir()]
+
+def lookup_csv(client_dir_path, directory, csv_name):
+    #path of a cyan csv. Inside the indexed client dir a missing file raises FileNotFoundError straight from the index without touching the drive
+    path = '{product_level}/{directory}/{csv_name}.csv'.format(product_level = client_dir_path, directory = directory, csv_name = csv_name)
+    normalized = indexed_root(client_dir_path)
+    if not normalized:
+        return path
+    relative = os.path.relpath(normalized, client_index['root']).split(os.sep)
+    if directory == 'agg' and len(relative) in (1, 2) and relative[0] != '.':
+        found = client_index['agg'].get((relative[0], relative[1] if len(relative) == 2 else ''), {}).get(csv_name)
+    else:
+        found = os.path.normpath(os.path.abspath(path))
+        if found not in client_index['paths']:
+            found = None
+    if found is None:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    return found
+
+#while one product level (or school) is being filled in, the csvs of the next ones are read into the csv cache on background threads so the CPU isn't
+#left waiting on the shared drive. Items are still handed out in order and at most prefetch_depth items are read ahead, so memory stays bounded
+PREFETCH_THREADS = 4
+prefetch_depth = 2
+
+def prefetch_csv(path, columns = None, nameStems = None):
+    #load a csv into the cache on a prefetch thread. A file that can't be read is left for the main thread to read again and report
+    try:
+        load_csv(path, columns, nameStems)
+    except Exception:
+        pass
+
+def level_csv_paths(client_dir, product_level, nameStems):
+    #(path, columns, nameStems) load_csv arguments of the agg and data csvs of a product level and the pct csvs of nameStems at it, read the way the
+    #data cube and fill_in_data read them so prefetched frames are the ones they look up. Files that aren't there are left out
+    columns = cyan_schema['columns']
+    targets = client_nameStems(client_dir, product_level)
+    wanted = [(os.path.join(client_dir, product_level), 'agg', 'allmean', columns, targets), (os.path.join(client_dir, product_level), 'agg', 'highprop', columns, targets)]
+    wanted += [(os.path.join(client_dir, product_level), directory, csv_name, None, None) for directory, csv_name in [('data', 'roundMeta'), ('agg', 'allcount'), ('data', 'schoolMeta')]]
+    wanted += [(os.path.join(client_dir, product_level, nameStem), 'agg', 'pct', columns, None) for nameStem in nameStems]
+    paths = []
+    for client_dir_path, directory, csv_name, csv_columns, csv_nameStems in wanted:
+        try:
+            paths.append((lookup_csv(client_dir_path, directory, csv_name), csv_columns, csv_nameStems))
+        except FileNotFoundError:
+            pass
+    return paths
+
+def prefetched(items, paths, depth = None):
+    #yield items in order while the csvs of the next depth items are read on background threads. paths(item) lists them as load_csv arguments.
+    #An item is only handed out once its own csvs are in the cache
+    items = list(items)
+    depth = prefetch_depth if depth is None else depth
+    if depth < 1 or len(items) < 2:
+        yield from items
+        return
+    with concurrent.futures.ThreadPoolExecutor(PREFETCH_THREADS) as executor:
+        queued = deque()
+        for i, item in enumerate(items):
+            while len(queued) <= depth and i + len(queued) < len(items):
+                queued.append([executor.submit(prefetch_csv, *request) for request in paths(items[i + len(queued)])])
+            concurrent.futures.wait(queued.popleft())
+            yield item
+
+def index_targets(csv):
+    #index the row positions of a cyan csv by the nameStem part of its target, once.
+    #Selecting a district or school slice is then a dict lookup instead of a row by row scan of the whole csv.
+    #Indexes of csvs in the run cache are kept with them so each file is only indexed once per run.
+    cached = target_index_cache.get(id(csv))
+    if cached is not None and cached['csv'] is csv:
+        return cached
+    name_stems = csv['target'].astype(str).str.split(':').str[0]
+    target_index = {
+    'csv': csv,
+    'positions': name_stems.groupby(name_stems.values, sort = False).indices}
+    with csv_cache_lock:
+        if any(cached_csv is csv for cached_csv in csv_cache.values()):
+            target_index_cache[id(csv)] = target_index
+    return target_index
+
+#CYAN data cube. The allmean, highprop and pct rows of a product level are loaded once per build into float64 arrays labeled with each row's
+#nameStem, round and type, and district, school and multilevel reports all take their rows from it with cube_rows
+data_cube = {}
+
+def cube_block(csv):
+    #the numeric columns of a cyan csv as a float64 array, with its key columns and row positions by nameStem
+    target_index = index_targets(csv)
+    key_columns = [column for column in ['target', 'genTarget', 'type'] if column in csv.columns]
+    variables = [column for column in csv.columns if column not in key_columns and pd.api.types.is_numeric_dtype(csv[column])]
+    return {
+    'variables': variables,
+    'values': csv[variables].to_numpy(dtype = float),
+    'keys': {column: csv[column].to_numpy() for column in key_columns},
+    'positions': target_index['positions']}
+
+def load_cube(client_dir, product_level):
+    #the cube of a product level. Means and percent positives are loaded straight away, percentiles are in a pct.csv per nameStem and are loaded when first used
+    key = (client_dir, product_level)
+    if key not in data_cube:
+        nameStems = client_nameStems(client_dir, product_level)
+        data_cube[key] = {
+        'mean': cube_block(read_in_csv(client_dir, os.path.join(client_dir, product_level), 'agg', 'allmean', cyan_schema['columns'], nameStems)),
+        'percent_pos': cube_block(read_in_csv(client_dir, os.path.join(client_dir, product_level), 'agg', 'highprop', cyan_schema['columns'], nameStems)),
+        'percentile': {}}
+    return data_cube[key]
+
+def cube_metric(client_dir, product_level, metric, nameStem):
+    #the block holding one metric for nameStem
+    cube = load_cube(client_dir, product_level)
+    if metric != 'percentile':
+        return cube[metric]
+    if nameStem not in cube['percentile']:
+        cube['percentile'][nameStem] = cube_block(read_in_csv(client_dir, os.path.join(client_dir, product_level, nameStem), 'agg', 'pct', cyan_schema['columns']))
+    return cube['percentile'][nameStem]
+
+def cube_positions(block, nameStem, row_type = False):
+    #row positions of nameStem in a block, only rows of row_type if it's passed
+    positions = block['positions'].get(nameStem)
+    if positions is not None and row_type:
+        positions = positions[block['keys']['type'][positions] == row_type]
+    return positions
+
+def cube_rows(client_dir, product_level, metric, nameStem, row_type = False):
+    #the rows of the metric's cyan csv (mean, percentile or percent_pos) whose target starts with nameStem, in file order, with the key columns and a
+    #float column per variable. If row_type is passed (highprop) only rows of that type are kept. Returns an empty df when nothing matches
+    key = (client_dir, product_level, metric, nameStem, row_type)
+    if key in pinned_rows:
+        return pinned_rows[key].copy()
+    block = cube_metric(client_dir, product_level, metric, nameStem)
+    positions = cube_positions(block, nameStem, row_type)
+    if positions is None or len(positions) == 0:
+        return pd.DataFrame()
+    rows = pd.DataFrame(block['values'][positions], columns = block['variables'])
+    for i, (column, values) in enumerate(block['keys'].items()):
+        rows.insert(i, column, values[positions])
+    return rows
+
+#--low_memory. The district pass takes the rows every school (and single school multilevel) report will ask cube_rows for out of a product level's
+#cube and keeps them here, then lets go of the cube and its allmean, highprop and pct csvs before the next product level is read. Peak memory is
+#then one product level's csvs (plus what's being prefetched) instead of every product level's
+low_memory = False
+pinned_rows = {}
+CUBE_CSVS = ['allmean', 'highprop', 'pct']
+
+def pin_school_rows(client_dir, product_level, nameStems):
+    #keep the rows school and multilevel reports read for nameStems at product_level so they don't need the cube again
+    for nameStem in nameStems:
+        for metric, row_type in [('mean', False), ('percentile', False), ('percent_pos', False), ('percent_pos', 'school')]:
+            rows = cube_rows(client_dir, product_level, metric, nameStem, row_type)
+            pinned_rows[(client_dir, product_level, metric, nameStem, row_type)] = rows
+
+def release_product_level(client_dir, product_level):
+    #drop a product level's cube and the csvs it was made from. Returns how many csvs were dropped
+    data_cube.pop((client_dir, product_level), None)
+    level_dir = os.path.join(os.path.realpath(os.path.join(client_dir, product_level)), '')
+    with csv_cache_lock:
+        released = [key for key in csv_cache if key[0].startswith(level_dir) and os.path.basename(key[0]).split('.')[0] in CUBE_CSVS]
+        for key in released:
+            evict_csv(key)
+    return len(released)
 
 def create_bar_dict(var_dict):
     #create dictionaries with variable names to create bar charts
@@ -166,12 +695,20 @@ def create_bar_dict(var_dict):
     return bar_dict
 
 def add_trend_col(df, rnd_dict, column_name):
-    #use rnd_dict to create a new col 'trend' in dfs
-    for index, row in df.iterrows():
-        for key, value in rnd_dict.items():
-            if value[0] == str(row[column_name]).split(':')[-1]: 
-                trend = key
-        df.at[index, 'trend'] = trend
+    #use rnd_dict to create a new col 'trend' in dfs. Rows are matched on the round at the end of column_name and a row whose round isn't in rnd_dict
+    #gets the trend of the row above it, same as tagging the rows one at a time did
+    #the frames are a few rows each so this is one pass over the column's values and a single column write, pandas string methods cost more than they save
+    if df.empty:
+        return df
+    trends = {value[0]: key for key, value in rnd_dict.items()}
+    trend = np.empty(len(df))
+    last_trend = None
+    for i, target in enumerate(df[column_name].values):
+        last_trend = trends.get(str(target).split(':')[-1], last_trend)
+        if last_trend is None:
+            raise ValueError("The round of {target} isn't in the round dict so it has no trend.".format(target = target))
+        trend[i] = last_trend
+    df['trend'] = trend
     return df
 
 def determine_quartile(percentile):
@@ -188,6 +725,18 @@ def determine_quartile(percentile):
         quartile = 4
     return quartile
 
+def round_lookup(round_meta):
+    #rnd: (RoundID, SurveyPeriod) for every round that's in roundMeta once. Lookups of roundMeta csvs in the run cache are kept with them like target indexes
+    cached = round_lookup_cache.get(id(round_meta))
+    if cached is not None and cached[0] is round_meta:
+        return cached[1]
+    once = ~round_meta['rnd'].duplicated(keep = False).to_numpy()
+    rounds = dict(zip(round_meta['rnd'].values[once], zip(round_meta['RoundID'].values[once], round_meta['SurveyPeriod'].values[once])))
+    with csv_cache_lock:
+        if any(cached_csv is round_meta for cached_csv in csv_cache.values()):
+            round_lookup_cache[id(round_meta)] = (round_meta, rounds)
+    return rounds
+
 def make_rnd_dict(district_mean, district_percentile, district_percent_pos, round_meta, product_level):
     #make a dict of rounds the client has data for with one being current and the most recent past being past
     rnd_dict = {}
@@ -199,95 +748,151 @@ def make_rnd_dict(district_mean, district_percentile, district_percent_pos, roun
         #create dictionary of rounds for client
         rnd_list = district_mean.loc[:,'target'].tolist()
         rnd_list = [rnd.split(":")[-1] for rnd in rnd_list]
+        rounds = round_lookup(round_meta)
         for rnd in rnd_list:
-            try:
-                rnd_dict[int(round_meta.loc[round_meta['rnd'] == rnd,'RoundID'])] = (rnd, round_meta.loc[round_meta['rnd'] == rnd, "SurveyPeriod"].values[0])
-            except TypeError:
+            if rnd not in rounds:
                 print("Oops! Rounds don't seem to match up across product/levels. Make sure this client dir only has data from the most recent round.\n")
-                raise
-        year = 0
-        for key, value in list(rnd_dict.items()):
-            new_rnd_dict[year] = rnd_dict.pop(max(rnd_dict))
-            year +=1
+                raise TypeError('Round {rnd} should be in roundMeta once.'.format(rnd = rnd))
+            rnd_dict[int(rounds[rnd][0])] = (rnd, rounds[rnd][1])
+        #most recent RoundID first
+        new_rnd_dict = dict(enumerate(rnd_dict[round_id] for round_id in sorted(rnd_dict, reverse = True)))
     return new_rnd_dict
 
 def add_trend_data_to_dfs(mean_df, percentile_df, percent_pos_df, rnd_dict):
     #use add_trend_col to add trend info to dfs and drop old rounds
-    mean_df = add_trend_col(mean_df, rnd_dict, 'target')
-    percentile_df = add_trend_col(percentile_df, rnd_dict, 'target')
-    percent_pos_df = add_trend_col(percent_pos_df, rnd_dict, 'target')
-
-    #drop old rounds
-    mean_df = mean_df[mean_df.trend != 'old']
-    mean_df = mean_df.reset_index(drop=True)
-    percentile_df = percentile_df[percentile_df.trend != 'old']
-    percentile_df = percentile_df.reset_index(drop = True)
-    percent_pos_df = percent_pos_df[percent_pos_df.trend != 'old']
-    percent_pos_df = percent_pos_df.reset_index(drop = True)
+    mean_df = drop_old_rounds(add_trend_col(mean_df, rnd_dict, 'target'))
+    percentile_df = drop_old_rounds(add_trend_col(percentile_df, rnd_dict, 'target'))
+    percent_pos_df = drop_old_rounds(add_trend_col(percent_pos_df, rnd_dict, 'target'))
     return mean_df, percentile_df, percent_pos_df
 
-def fill_in_df(product_level, df, mean_df, percentile_df, percent_pos_df, level_dict, trend_dict, mean = False):
-    #fills in values in premade dfs matching column names in cyan dfs on variable names in cells of df 
-    for column in mean_df.columns:
-        for index, row in df.iterrows():
-            if column == df.loc[index, level_dict[product_level.split('_')[1].lower()]]:
-                percentile = round(float(percentile_df.loc[percentile_df['trend'] == 0, column]), 2)
-                quartile = determine_quartile(percentile)
-                if len(percentile_df) > 1:
-                    last_percentile = round(float(percentile_df.loc[percentile_df['trend'] == 1, column]), 2)
-                    last_percent_pos = roundPercent(float(percent_pos_df.loc[percent_pos_df['trend'] == 1, column]))
-                    last_abs_score = round(float(mean_df.loc[mean_df['trend'] == 1, column]), 2)
-                else:
-                    last_percentile = False
-                    last_percent_pos = False
-                    last_abs_score = False
-                if mean:
-                    abs_score = round(float(mean_df.loc[mean_df['trend'] == 0, column]), 2) 
-                    trend, difference = determine_trend(abs_score, last_abs_score)
-                    df.loc[index, level_dict[product_level.split('_')[1].lower()]] = [abs_score, quartile]
-                    df.loc[index, trend_dict[product_level.split('_')[1].lower()]] = [trend, difference]
-                else:
-                    percent_pos = roundPercent(float(percent_pos_df.loc[percent_pos_df['trend'] == 0, column]))
-                    trend, difference = determine_trend(percent_pos, last_percent_pos)
-                    if np.isnan(percentile):
-                        df.loc[index, product_dict[product_level.split('_')[0]]] = np.nan
-                        df.loc[index, trend_dict[product_level.split('_')[0]]] = np.nan
-                    else:
-                        df.loc[index, level_dict[product_level.split('_')[1].lower()]] = ['{percent_pos}%'.format(percent_pos = percent_pos), quartile]
-                        df.loc[index, trend_dict[product_level.split('_')[1].lower()]] = [trend, difference]
+def drop_old_rounds(df):
+    #drop rows with an old trend and number the rest from 0. A frame with nothing to drop and a 0 to n index is returned as it is rather than copied twice
+    old = (df.trend == 'old').to_numpy()
+    if old.any():
+        df = df[~old]
+    if not df.index.equals(pd.RangeIndex(len(df))):
+        df = df.reset_index(drop = True)
     return df
 
-def schools_fill_in_df(product_level, df, mean_df, percentile_df, percent_pos_df, level_dict, school_trend_dict, product_dict, mean = False):
-    #fills in values in premade dfs matching column names in cyan dfs on variable names in cells of df 
-    for column in mean_df.columns:
-        for index, row in df.iterrows():
-            if column == df.loc[index, product_dict[product_level.split('_')[0]]]:
-                percentile = round(float(percentile_df.loc[percentile_df['trend'] == 0, column]), 2)
-                quartile = determine_quartile(percentile)
-                if len(percentile_df) > 1:
-                    last_percentile = round(float(percentile_df.loc[percentile_df['trend'] == 1, column]), 2)
-                    last_percent_pos = roundPercent(float(percent_pos_df.loc[percent_pos_df['trend'] == 1, column]))
-                    last_abs_score = round(float(mean_df.loc[mean_df['trend'] == 1, column]), 2)
-                else:
-                    last_percentile = False
-                    last_percent_pos = False
-                    last_abs_score = False
-                if mean:
-                    abs_score = round(float(mean_df.loc[mean_df['trend'] == 0, column]), 2) 
-                    trend, difference = determine_trend(abs_score, last_abs_score)
-                    df.loc[index, product_dict[product_level.split('_')[0]]] = [abs_score, quartile]
-                    df.loc[index, school_trend_dict[product_level.split('_')[0]]] = [trend, difference]
-                else:
-                    percent_pos = roundPercent(float(percent_pos_df.loc[percent_pos_df['trend'] == 0, column]))
-                    trend, difference = determine_trend(percent_pos, last_percent_pos)
-                    if np.isnan(percentile):
-                        df.loc[index, product_dict[product_level.split('_')[0]]] = np.nan
-                        df.loc[index, school_trend_dict[product_level.split('_')[0]]] = np.nan
-                    else:  
-                        df.loc[index, product_dict[product_level.split('_')[0]]] = ['{percent_pos}%'.format(percent_pos = percent_pos), quartile]
-                        df.loc[index, school_trend_dict[product_level.split('_')[0]]] = [trend, difference]
+def trend_values(df, trend, variables):
+    #one round of a cyan df as an array of floats in the order of variables. Like float() on a filtered column this fails unless exactly one row has the trend
+    rows = df.loc[df['trend'] == trend, variables]
+    if len(rows) != 1:
+        raise TypeError('Expected one row with trend {trend} but found {count}.'.format(trend = trend, count = len(rows)))
+    return rows.to_numpy(dtype = float)[0]
+
+def determine_quartiles(percentiles):
+    #determine_quartile for a whole array of percentiles. nan percentiles get a nan quartile
+    percentiles = np.asarray(percentiles, dtype = float)
+    with np.errstate(invalid = 'ignore'):
+        quartiles = np.select([percentiles >= 75, percentiles >= 50, percentiles >= 25, percentiles < 25], [1, 2, 3, 4], default = np.nan)
+    return [quartile if np.isnan(quartile) else int(quartile) for quartile in quartiles]
+
+def make_trend_lookup(mean_df, percentile_df, percent_pos_df, variables):
+    #pivot the cyan dfs into (trend, variable) arrays once and work out the cells for every variable that appears in a template.
+    #Returns a dict of variable: cells, where cells has the (value, quartile) mean and percent positive cells plus their (trend, difference) trend cells.
+    #determine_trend is still called per value so differences keep the number types (and formatting) they always had.
+    variables = [column for column in mean_df.columns if column in variables]
+    if not variables:
+        return {}
+    percentiles = [round(value, 2) for value in trend_values(percentile_df, 0, variables).tolist()]
+    quartiles = determine_quartiles(percentiles)
+    if len(percentile_df) > 1:
+        last_percent_pos = [roundPercent(value) for value in trend_values(percent_pos_df, 1, variables).tolist()]
+        last_abs_scores = [round(value, 2) for value in trend_values(mean_df, 1, variables).tolist()]
+    else:
+        last_percent_pos = [False] * len(variables)
+        last_abs_scores = [False] * len(variables)
+    abs_scores = [round(value, 2) for value in trend_values(mean_df, 0, variables).tolist()]
+    percent_pos = [roundPercent(value) for value in trend_values(percent_pos_df, 0, variables).tolist()]
+
+    trend_lookup = {}
+    for i, variable in enumerate(variables):
+        cells = {}
+        cells['mean'] = (abs_scores[i], quartiles[i])
+        cells['mean_trend'] = determine_trend(abs_scores[i], last_abs_scores[i])
+        if np.isnan(percentiles[i]):
+            cells['percent'] = (np.nan, np.nan)
+            cells['percent_trend'] = (np.nan, np.nan)
+        else:
+            cells['percent'] = ('{percent_pos}%'.format(percent_pos = percent_pos[i]), quartiles[i])
+            cells['percent_trend'] = determine_trend(percent_pos[i], last_percent_pos[i])
+        trend_lookup[variable] = cells
+    return trend_lookup
+
+#filled in table cells are kept in typed columns. A value column like High or Student holds the mean or percent positive and the float column
+#High:quartile its quartile (nan until it's filled in). A trend column like hs_trend holds the trend arrow and the float column hs_trend:difference
+#the difference (nan if there isn't one). deal_with_nas_in_dfs sets the bool column hs_trend:no_trend for trends with no difference to show.
+#gen_html doesn't show these columns, it turns them into text
+QUARTILE = ':quartile'
+DIFFERENCE = ':difference'
+NO_TREND = ':no_trend'
+#the value column each trend column belongs to, district and school
+TREND_VALUE_COLUMNS = {'es_trend': 'Elementary', 'ms_trend': 'Middle', 'hs_trend': 'High', 'ose_trend': 'Student', 'fam_trend': 'Family', 'sta_trend': 'Staff'}
+
+def add_cell_columns(df, value_columns, trend_columns):
+    #add the quartile, difference and no trend columns for the value and trend columns df has, if it doesn't have them yet
+    for column, suffix, empty in [(column, QUARTILE, np.nan) for column in value_columns] + [(column, suffix, empty) for column in trend_columns for suffix, empty in [(DIFFERENCE, np.nan), (NO_TREND, False)]]:
+        if column in df.columns and column + suffix not in df.columns:
+            df[column + suffix] = pd.Series(empty, index = df.index, dtype = bool if suffix == NO_TREND else float)
+    return df
+
+def is_cell_column(column):
+    #whether column is one of the columns added by add_cell_columns
+    return isinstance(column, str) and (column.endswith(QUARTILE) or column.endswith(DIFFERENCE) or column.endswith(NO_TREND))
+
+def template_variables(dfs, column):
+    #every variable name in column across a collection of template dfs
+    variables = set()
+    for df in dfs:
+        if column in df.columns:
+            variables.update(value for value in df[column].values if isinstance(value, str))
+    return variables
+
+def fill_in_template(df, value_column, trend_column, trend_lookup, mean = False):
+    #write the looked up cells into every cell of value_column that names a variable, and the trend cell next to it.
+    #cells that were already filled in have a quartile so they are never matched twice
+    add_cell_columns(df, [value_column], [trend_column])
+    unfilled = pd.isnull(df[value_column + QUARTILE].values)
+    variables = df[value_column].values
+    rows = [position for position, (variable, empty) in enumerate(zip(variables, unfilled)) if empty and isinstance(variable, str) and variable in trend_lookup]
+    if not rows:
+        return df
+    value_cell, trend_cell = ('mean', 'mean_trend') if mean else ('percent', 'percent_trend')
+    cells = [trend_lookup[variable] for variable in variables[rows]]
+    #positional writes, one for the two template columns and one for each typed column. Label based writes column by column cost more than the lookups
+    template_values = np.empty((len(rows), 2), dtype = object)
+    quartiles = np.empty(len(rows))
+    differences = np.empty(len(rows))
+    for i, variable_cells in enumerate(cells):
+        value, quartile = variable_cells[value_cell]
+        trend, difference = variable_cells[trend_cell]
+        template_values[i] = [value, trend]
+        quartiles[i] = quartile
+        #determine_trend gives '' when there's nothing to compare with
+        differences[i] = np.nan if isinstance(difference, str) else difference
+    df.iloc[rows, [df.columns.get_loc(value_column), df.columns.get_loc(trend_column)]] = template_values
+    df.iloc[rows, df.columns.get_loc(value_column + QUARTILE)] = quartiles
+    df.iloc[rows, df.columns.get_loc(trend_column + DIFFERENCE)] = differences
     return df
 
+def fill_in_df(product_level, df, mean_df, percentile_df, percent_pos_df, level_dict, trend_dict, mean = False, trend_lookup = None):
+    #fills in values in premade dfs matching column names in cyan dfs on variable names in cells of df 
+    #pass trend_lookup from make_trend_lookup when filling several dfs from the same cyan dfs so they're only pivoted once
+    level_column = level_dict[product_level.split('_')[1].lower()]
+    trend_column = trend_dict[product_level.split('_')[1].lower()]
+    if trend_lookup is None:
+        trend_lookup = make_trend_lookup(mean_df, percentile_df, percent_pos_df, template_variables([df], level_column))
+    return fill_in_template(df, level_column, trend_column, trend_lookup, mean)
+
+def schools_fill_in_df(product_level, df, mean_df, percentile_df, percent_pos_df, level_dict, school_trend_dict, product_dict, mean = False, trend_lookup = None):
+    #fills in values in premade dfs matching column names in cyan dfs on variable names in cells of df 
+    product_column = product_dict[product_level.split('_')[0]]
+    trend_column = school_trend_dict[product_level.split('_')[0]]
+    if trend_lookup is None:
+        trend_lookup = make_trend_lookup(mean_df, percentile_df, percent_pos_df, template_variables([df], product_column))
+    return fill_in_template(df, product_column, trend_column, trend_lookup, mean)
+
 def fill_in_bar_dict(bar_dict, product_level, district_percent_pos, rnd_dict):
     #similar too fill_in_df but for bar_dicts with data for bar charts. Difference is it adds multiple years of trend data
     percent_pos_list = []
@@ -352,26 +957,44 @@ def create_arrow(trend_value):
         arrow = empty
     return arrow
 
-def gen_rr_table(product_level, all_count, school_meta, rnd_dict, target, school_list, school = False):
-    #return response count and response rate for each product level passed
-    rr_table_row = {}
-    responses = 0
+def single_values(df, key, column, keys):
+    #{key: the value in column} for each of keys that has rows in df, from one groupby. Like int() on a filtered column this fails if a key has more than one row
+    groups = df[df[key].isin(keys)].groupby(key, sort = False)[column]
+    sizes = groups.size()
+    if (sizes > 1).any():
+        raise TypeError('Expected one row for {key} {value} but found {count}.'.format(key = key, value = sizes[sizes > 1].index[0], count = sizes.max()))
+    return groups.first().to_dict()
+
+def response_rates(all_count, school_meta, rnd_dict, school_list):
+    #(denominator, count, rate, nameStem, school name) of every school in school_list with responses this round, in school_list order. all_count and
+    #school_meta are each gone through once rather than once per school. Schools without a response rate denominator in schoolMeta get N/A's
+    counts = single_values(all_count[all_count['target'].str.contains(rnd_dict[0][0])], 'genTarget', 'total', school_list)
+    current_meta = school_meta[school_meta['current'] == 1]
+    denoms = single_values(current_meta, 'genTarget', 'respTarget', counts.keys())
+    names = single_values(current_meta, 'genTarget', 'SchoolName', counts.keys())
+    rows = []
     for school in school_list:
-        school_count_row = all_count[(all_count['genTarget'] == school) & (all_count['target'].str.contains(rnd_dict[0][0]))]
-        if not school_count_row.empty:
-            school_count = int(school_count_row["total"])
-            responses += school_count
-            school_meta_row = school_meta[(school_meta['genTarget'] == school) & (school_meta['current'] == 1)]
+        if school in counts:
+            if school not in names:
+                raise TypeError('No current row in schoolMeta for {school}.'.format(school = school))
+            school_count = int(counts[school])
             try:
-                school_denom = int(school_meta_row['respTarget']) #Response rates denominator 
+                school_denom = int(denoms[school]) #Response rates denominator 
                 school_rate = roundPercent(np.divide(school_count, school_denom))
             except ValueError:
                 print("No response rate denom in School Meta. Using N/A's.")
                 school_denom = 'N/A'
                 school_rate = 'N/A'
-            school_name = school_meta_row['SchoolName'].values[0]
-            nameStem = school_meta_row['genTarget'].values[0]
-            rr_table_row[school_name] = [school_denom, school_count, school_rate, nameStem]
+            rows.append((school_denom, school_count, school_rate, school, names[school]))
+    return rows
+
+def gen_rr_table(product_level, all_count, school_meta, rnd_dict, target, school_list, school = False):
+    #return response count and response rate for each product level passed
+    rr_table_row = {}
+    responses = 0
+    for school_denom, school_count, school_rate, nameStem, school_name in response_rates(all_count, school_meta, rnd_dict, school_list):
+        responses += school_count
+        rr_table_row[school_name] = [school_denom, school_count, school_rate, nameStem]
     rr_table = pd.DataFrame.from_dict(rr_table_row, orient = 'index', columns = ["Survey Population", "Number of Responses Received", "Response Rate", "nameStem"])
     rr_table.index.name = 'School Name'
     rr_table = rr_table.reset_index()
@@ -418,7 +1041,7 @@ def deal_with_trend_data_in_bars(bar_dict, level, rnd_dict, level_dict):
 def read_in_multi_dict(path):
     #read in multi_dict file
     try:
-        with open('{path_to_file}'.format(path_to_file = multi_dict_path)) as f:
+        with open('{path_to_file}'.format(path_to_file = path)) as f:
             multi_dict = json.load(f)
         print('\nFound multi_dict json. Please make sure all schools listed in this dict should get combined school-level synthesis reports.')
     except FileNotFoundError:
@@ -453,6 +1076,32 @@ def create_multilevel_school_report(combined_school, school_list, variables, sch
         multilevel_school_report = gen_report(combined_school, multilevel_tables, multilevel_bars, rnd_dict, total_responses, school = False)
     return multilevel_school_report, nameStem_list
 
+def create_multilevel_worker(multilevel_school):
+    #makes the multilevel report for one multi_dict entry from copies of the district's empty dfs and bar_dicts. Everything but the entry comes from worker_state
+    combined_school, school_list = multilevel_school
+    with stage('multilevel/{combined_school}'.format(combined_school = combined_school)):
+        multilevel_dfs = copy.deepcopy(worker_state['empty_dfs'])
+        multilevel_bar_dicts = copy.deepcopy(worker_state['empty_bar_dicts'])
+        return create_multilevel_school_report(combined_school, school_list, worker_state['variables'], worker_state['schools_full_names_dict'], worker_state['schools_nameStems_dict'],
+        worker_state['client_dir'], worker_state['current_round'], multilevel_dfs, multilevel_bar_dicts, worker_state['factor_dict_by_product'])
+
+def create_school_report(school):
+    #finishes off one school's data and makes its report. school is (nameStem, filled in school dfs, school bars), the district rr_dict and rnd_dict come from worker_state
+    nameStem, school_dfs, school_bars = school
+    with stage('school_report/{nameStem}'.format(nameStem = nameStem)):
+        full_school_name = worker_state['schools_full_names_dict'][nameStem]
+        school_dfs = deal_with_nas_in_dfs(school_dfs, school = True)
+        level = worker_state['schools_nameStems_dict'][nameStem][0].split("_")[1]
+        school_dfs = drop_wrong_level_school_dfs(school_dfs, level)
+        school_tables = {}
+        for df_name, df in school_dfs.items():
+            df_name = convert_school_object_names(df_name)
+            school_tables[df_name] = gen_html(df, school = True)
+        school_rr_dict, total_responses = gen_school_rr_dict(worker_state['rr_dict'], nameStem, worker_state.get('rr_index'))
+        school_tables['response_rates'] = gen_html(school_rr_dict)
+        school_report = gen_report(full_school_name, school_tables, school_bars, worker_state['rnd_dict'], total_responses, school = True)
+        return school_report
+
 def create_empty_structures(variables, client_dir):
     #first step is to create empty dfs and dictionaries where the data will go. 
     #This function creates those structures in the format that they will need to be in in the json.
@@ -463,6 +1112,9 @@ def create_empty_structures(variables, client_dir):
     all_factors = create_all_factors_df(factor_dict_by_product, variables.es_ose_ordered_factors_list, variables.ms_ose_ordered_factors_list, variables.hs_ose_ordered_factors_list,
     variables.es_fam_ordered_factors_list, variables.ms_fam_ordered_factors_list, variables.hs_fam_ordered_factors_list, variables.es_sta_ordered_factors_list,
     variables.ms_sta_ordered_factors_list, variables.hs_sta_ordered_factors_list)
+    #the quartile and difference columns are added before the tables cut from all_factors so they get them too
+    for df in list(dfs.values()) + [all_factors]:
+        add_cell_columns(df, variables.level_dict.values(), variables.trend_dict.values())
     dfs['all_factors'] = all_factors
     dfs['all_factors_pct'] = all_factors.copy()
     common_factors = all_factors[all_factors['Survey Theme'].isin(variables.common_themes)]
@@ -481,6 +1133,8 @@ def create_empty_structures(variables, client_dir):
     variables.school_es_fam_ordered_factors_list, variables.school_ms_fam_ordered_factors_list, variables.school_hs_fam_ordered_factors_list, variables.school_es_sta_ordered_factors_list,
     variables.school_ms_sta_ordered_factors_list, variables.school_hs_sta_ordered_factors_list)
     school_dfs = create_empty_dfs(variables.school_dicts)
+    for df in list(school_dfs.values()) + [school_es_all_factors, school_ms_all_factors, school_hs_all_factors]:
+        add_cell_columns(df, variables.product_dict.values(), variables.school_trend_dict.values())
     school_dfs['school_es_all_factors'] = school_es_all_factors
     school_dfs['school_ms_all_factors'] = school_ms_all_factors
     school_dfs['school_hs_all_factors'] = school_hs_all_factors
@@ -522,6 +1176,33 @@ def create_empty_structures(variables, client_dir):
     school_bar_dicts['school_hs_cult_theme_bar'] = {k: v for k, v in bar_dicts['cult_theme_bar'].items() if k.endswith('_HS')}
     return dfs, bar_dicts, school_dfs, school_bar_dicts, factor_dict_by_product
 
+#cyan rows with trends, round dict and trend lookups for each product level fill_in_data has done this build, keyed on (client_dir, product_level, target).
+#Multilevel reports use the same rows as the district (or the same school's rows) so they come from here instead of being worked out again
+level_data_cache = {}
+
+def level_data(client_dir, product_level, nameStems, client):
+    #mean, percentile and percent positive rows with trends for a product level, its round dict and a dict to keep trend lookups made from them in.
+    #With one school at the product level the rows are that school's, otherwise the client's
+    key = (client_dir, product_level, nameStems[0] if len(nameStems) == 1 else client)
+    if key in level_data_cache:
+        return level_data_cache[key]
+    #MDK: if it's just one school at this product -level some things need to change, the rows are that school's rather than the client's
+    if len(nameStems) == 1:
+        district_mean = cube_rows(client_dir, product_level, 'mean', nameStems[0])
+        district_percentile = cube_rows(client_dir, product_level, 'percentile', nameStems[0])
+        district_percent_pos = cube_rows(client_dir, product_level, 'percent_pos', nameStems[0])
+    else:
+        district_mean = cube_rows(client_dir, product_level, 'mean', client)
+        district_percentile = cube_rows(client_dir, product_level, 'percentile', client)
+        district_percent_pos = cube_rows(client_dir, product_level, 'percent_pos', client, row_type = 'district')
+
+    #make round dict for this product level
+    round_meta = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'data', 'roundMeta')
+    rnd_dict = make_rnd_dict(district_mean, district_percentile, district_percent_pos, round_meta, product_level)
+    district_mean, district_percentile, district_percent_pos = add_trend_data_to_dfs(district_mean, district_percentile, district_percent_pos, rnd_dict)
+    level_data_cache[key] = (district_mean, district_percentile, district_percent_pos, rnd_dict, {})
+    return level_data_cache[key]
+
 def fill_in_data(dfs, bar_dicts, factor_dict_by_product, variables, client_dir, current_round, multilevel_nameStems = False, schools_nameStems_dict = False):
     #run through empty dfs, bar_dicts, and response rate tables and fill in data. This function also reads in csvs and generally does the bulk of the actual data work of creating a district report
 
@@ -536,79 +1217,51 @@ def fill_in_data(dfs, bar_dicts, factor_dict_by_product, variables, client_dir,
     #do this one product - level at a time
     product_levels = []
     if multilevel_nameStems:
+        #schools at the same product level share it, it's only filled in once
         for nameStem in multilevel_nameStems:
-            product_levels += schools_nameStems_dict[nameStem]
+            product_levels += [product_level for product_level in schools_nameStems_dict[nameStem] if product_level not in product_levels]
     else:
-        product_levels = [f.name for f in os.scandir(client_dir) if f.is_dir()]
-    for product_level in product_levels:
+        product_levels = list_product_levels(client_dir)
+    client = client_dir.strip('/').split('/')[-1]
+    #with --low_memory multilevel reports only use pinned rows, prefetching would read the released csvs again
+    level_paths = lambda product_level: level_csv_paths(client_dir, product_level, [client]) if product_level in variables.product_levels_list and not (low_memory and multilevel_nameStems) else []
+    for product_level in prefetched(product_levels, level_paths):
         if product_level in variables.product_levels_list:  
-            print('Found a directory for {product_level}. Running.'.format(product_level=product_level))
-            client=client_dir.strip('/').split('/')[-1]
-            nameStems_dict[product_level] = get_schools_list(client_dir, product_level, client, current_round, multilevel_nameStems)
-            if len(nameStems_dict[product_level]) == 1:
-                #MDK: if it's just one school at this product -level some things need to change. So below i'm reading in different csvs. 
-                #This seems messy but couldn't think of a better way
-                all_mean = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'agg', 'allmean')
-                district_mean = all_mean[(all_mean['genTarget'] == nameStems_dict[product_level][0])].reset_index(drop = True)
-
-                #get percentiles for both all factors and common factors tables
-                all_percentile = read_in_csv(client_dir, os.path.join(client_dir, product_level, nameStems_dict[product_level][0]), 'agg', 'pct')
-                district_percentile = all_percentile[(all_percentile['genTarget'] == nameStems_dict[product_level][0])].reset_index(drop = True)
-
-                #get percent positives for common factors table
-                all_percent_pos = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'agg', 'highprop')
-                district_percent_pos = pd.DataFrame()
-                for i, row in all_percent_pos.iterrows():
-                    if str(row['target']).split(":")[0] == nameStems_dict[product_level][0]:
-                        district_percent_pos = district_percent_pos.append(row)                
-            else:
-                #get means for all factors table
-                all_mean = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'agg', 'allmean')
-                district_mean = pd.DataFrame()
-                for i, row in all_mean.iterrows():
-                    if str(row['target']).split(":")[0] == client:
-                        district_mean = district_mean.append(row)
-
-                #get percentiles for both all factors and common factors tables
-                all_percentile = read_in_csv(client_dir, os.path.join(client_dir, product_level, client), 'agg', 'pct')
-                district_percentile = pd.DataFrame()
-                for i, row in all_percentile.iterrows():
-                    if str(row['target']).split(":")[0] == client:
-                        district_percentile = district_percentile.append(row)
-
-                #get percent positives for common factors table
-                all_percent_pos = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'agg', 'highprop')
-                district_percent_pos = pd.DataFrame()
-                for i, row in all_percent_pos.iterrows():
-                    if str(row['target']).split(":")[0] == client and row['type'] == 'district':
-                        district_percent_pos = district_percent_pos.append(row)
-
-            #make round dict for this product level and add to list
-            round_meta = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'data', 'roundMeta')
-            rnd_dict = make_rnd_dict(district_mean, district_percentile, district_percent_pos, round_meta, product_level)
-            rnd_dict_list.append(rnd_dict)
-            district_mean, district_percentile, district_percent_pos = add_trend_data_to_dfs(district_mean, district_percentile, district_percent_pos, rnd_dict)
+            with stage(product_level):
+                print('Found a directory for {product_level}. Running.'.format(product_level=product_level))
+                nameStems_dict[product_level] = get_schools_list(client_dir, product_level, client, current_round, multilevel_nameStems)
+                #rows and round dict for this product level (worked out once per build, see level_data) and add round dict to list
+                district_mean, district_percentile, district_percent_pos, rnd_dict, trend_lookups = level_data(client_dir, product_level, nameStems_dict[product_level], client)
+                rnd_dict_list.append(rnd_dict)
  
-            dfs['all_factors'] = fill_in_df(product_level, dfs['all_factors'], district_mean, district_percentile, district_percent_pos, variables.level_dict, variables.trend_dict, mean=True)
-            for df in dfs.values():
-                df = fill_in_df(product_level, df, district_mean, district_percentile, district_percent_pos, variables.level_dict, variables.trend_dict, mean = False)
-            #fill in dicts for bar charts with percents
-            for name, bar_dict in bar_dicts.items():
-                bar_dict = fill_in_bar_dict(bar_dict, product_level, district_percent_pos, rnd_dict)
-            #generate table with response counts and rates
-            all_count = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'agg', 'allcount')
-            school_meta = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'data', 'schoolMeta')
-
-            #create response rates dataframe and add it to response rates dictionary
-            rr_df, responses = gen_rr_table(product_level, all_count, school_meta, rnd_dict, client, nameStems_dict[product_level]) #Response rates
-            level = variables.level_dict[product_level.split('_')[1].lower()]
-            product = variables.product_dict[product_level.split('_')[0]]
-            rr_dict['{level} School {product} Responses'.format(level = level, product = product)] = rr_df
-
-            #set round dict to be the longest of the ones in the list
-            max_rnd_dict_len = max(map(len, rnd_dict_list))
-            max_rnd_dicts = dict(i for i in enumerate(rnd_dict_list) if len(i[-1]) == max_rnd_dict_len)
-            rnd_dict = next(iter(max_rnd_dicts.values()))
+                level_variables = frozenset(template_variables(dfs.values(), variables.level_dict[product_level.split('_')[1].lower()]))
+                if level_variables not in trend_lookups:
+                    trend_lookups[level_variables] = make_trend_lookup(district_mean, district_percentile, district_percent_pos, level_variables)
+                trend_lookup = trend_lookups[level_variables]
+                dfs['all_factors'] = fill_in_df(product_level, dfs['all_factors'], district_mean, district_percentile, district_percent_pos, variables.level_dict, variables.trend_dict, mean=True, trend_lookup = trend_lookup)
+                for df in dfs.values():
+                    df = fill_in_df(product_level, df, district_mean, district_percentile, district_percent_pos, variables.level_dict, variables.trend_dict, mean = False, trend_lookup = trend_lookup)
+                #fill in dicts for bar charts with percents
+                for name, bar_dict in bar_dicts.items():
+                    bar_dict = fill_in_bar_dict(bar_dict, product_level, district_percent_pos, rnd_dict)
+                #generate table with response counts and rates
+                all_count = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'agg', 'allcount')
+                school_meta = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'data', 'schoolMeta')
+
+                #create response rates dataframe and add it to response rates dictionary
+                rr_df, responses = gen_rr_table(product_level, all_count, school_meta, rnd_dict, client, nameStems_dict[product_level]) #Response rates
+                level = variables.level_dict[product_level.split('_')[1].lower()]
+                product = variables.product_dict[product_level.split('_')[0]]
+                rr_dict['{level} School {product} Responses'.format(level = level, product = product)] = rr_df
+
+                #set round dict to be the longest of the ones in the list
+                max_rnd_dict_len = max(map(len, rnd_dict_list))
+                max_rnd_dicts = dict(i for i in enumerate(rnd_dict_list) if len(i[-1]) == max_rnd_dict_len)
+                rnd_dict = next(iter(max_rnd_dicts.values()))
+                if low_memory and not multilevel_nameStems:
+                    #the district pass is the last to read this product level's cube, schools and multilevel reports use the pinned rows
+                    pin_school_rows(client_dir, product_level, nameStems_dict[product_level])
+                    release_product_level(client_dir, product_level)
         total_responses += responses
     return dfs, bar_dicts, rr_dict, rnd_dict, total_responses, nameStems_dict, school_meta
 
@@ -631,65 +1284,262 @@ def grab_school_name(school, school_meta):
     school_name = school_meta.loc[school_meta['genTarget'] == school, 'SchoolName'].values[0]
     return school_name
 
-def schools_fill_in_data(empty_school_dfs, empty_school_bar_dicts, factor_dict_by_product, variables, client_dir, schools_nameStems_dict, rnd_dict):
+def school_templates(empty_school_dfs, empty_school_bar_dicts, product_levels):
+    #the empty dfs and bar_dicts a school's report can use: dfs for the level of its first product level, which is the level create_school_report keeps,
+    #and bar_dicts for the levels of all its product levels (bars of other levels never get filled in and are deleted). They are the shared templates, not copies
+    level = product_levels[0].split('_')[1].lower()
+    levels = [product_level.split('_')[1].lower() for product_level in product_levels]
+    school_dfs = {df_name: df for df_name, df in empty_school_dfs.items() if df_name.split('_')[1] == level}
+    school_bar_dicts = {bar_name: bar_dict for bar_name, bar_dict in empty_school_bar_dicts.items() if bar_name.split('_')[1] in levels}
+    return school_dfs, school_bar_dicts
+
+def write_template(templates, name, written):
+    #a school's own copy of templates[name] to write to. The shared template is copied the first time and the copy is used after that
+    if name not in written:
+        templates[name] = copy.deepcopy(templates[name])
+        written.add(name)
+    return templates[name]
+
+def fill_in_school_data(school, product_levels, empty_school_dfs, empty_school_bar_dicts, variables, client_dir, schools_nameStems_dict):
+    #reads in CYAN csvs for one school and fills in its dfs and bar_dicts. Templates are only copied when there's data to write to them.
+    #Also returns the round dict of each of the school's product levels, schools_fill_in_data decides which round dict the school's bars use.
+    school_dfs, school_bar_dicts = school_templates(empty_school_dfs, empty_school_bar_dicts, product_levels)
+    written_dfs = set()
+    written_bar_dicts = set()
+    rnd_dict_list = []
+    print('Found data for {school}. Running.'.format(school=school))
+    for product_level in product_levels:
+        school_mean = cube_rows(client_dir, product_level, 'mean', school)
+        school_percentile = cube_rows(client_dir, product_level, 'percentile', school)
+        school_percent_pos = cube_rows(client_dir, product_level, 'percent_pos', school, row_type = 'school')
+
+        round_meta = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'data', 'roundMeta')
+        rnd_dict = make_rnd_dict(school_mean, school_percentile, school_percent_pos, round_meta, product_level)
+        rnd_dict_list.append(rnd_dict)
+        school_mean, school_percentile, school_percent_pos = add_trend_data_to_dfs(school_mean, school_percentile, school_percent_pos, rnd_dict)
+        product_column = variables.product_dict[product_level.split('_')[0]]
+        trend_lookup = make_trend_lookup(school_mean, school_percentile, school_percent_pos, template_variables(school_dfs.values(), product_column))
+        #all factors tables get means, the rest get percent positives
+        for df_name in list(school_dfs.keys()):
+            if template_variables([school_dfs[df_name]], product_column) & trend_lookup.keys():
+                df = write_template(school_dfs, df_name, written_dfs)
+                df = schools_fill_in_df(product_level, df, school_mean, school_percentile, school_percent_pos, variables.level_dict, variables.school_trend_dict, variables.product_dict, mean = df_name.endswith('_all_factors'), trend_lookup = trend_lookup)
+        for bar_name in list(school_bar_dicts.keys()):
+            if product_level in school_bar_dicts[bar_name].keys():
+                bar_dict = write_template(school_bar_dicts, bar_name, written_bar_dicts)
+                bar_dict = schools_fill_in_bar_dict(school, bar_dict, product_level, school_percent_pos, rnd_dict, schools_nameStems_dict, variables.product_dict)
+
+        school_meta = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'data', 'schoolMeta')
+        full_school_name = grab_school_name(school, school_meta)
+    #create_school_report fills in N/As in place, so dfs the school had no data for need their own copies too
+    for df_name in list(school_dfs.keys()):
+        write_template(school_dfs, df_name, written_dfs)
+    return school_dfs, school_bar_dicts, rnd_dict_list, full_school_name
+
+def fill_in_school_worker(school):
+    #fill_in_school_data for a pool process, everything but the school comes from worker_state
+    with stage('school/{school}'.format(school = school)):
+        return fill_in_school_data(school, worker_state['schools_nameStems_dict'][school], worker_state['empty_school_dfs'], worker_state['empty_school_bar_dicts'],
+        worker_state['variables'], worker_state['client_dir'], worker_state['schools_nameStems_dict'])
+
+def schools_fill_in_data(empty_school_dfs, empty_school_bar_dicts, factor_dict_by_product, variables, client_dir, schools_nameStems_dict, rnd_dict, workers = 1, vars_path = False, school_hashes = None):
     #fills in data for school reports. Reads in CYAN csvs and fills in previously empty dfs, bar_dicts, and response rate dfs. Generally does bulk of the data work nevessary for creating a school report
     #MDK improvement here would be to merge and generalize with fill_in_data function. A lot of repetitive code. 
-    rr_dict = {}
+    #Schools are filled in independently (on a pool if workers > 1). Bars are made afterwards in school order because each school's bars use the longest round dict of every school up to and including it.
+    #school_hashes has the input hash of each school for incremental builds. A school whose inputs and bar round dict match the previous build isn't filled in and has no dfs or bars here, its report comes from the previous output.
     school_dfs = {}
     school_bar_dicts = {}
     school_bars = {}
     schools_full_names_dict = {}
+    school_builds = {}
     rnd_dict_list = []
-    for school, product_levels in schools_nameStems_dict.items():
-        school_dfs[school] = copy.deepcopy(empty_school_dfs)
-        school_bar_dicts[school] = copy.deepcopy(empty_school_bar_dicts)
-        print('Found data for {school}. Running.'.format(school=school))
-        client=client_dir.strip('/').split('/')[-1]
-        for product_level in product_levels:
-            all_mean = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'agg', 'allmean')
-            school_mean = pd.DataFrame()
-            for i, row in all_mean.iterrows():
-                if str(row['target']).split(":")[0] == school:
-                    school_mean = school_mean.append(row)
-
-            all_percentile = read_in_csv(client_dir, os.path.join(client_dir, product_level, school), 'agg', 'pct')
-            school_percentile = pd.DataFrame()
-            for i, row in all_percentile.iterrows():
-                if str(row['target']).split(":")[0] == school:
-                    school_percentile = school_percentile.append(row)
-
-            all_percent_pos = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'agg', 'highprop')
-            school_percent_pos = pd.DataFrame()
-            for i, row in all_percent_pos.iterrows():
-                if str(row['target']).split(":")[0] == school and row['type'] == 'school':
-                    school_percent_pos = school_percent_pos.append(row)
-
-            round_meta = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'data', 'roundMeta')
-            rnd_dict = make_rnd_dict(school_mean, school_percentile, school_percent_pos, round_meta, product_level)
-            rnd_dict_list.append(rnd_dict)
-            school_mean, school_percentile, school_percent_pos = add_trend_data_to_dfs(school_mean, school_percentile, school_percent_pos, rnd_dict)
-            school_dfs[school]['school_es_all_factors'] = schools_fill_in_df(product_level, school_dfs[school]['school_es_all_factors'], school_mean, school_percentile, school_percent_pos, variables.level_dict, variables.school_trend_dict, variables.product_dict, mean=True)
-            school_dfs[school]['school_ms_all_factors'] = schools_fill_in_df(product_level, school_dfs[school]['school_ms_all_factors'], school_mean, school_percentile, school_percent_pos, variables.level_dict, variables.school_trend_dict, variables.product_dict, mean=True)
-            school_dfs[school]['school_hs_all_factors'] = schools_fill_in_df(product_level, school_dfs[school]['school_hs_all_factors'], school_mean, school_percentile, school_percent_pos, variables.level_dict, variables.school_trend_dict, variables.product_dict, mean=True)
-            for df_name, df in school_dfs[school].items():
-                df = schools_fill_in_df(product_level, df, school_mean, school_percentile, school_percent_pos, variables.level_dict, variables.school_trend_dict, variables.product_dict, mean = False)
-            for bar_dict in school_bar_dicts[school].values():
-                bar_dict = schools_fill_in_bar_dict(school, bar_dict, product_level, school_percent_pos, rnd_dict, schools_nameStems_dict, variables.product_dict)
-
-            school_meta = read_in_csv(client_dir, os.path.join(client_dir, product_level), 'data', 'schoolMeta')
-            schools_full_names_dict[school] = grab_school_name(school, school_meta)
+    schools = list(schools_nameStems_dict.keys())
+    school_hashes = school_hashes or {}
+    previous_schools = {school: previous_school(school, school_hash) for school, school_hash in school_hashes.items()}
+    to_fill = [school for school in schools if not previous_schools.get(school)]
+    pool = start_pool(workers, {'variables': variables, 'vars_path': vars_path, 'client_dir': client_dir, 'schools_nameStems_dict': schools_nameStems_dict,
+    'empty_school_dfs': empty_school_dfs, 'empty_school_bar_dicts': empty_school_bar_dicts})
+    #without a pool the next schools' pct csvs are read while one is filled in. With --low_memory the schools' rows are already pinned
+    school_paths = lambda school: [path for product_level in schools_nameStems_dict[school] for path in level_csv_paths(client_dir, product_level, [school])]
+    filled_schools = dict(zip(to_fill, map_reports(pool, fill_in_school_worker, to_fill if pool or low_memory else prefetched(to_fill, school_paths))))
+    #a school's bar round dict depends on the schools before it, so an unchanged school still has to be filled in if an earlier school gained or lost rounds
+    bar_rnd_dicts = {}
+    for school in schools:
+        school_rnd_dict_list = filled_schools[school][2] if school in filled_schools else previous_schools[school]['rnd_dict_list']
+        rnd_dict_list += school_rnd_dict_list
         #set round dict to be the longest of the ones in the list
         max_rnd_dict_len = max(map(len, rnd_dict_list))
         max_rnd_dicts = dict(i for i in enumerate(rnd_dict_list) if len(i[-1]) == max_rnd_dict_len)
-        rnd_dict = next(iter(max_rnd_dicts.values()))
+        bar_rnd_dicts[school] = next(iter(max_rnd_dicts.values()))
+    refill = [school for school in schools if school not in filled_schools and stamp(bar_rnd_dicts[school]) != previous_schools[school]['bar_rnd_dict']]
+    filled_schools.update(zip(refill, map_reports(pool, fill_in_school_worker, refill)))
+    stop_pool(pool)
+    for school in schools:
+        rnd_dict = bar_rnd_dicts[school]
+        if school not in filled_schools:
+            schools_full_names_dict[school] = previous_schools[school]['full_school_name']
+            school_builds[school] = previous_schools[school]
+            continue
+        filled_dfs, filled_bar_dicts, school_rnd_dict_list, full_school_name = filled_schools[school]
+        school_dfs[school] = filled_dfs
+        school_bar_dicts[school] = filled_bar_dicts
+        schools_full_names_dict[school] = full_school_name
+        school_builds[school] = {'hash': school_hashes.get(school), 'rnd_dict_list': school_rnd_dict_list, 'full_school_name': full_school_name, 'bar_rnd_dict': stamp(rnd_dict)}
         #delete empty bar_dicts
-        for bars in school_bar_dicts.values():
-            for name in list(bars.keys()):
-                if all(isinstance(value, str) for value in bars[name].values()):
-                    del bars[name]
-            #generate school bars and save them in dict
-            school_bars[school] = school_gen_bars(school_bar_dicts[school], rnd_dict, variables.level_dict)
-    return school_dfs, school_bars, schools_full_names_dict
+        bars = school_bar_dicts[school]
+        for name in list(bars.keys()):
+            if all(isinstance(value, str) for value in bars[name].values()):
+                del bars[name]
+        #generate school bars and save them in dict
+        school_bars[school] = school_gen_bars(school_bar_dicts[school], rnd_dict, variables.level_dict)
+    return school_dfs, school_bars, schools_full_names_dict, school_builds
+
+#inputs every school/multilevel report reads but never changes. In a pool they are set once per process by init_worker instead of being sent with each report.
+worker_state = {}
+
+def init_worker(state):
+    #set up worker_state in a pool process (or in this process when running without a pool). With fork the parent's csv cache comes along too,
+    #so schools don't re-read what the district report already parsed.
+    global use_sidecars, prefetch_depth, low_memory
+    worker_state.clear()
+    worker_state.update(state)
+    if 'variables' not in worker_state:
+        worker_state['variables'] = load_variables(state['vars_path'])
+    use_sidecars = state.get('use_sidecars', use_sidecars)
+    prefetch_depth = state.get('prefetch_depth', prefetch_depth)
+    low_memory = state.get('low_memory', low_memory)
+    cyan_schema['columns'] = state.get('cyan_columns', cyan_schema['columns'])
+    if state.get('profile') and not profiling['enabled']:
+        start_profiling()
+    if state.get('client_index') and state['client_index'] is not client_index:
+        client_index.clear()
+        client_index.update(state['client_index'])
+    #with --low_memory the cubes the pinned rows came from are gone, workers started with spawn would read their csvs again without them
+    if state.get('pinned_rows') and state['pinned_rows'] is not pinned_rows:
+        pinned_rows.clear()
+        pinned_rows.update(state['pinned_rows'])
+
+def start_pool(workers, state):
+    #start a pool of worker processes sharing state. With one worker there is no pool and state is set up in this process
+    state = dict(state, use_sidecars = use_sidecars, prefetch_depth = prefetch_depth, low_memory = low_memory, cyan_columns = cyan_schema['columns'], client_index = client_index,
+    pinned_rows = pinned_rows, profile = profiling['enabled'])
+    if workers > 1:
+        #modules can't be pickled, workers import the variables module themselves from vars_path
+        pool_state = {key: value for key, value in state.items() if key != 'variables'}
+        return multiprocessing.Pool(workers, initializer = init_worker, initargs = (pool_state,))
+    init_worker(state)
+    return None
+
+def map_reports(pool, func, items):
+    #run func over items, on the pool if there is one. Results come back in the order of items either way so the json matches a serial run
+    if pool is None:
+        return [func(item) for item in items]
+    if profiling['enabled']:
+        #stages timed in the pool processes are sent back and added under the current stage
+        results = pool.map(profiled_call, [(func, item) for item in items], chunksize = 1)
+        add_worker_stages([stages for result, stages in results])
+        return [result for result, stages in results]
+    return pool.map(func, items, chunksize = 1)
+
+def imap_reports(pool, func, items):
+    #map_reports that hands back each result as soon as it (and the ones before it) are done, so they can be written out and freed one at a time
+    if pool is None:
+        for item in items:
+            yield func(item)
+    elif profiling['enabled']:
+        for result, stages in pool.imap(profiled_call, ((func, item) for item in items), chunksize = 1):
+            add_worker_stages([stages])
+            yield result
+    else:
+        for result in pool.imap(func, items, chunksize = 1):
+            yield result
+
+def stop_pool(pool):
+    #wait for a pool's processes to finish
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+#--profile. Stages of the run are timed with stage(name) and written next to the output json by write_profile.
+#Stage names are paths, e.g. multilevel_reports/multilevel/Combined School/OSE_HS
+profiling = {'enabled': False, 'cprofile': False, 'start': 0, 'stack': [], 'stages': [], 'slowest': None}
+
+def start_profiling(cprofile = False):
+    #turn on stage timing. Memory is measured with tracemalloc, which slows everything down while it's on
+    profiling.update({'enabled': True, 'cprofile': cprofile, 'start': time.perf_counter(), 'stack': [], 'stages': [], 'slowest': None})
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+@contextlib.contextmanager
+def stage(name):
+    #time a named stage: wall time, cpu time of this process and the peak of memory allocated by python during the stage. Does nothing unless profiling is on.
+    #With --cprofile top level stages are also run under cProfile and the stats of the slowest one are kept
+    if not profiling['enabled']:
+        yield
+        return
+    stack = profiling['stack']
+    peak = tracemalloc.get_traced_memory()[1]
+    if stack:
+        stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+    record = {'stage': name if not stack else stack[-1]['record']['stage'] + '/' + name, 'depth': len(stack), 'pid': os.getpid(),
+    'start_seconds': round(time.perf_counter() - profiling['start'], 6)}
+    profiling['stages'].append(record)
+    stack.append({'record': record, 'peak': 0})
+    profiler = cProfile.Profile() if profiling['cprofile'] and len(stack) == 1 else None
+    tracemalloc.reset_peak()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        record['wall_seconds'] = round(time.perf_counter() - wall, 6)
+        record['cpu_seconds'] = round(time.process_time() - cpu, 6)
+        peak = max(stack.pop()['peak'], tracemalloc.get_traced_memory()[1])
+        record['peak_memory_mb'] = round(peak / 2 ** 20, 3)
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        if profiler and (profiling['slowest'] is None or record['wall_seconds'] > profiling['slowest'][0]['wall_seconds']):
+            profiling['slowest'] = (record, profiler)
+
+def profiled_call(task):
+    #run func(item) in a pool process and send back what it did along with the stages it timed
+    func, item = task
+    profiling.update({'stack': [], 'stages': [], 'start': time.perf_counter()})
+    result = func(item)
+    return result, profiling['stages']
+
+def add_worker_stages(stages_lists):
+    #add stages timed in pool processes under the current stage of this process
+    parent = profiling['stack'][-1]['record'] if profiling['stack'] else None
+    for stages in stages_lists:
+        for record in stages:
+            record = dict(record)
+            if parent:
+                record['stage'] = parent['stage'] + '/' + record['stage']
+                record['depth'] += parent['depth'] + 1
+                record['start_seconds'] = None
+            profiling['stages'].append(record)
+
+def write_profile(json_path):
+    #write the stage timings as json and csv next to the output json, and the cProfile stats of the slowest stage if there are any
+    stem = json_stem(json_path)
+    timings = pd.DataFrame(profiling['stages'], columns = ['stage', 'depth', 'pid', 'start_seconds', 'wall_seconds', 'cpu_seconds', 'peak_memory_mb'])
+    timings.to_csv(stem + '.profile.csv', index = False)
+    with open(stem + '.profile.json', 'w') as f:
+        json.dump({'json': json_path, 'stages': timings.to_dict(orient = 'records')}, f, indent = 1, default = str)
+    print('\nwrote stage timings to {stem}.profile.json and {stem}.profile.csv'.format(stem = stem))
+    top = timings[timings['depth'] == 0].sort_values('wall_seconds', ascending = False)
+    for index, row in top.iterrows():
+        print('  {stage}: {wall:.2f}s wall, {cpu:.2f}s cpu, {peak:.1f}MB peak'.format(stage = row['stage'], wall = row['wall_seconds'], cpu = row['cpu_seconds'], peak = row['peak_memory_mb']))
+    if profiling['slowest']:
+        record, profiler = profiling['slowest']
+        profiler.dump_stats(stem + '.profile.prof')
+        print('wrote cProfile stats for {stage} to {stem}.profile.prof'.format(stage = record['stage'], stem = stem))
 
 def add_up_responses(table):
     #function that adds up columns in response rate tables to help create the total table
@@ -749,52 +1599,38 @@ def gen_total_rr_df(rr_dict):
     total_rr_df['Response Rate'] = total_rr_df['Response Rate'].replace('nan%', np.nan)
     return total_rr_df
 
-def gen_school_rr_dict(rr_dict, nameStem):
-    #function that loops through all response rate tables and creates each school's table
-    ose_denom = 0
-    ose_count = 0
-    ose_rate = np.nan
-    fam_denom = 0 
-    fam_count = 0
-    fam_rate = np.nan
-    sta_denom = 0
-    sta_count = 0
-    sta_rate = np.nan
-
+def index_response_rates(rr_dict):
+    #{table name: {nameStem: (count, denominator)}} from the response rate tables, so each school's numbers are looked up instead of filtered out of every table.
+    #A nameStem in a table more than once gets its last row, like tail(1) on the filtered table
+    rr_index = OrderedDict()
     for name, table in rr_dict.items():
-        if 'Student' in name:
-            table = table[(table['nameStem'] == nameStem)]
-            if not table.empty:
-                ose_count += int(table['Number of Responses Received'].tail(1))
-                try:
-                    ose_denom += int(table["Survey Population"].tail(1))
-                    ose_rate = int(roundPercent(np.divide(ose_count, ose_denom)))
-                except ValueError:
-                    print("No response rate denom in School Meta for {nameStem}. Using N/A's.".format(nameStem = nameStem))
-                    ose_denom = 'N/A'
-                    ose_rate = 'N/A'
-        if 'Family' in name:
-            table = table[(table['nameStem'] == nameStem)]
-            if not table.empty:
-                fam_count += int(table['Number of Responses Received'].tail(1))
-                try:
-                    fam_denom += int(table["Survey Population"].tail(1))
-                    fam_rate = int(roundPercent(np.divide(fam_count, fam_denom)))
-                except ValueError:
-                    print("No response rate denom in School Meta for {nameStem}. Using N/A's.".format(nameStem = nameStem))
-                    fam_denom = 'N/A'
-                    fam_rate = 'N/A'
-        if 'Staff' in name:
-            table = table[(table['nameStem'] == nameStem)]
-            if not table.empty:
-                sta_count += int(table['Number of Responses Received'].tail(1))
+        if 'nameStem' in table.columns:
+            rr_index[name] = dict(zip(table['nameStem'].values, zip(table['Number of Responses Received'].values, table['Survey Population'].values)))
+    return rr_index
+
+def gen_school_rr_dict(rr_dict, nameStem, rr_index = None):
+    #creates each school's response rate table from the district's. Pass rr_index from index_response_rates when making more than one school's table
+    if rr_index is None:
+        rr_index = index_response_rates(rr_dict)
+    groups = ['Student', 'Family', 'Staff']
+    denoms = dict.fromkeys(groups, 0)
+    counts = dict.fromkeys(groups, 0)
+    rates = dict.fromkeys(groups, np.nan)
+    for name, rows in rr_index.items():
+        for group in groups:
+            if group in name and nameStem in rows:
+                count, denom = rows[nameStem]
+                counts[group] += int(count)
                 try:
-                    sta_denom += int(table["Survey Population"].tail(1))
-                    sta_rate = int(roundPercent(np.divide(sta_count, sta_denom)))
+                    denoms[group] += int(denom)
+                    rates[group] = int(roundPercent(np.divide(counts[group], denoms[group])))
                 except ValueError:
                     print("No response rate denom in School Meta for {nameStem}. Using N/A's.".format(nameStem = nameStem))
-                    sta_denom = 'N/A'
-                    sta_rate = 'N/A'
+                    denoms[group] = 'N/A'
+                    rates[group] = 'N/A'
+    ose_denom, fam_denom, sta_denom = [denoms[group] for group in groups]
+    ose_count, fam_count, sta_count = [counts[group] for group in groups]
+    ose_rate, fam_rate, sta_rate = [rates[group] for group in groups]
     total_responses = (ose_count + fam_count + sta_count)
     school_rr_dict = {'Group': ['Student', 'Family', 'Staff'], "Survey Population": [ose_denom, fam_denom, sta_denom], 
     "Number of Responses Received": [ose_count, fam_count, sta_count], 
@@ -811,60 +1647,132 @@ def gen_school_rr_dict(rr_dict, nameStem):
     return school_rr_df, total_responses
 
 def deal_with_nas_in_dfs(dfs, school = True):
-    #enforces different rules for na's depending on which column
+    #enforces different rules for na's depending on which column. Value cells without a quartile (variable names that were never filled in, blanks and
+    #percent positives without a percentile) become nan and trend cells that are null get the no trend arrow
     if school:
-        for df in dfs.values():
-            df[['Student', 'Family', 'Staff']] = df[['Student', 'Family', 'Staff']].applymap(lambda x: np.nan if isinstance(x, str) or np.all(pd.isnull(x)) else x)
-            df[['ose_trend', 'fam_trend', 'sta_trend']] = df[['ose_trend', 'fam_trend', 'sta_trend']].applymap(lambda x: [3, ''] if np.all(pd.isnull(x)) else x)
+        value_columns, trend_columns = ['Student', 'Family', 'Staff'], ['ose_trend', 'fam_trend', 'sta_trend']
     else:
-        for df in dfs.values():
-            df[['Elementary', 'Middle', 'High']] = df[['Elementary', 'Middle', 'High']].applymap(lambda x: np.nan if isinstance(x, str) or np.all(pd.isnull(x)) else x)
-            df[['es_trend', 'ms_trend', 'hs_trend']] = df[['es_trend', 'ms_trend', 'hs_trend']].applymap(lambda x: [3, ''] if np.all(pd.isnull(x)) else x)
+        value_columns, trend_columns = ['Elementary', 'Middle', 'High'], ['es_trend', 'ms_trend', 'hs_trend']
+    for df in dfs.values():
+        add_cell_columns(df, value_columns, trend_columns)
+        for value_column, trend_column in zip(value_columns, trend_columns):
+            df.loc[np.isnan(df[value_column + QUARTILE].to_numpy()), value_column] = np.nan
+            df.loc[df[trend_column].isnull().to_numpy(), trend_column] = 3
+            #every trend is filled in now, so the ones without a difference have no trend to show
+            df[trend_column + NO_TREND] = np.isnan(df[trend_column + DIFFERENCE].to_numpy())
     return dfs
 
-def gen_html(df, school = False):
-    #takes a dataframe and generates an HTML table
-
-    header = '<table class="reporttable">  <thead>    <tr style="color: rgb(102, 102, 102); background-color: rgb(255, 187, 128); font-weight: normal">'
-    rows = [header]
-    columns = []
-    for col in df.columns:
-        if 'trend' in col:
-            columns.append('<th col width="40">''</th>')
-        elif col in ['Elementary', 'Middle', 'High'] or ((col in ['Student', 'Family', 'Staff']) & (school == True)):
-            columns.append('<th style="text-align:right">{}</th>'.format(col))
-        else:
-            columns.append('<th col width="190">{}</th>'.format(col))
-    rows.append(' '.join(columns) + ' </tr>  </thead>  <tbody> ')
-    rowColour = 'odd'
-    for index in df.index:
-        row = '<tr class="{}">'.format(rowColour)
-        rVals = [df[c][index] for c in df.columns]
-        cols = []
-        for v in rVals:
-            #MDK this is messy and seems like poor practice to just be using types like this?
-            if isinstance(v, list):
-                if v[0] == '-1000%':
-                    cols.append('<td style="color: #808080;font-size:11px">N/A</td>')
-                elif isinstance(v[0], float) or isinstance(v[0], str):
-                    cols.append('<td style="text-align:left">{value}</td>'.format(value = format_number(v[0], v[1])))
-                elif isinstance(v[0], int):
-                    cols.append('<td style="color: #808080;font-size:11px">{arrow}&nbsp;{difference}</td>'.format(arrow = create_arrow(v[0]), difference = v[1]))
-            elif isinstance(v, str):
-                cols.append('<td>{}</td>'.format(stringHelpers.removeUTF(v)))
-            elif np.isnan(v):
-                cols.append('<td style="color: #808080;font-size:11px">N/A</td>')
-        row = row + ' '.join(cols)
-        row = row + ' </tr>'
-        if rowColour == 'odd':
-            rowColour = 'even'
+#rendered html by content. Headers are kept per table shape and cells per (type, value, quartile or difference) since most of them repeat across
+#the reports of a run. Whole tables are kept by a hash of their contents, for example the all N/A tables of schools missing a product
+html_headers = {}
+html_cells = {}
+html_tables = OrderedDict()
+HTML_TABLE_CACHE_SIZE = 512
+NA_CELL = '<td style="color: #808080;font-size:11px">N/A</td>'
+VALUE_CELL = '<td style="text-align:left">{value}</td>'
+TREND_CELL = '<td style="color: #808080;font-size:11px">{arrow}&nbsp;{difference}</td>'
+
+def clear_html_cache():
+    #empty the rendered html caches
+    html_headers.clear()
+    html_cells.clear()
+    html_tables.clear()
+
+def html_header(columns, school = False):
+    #the table header for a table with columns
+    key = (tuple(columns), school)
+    if key not in html_headers:
+        header = '<table class="reporttable">  <thead>    <tr style="color: rgb(102, 102, 102); background-color: rgb(255, 187, 128); font-weight: normal">'
+        cells = []
+        for col in columns:
+            if 'trend' in col:
+                cells.append('<th col width="40">''</th>')
+            elif col in ['Elementary', 'Middle', 'High'] or ((col in ['Student', 'Family', 'Staff']) & (school == True)):
+                cells.append('<th style="text-align:right">{}</th>'.format(col))
+            else:
+                cells.append('<th col width="190">{}</th>'.format(col))
+        html_headers[key] = header + ' ' + ' '.join(cells) + ' </tr>  </thead>  <tbody> '
+    return html_headers[key]
+
+def value_cell(value, quartile):
+    #the cell for a filled in value and its quartile
+    if pd.isnull(value):
+        return VALUE_CELL.format(value = format_number(value, quartile))
+    key = ('value', type(value), value, quartile)
+    if key not in html_cells:
+        if isinstance(value, str) and value == '-1000%':
+            html_cells[key] = NA_CELL
         else:
-            rowColour = 'odd'
-        rows.append(row)
+            html_cells[key] = VALUE_CELL.format(value = format_number(value, quartile))
+    return html_cells[key]
+
+def difference_text(difference, no_trend, percent):
+    #what a trend cell shows after its arrow: nothing if there's no trend, whole points for a percent positive and the rounded difference for a mean
+    if no_trend:
+        return ''
+    return int(difference) if percent else float(difference)
+
+def trend_cell(trend, difference):
+    #the cell for a trend arrow and the difference_text next to it
+    key = ('trend', trend, type(difference), difference)
+    if key not in html_cells:
+        html_cells[key] = TREND_CELL.format(arrow = create_arrow(trend), difference = difference)
+    return html_cells[key]
+
+def html_cell(v):
+    #one table cell for a value that isn't in a typed column (see add_cell_columns). Returns None for anything else, which gets no cell
+    #MDK this is messy and seems like poor practice to just be using types like this?
+    if isinstance(v, list):
+        if v[0] == '-1000%':
+            return NA_CELL
+        elif isinstance(v[0], float) or isinstance(v[0], str):
+            return VALUE_CELL.format(value = format_number(v[0], v[1]))
+        elif isinstance(v[0], int):
+            return TREND_CELL.format(arrow = create_arrow(v[0]), difference = v[1])
+    elif isinstance(v, str):
+        key = ('str', v)
+        if key not in html_cells:
+            html_cells[key] = '<td>{}</td>'.format(stringHelpers.removeUTF(v))
+        return html_cells[key]
+    elif np.isnan(v):
+        return NA_CELL
+
+def html_column(columns, col):
+    #the cells of one column. Value and trend columns read their typed columns, cells that weren't filled in are shown like any other value.
+    #A trend is for a percent positive when its value column holds a percent string rather than a mean
+    values = columns[col]
+    if col + QUARTILE in columns:
+        return [html_cell(value) if np.isnan(quartile) else value_cell(value, int(quartile)) for value, quartile in zip(values, columns[col + QUARTILE])]
+    if col + DIFFERENCE in columns:
+        percents = [isinstance(value, str) for value in columns[TREND_VALUE_COLUMNS[col]]] if col in TREND_VALUE_COLUMNS and TREND_VALUE_COLUMNS[col] in columns else [False] * len(values)
+        return [trend_cell(trend, difference_text(difference, no_trend, percent)) if no_trend or not np.isnan(difference) else html_cell(trend)
+        for trend, difference, no_trend, percent in zip(values, columns[col + DIFFERENCE], columns[col + NO_TREND], percents)]
+    return [html_cell(value) for value in values]
+
+def table_hash(columns, school = False):
+    #hash of everything gen_html's output depends on. Types are part of it since 4 and 4.0 are rendered differently
+    contents = [(col, [(type(v).__name__, v) for v in values]) for col, values in columns.items()]
+    return hashlib.sha1(repr((school, contents)).encode()).hexdigest()
+
+def gen_html(df, school = False):
+    #takes a dataframe and generates an HTML table. Tables that were already rendered come from html_tables
+    columns = OrderedDict(zip(df.columns, df.to_numpy(dtype = object).T)) if len(df.index) else OrderedDict((col, []) for col in df.columns)
+    key = table_hash(columns, school)
+    if key in html_tables:
+        html_tables.move_to_end(key)
+        return html_tables[key]
+    shown_columns = [col for col in columns if not is_cell_column(col)]
+    rows = [html_header(shown_columns, school)]
+    cells = [html_column(columns, col) for col in shown_columns]
+    row_colours = ['<tr class="odd">', '<tr class="even">']
+    for i in range(len(df.index)):
+        rows.append(row_colours[i % 2] + ' '.join(column[i] for column in cells if column[i] is not None) + ' </tr>')
     rows.append('</tbody></table>')
-    df = ' '.join(rows)
-        # tables[df_name] = df
-    return df
+    html = ' '.join(rows)
+    html_tables[key] = html
+    while len(html_tables) > HTML_TABLE_CACHE_SIZE:
+        html_tables.popitem(last = False)
+    return html
 
 def gen_rr_html(rr_dict):
     #generate html for each response rates df and add them to tables
@@ -940,104 +1848,615 @@ def gen_report(report_name, tables, bars, rnd_dict, total_responses, school = Fa
     report = dict(name = 'Batch Title', title = '{client} - Synthesis Report - {round}'.format(client = report_name, round = rnd_dict[0][1]), elements = elements)
     return report
             
-def write_json(json, client_dir, outDir = False, testing = False):
+def output_path(client_dir, outDir = False, testing = False, compress = False, shard = False):
+    #path of the synthesis report json for a client
     client_name = client_dir.split("/")[-2]
     if testing:
         test = '.TESTING'
     else:
         test = ''
     fileName = 'Synthesis Report_' + client_name + test +'.json'
+    if shard:
+        fileName = fileName[:-len('.json')] + '.shards.json'
+    elif compress:
+        fileName += '.gz'
     if not outDir:
         outDir = client_dir
-    fileName = os.path.join(outDir, fileName)
-    writeJSON(json,fileName)
+    return os.path.join(outDir, fileName)
+
+def write_json(json, client_dir, outDir = False, testing = False):
+    #write the output json. If its reports are a ReportStream they are already on disk and the stream just gets finished
+    if isinstance(json['reports'], (ReportStream, ShardStream)):
+        fileName = json['reports'].close()
+    else:
+        fileName = output_path(client_dir, outDir, testing)
+        writeJSON(json,fileName)
     print('\nsaved json as {}'.format(fileName))
 
-if __name__ == "__main__":
-    #argument and general set up
-    args = parser.parse_args()
-    client_dir = args.client_dir
-    outDir = args.outDir
-    testing = args.testing
-    current_round = args.current_round
-    multi_dict_path = args.multi_dict
-    district_report_only = args.district_report_only
+def json_stem(path):
+    #path of an output json without .json, for the files written next to it. A .json.gz keeps the .gz (Synthesis Report_X.gz) so a gzipped
+    #and a plain output in the same dir don't share a manifest, delta or profile
+    if path.endswith('.gz'):
+        return os.path.splitext(path[:-3])[0] + '.gz'
+    return os.path.splitext(path)[0]
+
+def text_size(text):
+    #size of text in utf-8 bytes. json.dumps escapes everything that isn't ascii so that's nearly always its length
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+def output_offsets(final_json, json_path):
+    #[start, length] of each report in the output json just written to json_path, so the next build can read one report back without the others.
+    #A ReportStream kept them as it wrote. Reports written by writeJSON are measured by serializing them again, and if the file isn't the size that gives
+    #there are none and the next build reads the whole json. Shards are read from their own files and need none
+    if isinstance(final_json['reports'], ReportStream):
+        return final_json['reports'].offsets
+    if isinstance(final_json['reports'], ShardStream):
+        return None
+    offsets = []
+    position = text_size('{"version": ' + json.dumps(final_json['version']) + ', "reports": [')
+    for report in final_json['reports']:
+        size = text_size(json.dumps(report))
+        offsets.append([position, size])
+        position += size + 2
+    end = position + len(']}') - (2 if offsets else 0)
+    if end != os.path.getsize(json_path):
+        return None
+    return offsets
+
+def open_json(path):
+    #open an output json for reading, gzipped or not
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+class ReportStream(object):
+    #stands in for the reports list of the output json with --stream. Each report is written to disk when it's appended and isn't kept, so memory doesn't grow
+    #with the number of schools. The document is the same one writeJSON writes for {'version': version, 'reports': [...]}. It goes to a temp file that
+    #replaces path when the stream is closed, so a failed run never leaves half a json behind
+    def __init__(self, path, version, compress = False):
+        self.path = path
+        self.temp_path = path + '.tmp'
+        self.raw = None
+        if compress:
+            #mtime 0 so the same reports always give the same file
+            self.raw = open(self.temp_path, 'wb')
+            self.file = io.TextIOWrapper(gzip.GzipFile(filename = os.path.basename(path)[:-3], mode = 'wb', fileobj = self.raw, mtime = 0), encoding = 'utf-8')
+        else:
+            self.file = open(self.temp_path, 'w')
+        self.count = 0
+        #[start, length] of each report in the document, in bytes before compression
+        self.offsets = []
+        self.position = 0
+        self.write('{"version": ' + json.dumps(version) + ', "reports": [')
+
+    def __len__(self):
+        return self.count
+
+    def append(self, report, key = None):
+        self.append_json(json.dumps(report))
+
+    def append_json(self, text):
+        #append a report that's already serialized
+        if self.count:
+            self.write(', ')
+        self.offsets.append([self.position, text_size(text)])
+        self.write(text)
+        self.count += 1
+
+    def write(self, text):
+        self.file.write(text)
+        self.position += text_size(text)
+
+    def close(self):
+        #finish the document and move it into place. Returns its path
+        self.write(']}')
+        self.file.close()
+        if self.raw is not None:
+            self.raw.close()
+        os.replace(self.temp_path, self.path)
+        return self.path
+
+    def abort(self):
+        #give up on the document when the build fails. The temp file is removed and whatever was at path is left as it was
+        for f in [self.file, self.raw]:
+            if f is not None:
+                with contextlib.suppress(OSError):
+                    f.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.temp_path)
+
+#--shard. Each report goes to its own file in a dir next to the output instead of one big json, so they can be uploaded and retried on their own.
+#The output path is then a small shard manifest listing the files in report order with their sizes and sha256s. merge_shards puts the classic json back together
+SHARD_FORMAT = 'synthesis-report-shards'
+SHARD_WRITERS = 4
+
+def shard_dir(manifest_path):
+    #dir the shards listed in a shard manifest are in
+    return json_stem(manifest_path)
+
+def shard_name(index, key):
+    #file name of the report at index in the output, e.g. 0003_school_sch004hs.json
+    return '{index:04d}_{key}.json'.format(index = index, key = re.sub(r'[^A-Za-z0-9_-]+', '_', key))
+
+def write_shard(path, text):
+    #write one shard and return its size and sha256
+    data = text.encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return len(data), hashlib.sha256(data).hexdigest()
+
+class ShardStream(object):
+    #stands in for the reports list of the output json with --shard. Reports are written to their own files on a few threads as they're appended.
+    #Shards go to a temp dir that replaces the shard dir when the stream is closed, then the shard manifest is written
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.dir = shard_dir(path)
+        self.temp_dir = self.dir + '.tmp'
+        shutil.rmtree(self.temp_dir, ignore_errors = True)
+        os.makedirs(self.temp_dir)
+        self.executor = concurrent.futures.ThreadPoolExecutor(SHARD_WRITERS)
+        self.shards = []
+
+    def __len__(self):
+        return len(self.shards)
+
+    def append(self, report, key = None):
+        name = shard_name(len(self.shards), key or str(len(self.shards)))
+        future = self.executor.submit(write_shard, os.path.join(self.temp_dir, name), json.dumps(report))
+        self.shards.append((name, key, future))
+
+    def close(self):
+        #wait for the shards, swap in the new shard dir and write the manifest. Returns the manifest's path
+        self.executor.shutdown()
+        shards = []
+        for name, key, future in self.shards:
+            size, sha256 = future.result()
+            shards.append({'file': name, 'key': key, 'size': size, 'sha256': sha256})
+        shutil.rmtree(self.dir, ignore_errors = True)
+        os.replace(self.temp_dir, self.dir)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'format': SHARD_FORMAT, 'version': self.version, 'shards': shards}, f, indent = 1)
+        os.replace(temp_path, self.path)
+        return self.path
+
+    def abort(self):
+        #give up on the shards when the build fails. Shards that haven't started aren't written, the rest are waited for and the temp dir is removed
+        for name, key, future in self.shards:
+            future.cancel()
+        self.executor.shutdown()
+        shutil.rmtree(self.temp_dir, ignore_errors = True)
+
+def read_shard_manifest(path):
+    #the shard manifest at path. Raises ValueError if it isn't one
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != SHARD_FORMAT:
+        raise ValueError('{path} is not a shard manifest.'.format(path = path))
+    return manifest
+
+def read_shard(path, shard):
+    #the serialized report of one shard listed in the shard manifest at path. Raises ValueError if its size or checksum doesn't match the manifest.
+    #The size is checked first so a truncated shard is reported as one without hashing it
+    with open(os.path.join(shard_dir(path), shard['file']), 'rb') as f:
+        data = f.read()
+    if len(data) != shard['size']:
+        raise ValueError('{file} is {size} bytes but {path} lists {expected}.'.format(file = shard['file'], size = len(data), path = path, expected = shard['size']))
+    if hashlib.sha256(data).hexdigest() != shard['sha256']:
+        raise ValueError('{file} does not match its checksum in {path}.'.format(file = shard['file'], path = path))
+    return data.decode('utf-8')
+
+def read_shards(path):
+    #the version and the serialized reports of a shard manifest, in order
+    manifest = read_shard_manifest(path)
+    return manifest['version'], [read_shard(path, shard) for shard in manifest['shards']]
+
+def read_output(path):
+    #an output json as a dict, whether it's a json, a .json.gz or a shard manifest
+    if path.endswith('.shards.json'):
+        version, texts = read_shards(path)
+        return {'version': version, 'reports': [json.loads(text) for text in texts]}
+    with open_json(path) as f:
+        return json.load(f)
+
+def read_output_report(json_path, index, offsets, handles):
+    #the report at index in an output json, without reading the others. offsets are output_offsets of the json (None to read it all), a shard
+    #manifest's reports come from their shard files. The open file, shard list or whole json are kept in handles for the next report
+    if json_path.endswith('.shards.json'):
+        if 'shards' not in handles:
+            handles['shards'] = read_shard_manifest(json_path)['shards']
+        return json.loads(read_shard(json_path, handles['shards'][index]))
+    if offsets is None:
+        if 'output' not in handles:
+            handles['output'] = read_output(json_path)
+        return handles['output']['reports'][index]
+    if 'file' not in handles:
+        handles['file'] = gzip.open(json_path, 'rb') if json_path.endswith('.gz') else open(json_path, 'rb')
+    start, length = offsets[index]
+    handles['file'].seek(start)
+    return json.loads(handles['file'].read(length))
+
+def close_output(handles):
+    #close what read_output_report kept open
+    if 'file' in handles:
+        handles['file'].close()
+    handles.clear()
+
+def merge_shards(path, json_path):
+    #write the reports of the shard manifest at path to one json at json_path (gzipped if it ends in .gz), the same json a run without --shard writes
+    version, texts = read_shards(path)
+    stream = ReportStream(json_path, version, json_path.endswith('.gz'))
+    for text in texts:
+        stream.append_json(text)
+    return stream.close()
+
+#incremental builds. A manifest next to the output json records a hash of each report's inputs (its cyan files, the variables module, this script and the run args)
+#and where the report is in the output. On the next run reports whose hash hasn't changed are copied from the previous output instead of being rebuilt.
+#Only the manifest is loaded, each reused report is read from the previous output on its own when it's copied
+MANIFEST_VERSION = 3
+previous_build = {}
+build_manifest = {}
+#read_output_report handles for the previous output, and whether it's still the one the previous manifest was written for
+previous_output = {}
+
+def manifest_path(json_path):
+    #the manifest sits next to the json it describes
+    return json_stem(json_path) + '.manifest.json'
+
+def file_sha256(path):
+    #sha256 of a file's contents
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def start_build(json_path, force = False):
+    #load the previous manifest. It's ignored with --force. The previous output isn't read here, see previous_output_matches and previous_report
+    close_output(previous_output)
+    previous_build.clear()
+    build_manifest.clear()
+    build_manifest.update({'version': MANIFEST_VERSION, 'files': {}, 'reports': {}, 'schools': {}})
+    if force:
+        return
+    try:
+        with open(manifest_path(json_path)) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return
+    if manifest.get('version') == MANIFEST_VERSION:
+        previous_build.update(manifest, json_path = json_path)
+
+def check_run_inputs(run_inputs):
+    #note the run inputs in the manifest. Every report hash includes them, so if they changed nothing can be reused and the previous build is dropped
+    #before anything is read from its output
+    build_manifest['run_inputs'] = inputs_hash(run_inputs)
+    if previous_build and previous_build.get('run_inputs') != build_manifest['run_inputs']:
+        print('\nThis script, the variables module or the run args changed since the last build. Rebuilding every report.')
+        previous_build.clear()
+
+def previous_output_matches():
+    #whether the previous output is still the json the previous manifest was written for. Checked when the first report would be reused, if it isn't
+    #the previous build is dropped
+    if 'matches' not in previous_output:
+        try:
+            previous_output['matches'] = file_sha256(previous_build['json_path']) == previous_build.get('output_sha256')
+        except FileNotFoundError:
+            previous_output['matches'] = False
+        if not previous_output['matches']:
+            print('\n{json_path} changed since its build manifest was written. Rebuilding every report.'.format(json_path = previous_build['json_path']))
+            previous_build.clear()
+    return previous_output['matches']
+
+def stamp(obj):
+    #stable text form of a value for hashing. Round dicts are {int: (rnd, SurveyPeriod)} and come back from json as {str: [rnd, SurveyPeriod]}, both give the same stamp
+    if isinstance(obj, dict):
+        obj = sorted((str(key), value) for key, value in obj.items())
+    return json.dumps(obj, sort_keys = True, default = str)
+
+def inputs_hash(*parts):
+    #hash of any number of stamped values
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(stamp(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def input_file_digests(product_levels, nameStems = None):
+    #(path, sha256) of the csvs a report reads: the product levels' agg and data csvs and the pct csvs of nameStems at them, or of every nameStem if it's None.
+    #Files whose size and mtime match the previous manifest aren't read again, and each file is only hashed once per build
+    previous_files = previous_build.get('files', {})
+    inputs = client_index['inputs']
+    if nameStems is None:
+        keys = [key for key in inputs if key[0] in product_levels]
+    else:
+        keys = [(product_level, nameStem) for product_level in product_levels for nameStem in [''] + list(nameStems)]
+    digests = []
+    for path in sorted(path for key in keys for path in inputs.get(key, [])):
+        relpath = '/'.join(os.path.relpath(path, client_index['root']).split(os.sep))
+        if relpath not in build_manifest['files']:
+            stat = os.stat(path)
+            known = previous_files.get(relpath)
+            if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+                build_manifest['files'][relpath] = known
+            else:
+                build_manifest['files'][relpath] = [stat.st_size, stat.st_mtime_ns, file_sha256(path)]
+        digests.append((relpath, build_manifest['files'][relpath][2]))
+    return digests
+
+def previous_entry(key, report_hash):
+    #the previous manifest's entry for key if its inputs hash was the same and the previous output is there to copy it from, otherwise None
+    entry = previous_build.get('reports', {}).get(key)
+    if not entry or entry['hash'] != report_hash or not previous_output_matches():
+        return None
+    return entry
+
+def previous_report(key, report_hash):
+    #the report built for key last time if its inputs hash was the same, otherwise None. Only that report is read from the previous output
+    entry = previous_entry(key, report_hash)
+    if entry is None:
+        return None
+    if entry['index'] is None:
+        return ''
+    return read_output_report(previous_build['json_path'], entry['index'], previous_build.get('offsets'), previous_output)
+
+def previous_school(school, school_hash):
+    #what the previous build recorded about a school's data if its inputs hash was the same, otherwise None. Round dicts get their int keys and tuples back
+    entry = previous_build.get('schools', {}).get(school)
+    if not entry or entry['hash'] != school_hash:
+        return None
+    #schools in a multilevel report have no school report of their own to reuse, they are filled in every run
+    report_entry = previous_entry('school:' + school, school_hash)
+    if report_entry is None or report_entry['index'] is None:
+        return None
+    entry = dict(entry, rnd_dict_list = [{int(key): tuple(value) for key, value in rnd_dict.items()} for rnd_dict in entry['rnd_dict_list']])
+    return entry
+
+def multilevel_hash(run_inputs, combined_school, school_list, schools_full_names_dict, schools_nameStems_dict):
+    #inputs hash of a multilevel report: its multi_dict entry, the schools that entry matches and every file under those schools' product levels
+    names = invert_dict(schools_full_names_dict)
+    nameStems = [names[school_name] for school_name in school_list if school_name in names]
+    product_levels = [product_level for nameStem in nameStems for product_level in schools_nameStems_dict[nameStem]]
+    return inputs_hash(run_inputs, combined_school, school_list, nameStems, input_file_digests(product_levels))
+
+def record_report(key, report_hash, report, reports, rebuilt, **extra):
+    #add report to the output reports (unless it's empty) and note it in the manifest
+    index = None
+    if report:
+        index = len(reports)
+        if isinstance(reports, list):
+            reports.append(report)
+        else:
+            reports.append(report, key)
+    build_manifest['reports'][key] = dict(extra, hash = report_hash, index = index, rebuilt = rebuilt)
+
+def finish_build(json_path):
+    #write the manifest for the json just written and print what was rebuilt
+    close_output(previous_output)
+    build_manifest['output_sha256'] = file_sha256(json_path)
+    rebuilt = [key for key, entry in build_manifest['reports'].items() if entry['rebuilt']]
+    reused = [key for key, entry in build_manifest['reports'].items() if not entry['rebuilt']]
+    temp_path = manifest_path(json_path) + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(build_manifest, f, default = str)
+    os.replace(temp_path, manifest_path(json_path))
+    print('\nRebuilt {rebuilt} reports and reused {reused} from the last build.'.format(rebuilt = len(rebuilt), reused = len(reused)))
+    if rebuilt and reused:
+        print('Rebuilt: {rebuilt}'.format(rebuilt = ', '.join(rebuilt)))
+
+#--delta. Reports are matched across builds by name and title (see report_keys). A report whose hash is the same as last time is unchanged and isn't looked at further,
+#only changed reports are hashed part by part (each table and bar) so the summary can say what changed
+def delta_path(json_path):
+    #the delta sits next to the json it was made for
+    return json_stem(json_path) + '.delta.json'
+
+def report_keys(reports):
+    #(name, title, n) of each report in a list of output reports, n counting the reports before it with the same name and title. Titles are made from
+    #school names, so two schools with the same name would otherwise be taken for one report
+    seen = {}
+    keys = []
+    for report in reports:
+        name_title = (report['name'], report['title'])
+        keys.append(name_title + (seen.get(name_title, 0),))
+        seen[name_title] = seen.get(name_title, 0) + 1
+    return keys
+
+def report_digests(reports):
+    #{key: (hash of the report, the report)} for a list of output reports, keyed by report_keys
+    return OrderedDict((key, (inputs_hash(report), report)) for key, report in zip(report_keys(reports), reports))
+
+def part_digests(report):
+    #{part: hash of the part} of one report
+    parts = {}
+    for element_name, element in report['elements'].items():
+        if element_name == 'tables':
+            parts.update((name, inputs_hash(value)) for name, value in element['substitutions'].items())
+        else:
+            parts[element_name] = inputs_hash(element)
+    return parts
+
+def previous_digests(path):
+    #report digests of a json from an earlier build. An empty dict if there's no json there, then every report counts as added
+    try:
+        return report_digests(read_output(path)['reports'])
+    except (FileNotFoundError, ValueError, KeyError):
+        print("\nCouldn't read a previous json at {path} so the delta has every report as added.".format(path = path))
+        return OrderedDict()
+
+def write_delta(json_path, previous, previous_path):
+    #write the added and changed reports of the json at json_path and the names and titles of reports that are no longer in it to a delta json,
+    #along with a summary of the changes. previous is report_digests of the json it's compared with. Returns the delta's path
+    delta = {'version': '2.0', 'previous': previous_path, 'summary': [], 'added': [], 'changed': [], 'removed': []}
+    lines = []
+    unchanged = 0
+    current = report_digests(read_output(json_path)['reports'])
+    duplicates = sorted(set(title for name, title, n in current if n))
+    if duplicates:
+        print('\nMore than one report is titled {titles}. Reports with the same title are matched with the last build in the order they are in.'.format(titles = ', '.join(duplicates)))
+    for key, (report_hash, report) in current.items():
+        if key not in previous:
+            delta['added'].append(report)
+            lines.append('added: {title}'.format(title = report['title']))
+        elif previous[key][0] != report_hash:
+            delta['changed'].append(report)
+            parts, previous_parts = part_digests(report), part_digests(previous[key][1])
+            changed_parts = sorted(part for part in set(parts) | set(previous_parts) if parts.get(part) != previous_parts.get(part))
+            lines.append('changed: {title} ({parts})'.format(title = report['title'], parts = ', '.join(changed_parts)))
+        else:
+            unchanged += 1
+    for name, title, n in previous:
+        if (name, title, n) not in current:
+            delta['removed'].append({'name': name, 'title': title})
+            lines.append('removed: {title}'.format(title = title))
+    delta['summary'] = ['{added} added, {changed} changed, {removed} removed and {unchanged} unchanged reports since {previous_path}'.format(added = len(delta['added']),
+    changed = len(delta['changed']), removed = len(delta['removed']), unchanged = unchanged, previous_path = previous_path)] + lines
+    writeJSON(delta, delta_path(json_path))
+    print('\n' + '\n'.join(delta['summary']))
+    print('saved delta as {path}'.format(path = delta_path(json_path)))
+    return delta_path(json_path)
+
+def build_synthesis_report(client_dir, current_round, outDir = False, testing = False, district_report_only = False, workers = 1, multi_dict_path = False, force = False, stream = False, compress = False, shard = False, delta = False):
+    #make the district, multilevel and school reports for one client and write them to one json. Returns the path of the json.
+    #With stream (or compress, which always streams) each report is written out when it's made instead of at the end. With shard each report gets its
+    #own file and the returned path is the shard manifest. With delta (True for the json being replaced, or the path of an earlier json) a delta json is
+    #written next to it too
+    if shard and compress:
+        sys.exit("--shard and --gzip can't be used together. Merge the shards into a .json.gz with synthesis_shards.py instead.")
+    with stage('build_client_index'):
+        build_client_index(client_dir)
+    level_data_cache.clear()
+    data_cube.clear()
+    pinned_rows.clear()
     district_name = client_dir.split("/")[-2]
     final_json = {}
     final_json['version'] = '2.0'
     final_json['reports'] = []
     vars_path =  os.path.abspath(os.path.join(client_dir, '..', '..', 'data/synthesis_report_vars.py'))
-    variables = varHelpers.importModule(vars_path, 'synthesis_report_vars')
-
-    #beginning of district report set up
-    empty_dfs, empty_bar_dicts, empty_school_dfs, empty_school_bar_dicts, factor_dict_by_product = create_empty_structures(variables, client_dir)
-    print('\nStarting with the district report.')
-    dfs, bar_dicts, rr_dict, rnd_dict, total_responses, nameStems_dict, school_meta = fill_in_data(empty_dfs, empty_bar_dicts, factor_dict_by_product, variables, client_dir, current_round)    
+    variables = load_variables(vars_path)
+
+    json_path = output_path(client_dir, outDir, testing, compress, shard)
+    start_build(json_path, force)
+    if delta:
+        #read before the json is written over
+        previous_path = json_path if delta is True else delta
+        previous = previous_digests(previous_path)
+    if shard:
+        final_json['reports'] = ShardStream(json_path, final_json['version'])
+    elif stream or compress:
+        final_json['reports'] = ReportStream(json_path, final_json['version'], compress)
+    try:
+        #beginning of district report set up
+        with stage('create_empty_structures'):
+            empty_dfs, empty_bar_dicts, empty_school_dfs, empty_school_bar_dicts, factor_dict_by_product = create_empty_structures(variables, client_dir)
+            set_cyan_schema(empty_dfs, empty_bar_dicts, empty_school_dfs, empty_school_bar_dicts)
+        run_inputs = [MANIFEST_VERSION, file_sha256(os.path.abspath(__file__)), file_sha256(vars_path), current_round, district_name, factor_dict_by_product]
+        check_run_inputs(run_inputs)
+        print('\nStarting with the district report.')
+        with stage('fill_in_data'):
+            #the district fills in copies so multilevel reports can start from the same empty structures
+            dfs, bar_dicts, rr_dict, rnd_dict, total_responses, nameStems_dict, school_meta = fill_in_data(copy.deepcopy(empty_dfs), copy.deepcopy(empty_bar_dicts), factor_dict_by_product, variables, client_dir, current_round)    
     
-    #this part checks if this is a one school district. If it is, this will just generate a school report and will skip the district report
-    school_report_only = True
-    for product_level, nameStem in nameStems_dict.items():
-        if len(nameStem) > 2:
-            school_report_only = False
-
-    if school_report_only:
-        print("\nOnly found 1 school for this client so skipping the district report.")
+        #this part checks if this is a one school district. If it is, this will just generate a school report and will skip the district report
+        school_report_only = True
+        for product_level, nameStem in nameStems_dict.items():
+            if len(nameStem) > 2:
+                school_report_only = False
+
+        if school_report_only:
+            print("\nOnly found 1 school for this client so skipping the district report.")
     
-    #actually fill in district report data
-    if not school_report_only:
-        rr_dict['Total'] = gen_total_rr_df(rr_dict)
-        dfs = deal_with_nas_in_dfs(dfs, school = False)
-        tables = {}
-        for df_name, df in dfs.items():
-            tables[df_name] = gen_html(df)
-        tables['response_rates'] = gen_rr_html(rr_dict)
-        bars = gen_bars(bar_dicts, rnd_dict, variables.level_dict)
-        district_report = gen_report(district_name, tables, bars, rnd_dict, total_responses, school = False)
-        final_json['reports'].append(district_report)
+        #actually fill in district report data
+        if not school_report_only:
+            rr_dict['Total'] = gen_total_rr_df(rr_dict)
+            district_hash = inputs_hash(run_inputs, input_file_digests(list(nameStems_dict.keys())))
+            district_report = previous_report('district', district_hash)
+            rebuilt = district_report is None
+            if rebuilt:
+                with stage('district_report'):
+                    dfs = deal_with_nas_in_dfs(dfs, school = False)
+                    tables = {}
+                    for df_name, df in dfs.items():
+                        tables[df_name] = gen_html(df)
+                    tables['response_rates'] = gen_rr_html(rr_dict)
+                    bars = gen_bars(bar_dicts, rnd_dict, variables.level_dict)
+                    district_report = gen_report(district_name, tables, bars, rnd_dict, total_responses, school = False)
+            record_report('district', district_hash, district_report, final_json['reports'], rebuilt)
     
-    #school report set up
-    if not district_report_only:
-        schools_nameStems_dict = invert_dict(nameStems_dict)
-        print('\nMoving on to school reports.')
-        school_dfs_dict, school_bars, schools_full_names_dict = schools_fill_in_data(empty_school_dfs, empty_school_bar_dicts, factor_dict_by_product, variables, client_dir, schools_nameStems_dict, rnd_dict)
-        school_rr_dict = {}
-        school_tables = {}
+        #school report set up
+        if not district_report_only:
+            schools_nameStems_dict = invert_dict(nameStems_dict)
+            print('\nMoving on to school reports.')
+            school_hashes = {school: inputs_hash(run_inputs, rnd_dict, product_levels, input_file_digests(product_levels, [school])) for school, product_levels in schools_nameStems_dict.items()}
+            with stage('schools_fill_in_data'):
+                school_dfs_dict, school_bars, schools_full_names_dict, school_builds = schools_fill_in_data(empty_school_dfs, empty_school_bar_dicts, factor_dict_by_product, variables, client_dir, schools_nameStems_dict, rnd_dict, workers, vars_path, school_hashes)
+            build_manifest['schools'] = school_builds
+
+            #create district-like reports for multi-level schools
+            if not multi_dict_path:
+                client_name = client_dir.split("/")[-2]
+                multi_dict_path = os.path.abspath(os.path.join(client_dir, "..", "..", "..", "..", "..", 'YouthTruth/Survey Administration/clients/{client_name}/multi_dict.json'.format(client_name = client_name)))
+            multi_dict = read_in_multi_dict(multi_dict_path)
+
+            #multilevel and school reports only read the district results so they can be made on a pool
+            pool = start_pool(workers, {'variables': variables, 'vars_path': vars_path, 'client_dir': client_dir, 'current_round': current_round,
+            'schools_nameStems_dict': schools_nameStems_dict, 'schools_full_names_dict': schools_full_names_dict, 'rr_dict': rr_dict, 'rr_index': index_response_rates(rr_dict), 'rnd_dict': rnd_dict,
+            'empty_dfs': empty_dfs, 'empty_bar_dicts': empty_bar_dicts, 'factor_dict_by_product': factor_dict_by_product})
+            multilevel_nameStems_list = []
+            if multi_dict:
+                multilevel_hashes = {combined_school: multilevel_hash(run_inputs, combined_school, school_list, schools_full_names_dict, schools_nameStems_dict) for combined_school, school_list in multi_dict.items()}
+                rebuilt_multilevel = [(combined_school, school_list) for combined_school, school_list in multi_dict.items() if previous_report('multilevel:' + combined_school, multilevel_hashes[combined_school]) is None]
+                with stage('multilevel_reports'):
+                    rebuilt_multilevel = dict(zip([combined_school for combined_school, school_list in rebuilt_multilevel], map_reports(pool, create_multilevel_worker, rebuilt_multilevel)))
+                for combined_school in multi_dict:
+                    if combined_school in rebuilt_multilevel:
+                        multilevel_school_report, nameStem_list = rebuilt_multilevel[combined_school]
+                    else:
+                        multilevel_school_report = previous_report('multilevel:' + combined_school, multilevel_hashes[combined_school])
+                        nameStem_list = previous_build['reports']['multilevel:' + combined_school]['nameStems']
+                    multilevel_nameStems_list += nameStem_list
+                    record_report('multilevel:' + combined_school, multilevel_hashes[combined_school], multilevel_school_report, final_json['reports'], combined_school in rebuilt_multilevel, nameStems = nameStem_list)
+
+            #finishes off school report data and appends reports to json. skips multilevel schools when making normal school reports. Unchanged schools have no dfs and reuse their last report.
+            #Reports are recorded as they come back and each school's dfs are let go once its report is handed out, so with --stream only a few schools are in memory at once
+            built_schools = [nameStem for nameStem in schools_nameStems_dict if nameStem in school_dfs_dict and nameStem not in multilevel_nameStems_list]
+            schools = ((nameStem, school_dfs_dict.pop(nameStem), school_bars.pop(nameStem)) for nameStem in built_schools)
+            with stage('school_reports'):
+                school_reports = imap_reports(pool, create_school_report, schools)
+                for nameStem in schools_nameStems_dict:
+                    if nameStem not in multilevel_nameStems_list:
+                        rebuilt = nameStem in built_schools
+                        school_report = next(school_reports) if rebuilt else previous_report('school:' + nameStem, school_hashes[nameStem])
+                        record_report('school:' + nameStem, school_hashes[nameStem], school_report, final_json['reports'], rebuilt)
+            stop_pool(pool)
+
+        with stage('write_json'):
+            #every reused report has been read, the previous output can be replaced
+            close_output(previous_output)
+            write_json(final_json, client_dir, outDir, testing)
+            build_manifest['offsets'] = output_offsets(final_json, json_path)
+    except BaseException:
+        #a failed build leaves no temp files behind and the last output as it was. Matters in batch and service runs, which go on to the next build
+        close_output(previous_output)
+        if isinstance(final_json['reports'], (ReportStream, ShardStream)):
+            final_json['reports'].abort()
+        raise
+    finish_build(json_path)
+    if delta:
+        write_delta(json_path, previous, previous_path)
+    print('\ncsv cache: {hits} hits, {misses} misses'.format(**csv_cache_stats))
+    return json_path
 
-        #create district-like reports for multi-level schools
-        if not multi_dict_path:
-            client_name = client_dir.split("/")[-2]
-            multi_dict_path = os.path.abspath(os.path.join(client_dir, "..", "..", "..", "..", "..", 'YouthTruth/Survey Administration/clients/{client_name}/multi_dict.json'.format(client_name = client_name)))
-        multi_dict = read_in_multi_dict(multi_dict_path)
-        
-        multilevel_nameStems_list = []
-        if multi_dict:
-            for combined_school, school_list in multi_dict.items():
-                multilevel_empty_dfs = empty_dfs.copy()
-                multilevel_dfs, multilevel_bar_dicts, empty_school_dfs, empty_school_bar_dicts, factor_dict_by_product = create_empty_structures(variables, client_dir)
-                multilevel_school_report, nameStem_list = create_multilevel_school_report(combined_school, school_list, variables, schools_full_names_dict, schools_nameStems_dict, client_dir, current_round, multilevel_dfs, multilevel_bar_dicts, factor_dict_by_product)
-                multilevel_nameStems_list += nameStem_list
-                if not multilevel_school_report:
-                    pass
-                else:
-                    final_json['reports'].append(multilevel_school_report)
-        
-        #finishes off school report data and appends reports to json
-        for nameStem, school_dfs in school_dfs_dict.items():
-            #skips multilevel schools when making normal school reports
-            if nameStem in multilevel_nameStems_list:
-                pass
-            else:
-                full_school_name = schools_full_names_dict[nameStem]
-                school_dfs = deal_with_nas_in_dfs(school_dfs, school = True)
-                level = schools_nameStems_dict[nameStem][0].split("_")[1]
-                school_dfs = drop_wrong_level_school_dfs(school_dfs, level)
-                school_tables[nameStem] = {}
-                for df_name, df in school_dfs.items():
-                    df_name = convert_school_object_names(df_name)
-                    school_tables[nameStem][df_name] = gen_html(df, school = True)
-                school_rr_dict, total_responses = gen_school_rr_dict(rr_dict, nameStem)
-                school_tables[nameStem]['response_rates'] = gen_html(school_rr_dict)
-                school_report = gen_report(full_school_name, school_tables[nameStem], school_bars[nameStem], rnd_dict, total_responses, school = True)
-                final_json['reports'].append(school_report)
-
-    write_json(final_json, client_dir, outDir, testing)
\ No newline at end of file
+if __name__ == "__main__":
+    #argument and general set up
+    args = parser.parse_args()
+    use_sidecars = not args.no_sidecar
+    prefetch_depth = args.prefetch
+    low_memory = args.low_memory
+    if args.purge_sidecars:
+        purge_sidecars(args.client_dir)
+    if args.profile:
+        start_profiling(args.cprofile)
+    json_path = build_synthesis_report(args.client_dir, args.current_round, args.outDir, args.testing, args.district_report_only, args.workers, args.multi_dict, args.force, args.stream, args.gzip, args.shard, args.delta)
+    if args.profile:
+        write_profile(json_path)
@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import threading
+import traceback
+import urllib.parse
+import urllib.request
+import urllib.error
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from argparse import ArgumentParser
+import synthesis_report
+
+'''
+Keeps synthesis_report.py running between builds for report QA, when the same client is rebuilt over and over. pandas, the synthesis_report_vars and
+coreVars modules and the parsed CYAN csvs stay loaded, so a rebuild only pays for what changed: the build manifest reuses every report whose inputs are
+the same and the csv cache skips files that haven't been rewritten. A watcher drops cached csvs and modules whose files change.
+
+python synthesis_service.py serve                                          runs the service on localhost
+python synthesis_service.py build -c <client_dir> -r <round> [-s <school>]  asks it for a build and prints the school's report if -s is passed
+python synthesis_service.py status                                         prints what the service has cached
+'''
+
+parser = ArgumentParser()
+parser.add_argument('command', choices = ['serve', 'build', 'status'], help = 'serve runs the service, build and status ask a running one.')
+parser.add_argument('--host', help = 'address the service listens on. Defaults to localhost only.', default = '127.0.0.1', required = False)
+parser.add_argument('-p', '--port', help = 'port the service listens on. Defaults to 8765.', type = int, default = 8765, required = False)
+parser.add_argument('--poll', help = 'seconds between checks for changed csvs and vars modules while serving. Defaults to 5, 0 only checks before each build.', type = float, default = 5, required = False)
+parser.add_argument('-c', '--client_dir', help = 'top level report production dir of the client to build.', required = False)
+parser.add_argument('-r', '--current_round', help = 'current round of the client.', required = False)
+parser.add_argument('-s', '--school', help = "nameStem of a school (or name of a multilevel school) whose report to print. 'district' prints the district report.", required = False)
+parser.add_argument('-o', '--outDir', metavar = 'outDir', help = "Use this if you want to write the json somewhere other than the client's directory.", required = False)
+parser.add_argument('-t', '--testing', help = 'names files with testing and writes over other testing files if in same outdir.', action = 'store_true', required = False)
+parser.add_argument('-d', '--district_report_only', help = 'only produce district-level reports', action = 'store_true', required = False)
+parser.add_argument('-w', '--workers', help = 'number of processes to fill in schools with. Defaults to 1 (no pool).', type = int, default = 1, required = False)
+parser.add_argument('-m', '--multi_dict', metavar = 'multi_dict', help = "path of the multi_dict if it isn't in the client's survey admin dir.", required = False)
+parser.add_argument('--force', help = 'rebuild every report even if its inputs are unchanged since the last build.', action = 'store_true', required = False)
+
+#one build at a time. Builds share synthesis_report's module level caches and the watcher takes the same lock before dropping anything from them
+build_lock = threading.Lock()
+#mtime of every vars and coreVars module in synthesis_report's caches when it was first seen, by path
+module_stamps = {}
+service_stats = {'started': time.time(), 'builds': 0, 'evicted_csvs': 0, 'reloaded_modules': 0, 'last_build': None}
+
+def file_mtime(path):
+    #mtime of a file, None if it's gone
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def drop_changed_modules():
+    #forget vars and coreVars modules whose file changed since they were imported so the next build imports them again. Returns how many were dropped
+    dropped = 0
+    for cache in [synthesis_report.variables_cache, synthesis_report.core_vars_cache]:
+        for path in list(cache):
+            if path in module_stamps and module_stamps[path] != file_mtime(path):
+                del cache[path]
+                del module_stamps[path]
+                dropped += 1
+    return dropped
+
+def stamp_modules():
+    #note the mtime of modules imported by the last build
+    for cache in [synthesis_report.variables_cache, synthesis_report.core_vars_cache]:
+        for path in cache:
+            module_stamps.setdefault(path, file_mtime(path))
+
+def invalidate():
+    #drop whatever changed on disk. Call with build_lock held
+    service_stats['evicted_csvs'] += synthesis_report.evict_changed_csvs()
+    service_stats['reloaded_modules'] += drop_changed_modules()
+
+def watch(poll):
+    #invalidate every poll seconds for as long as the service runs
+    while True:
+        time.sleep(poll)
+        with build_lock:
+            invalidate()
+
+def find_report(json_path, school):
+    #a report from the json just built: the district report, a school's by nameStem or a multilevel school's by name. None if it's not there.
+    #Only that report is read from the json
+    for key in [school, 'school:' + school, 'multilevel:' + school]:
+        entry = synthesis_report.build_manifest['reports'].get(key)
+        if entry and entry['index'] is not None:
+            handles = {}
+            try:
+                return synthesis_report.read_output_report(json_path, entry['index'], synthesis_report.build_manifest.get('offsets'), handles)
+            finally:
+                synthesis_report.close_output(handles)
+    return None
+
+def run_build(options):
+    #build a client the way synthesis_report.py does with the same options. Returns where the json went, how long it took, which reports were rebuilt and
+    #the report of options['school'] if it was passed
+    if not options.get('client_dir') or not options.get('current_round'):
+        raise ValueError('A build needs client_dir and current_round.')
+    client_dir = os.path.join(options['client_dir'], '')
+    with build_lock:
+        invalidate()
+        start = time.perf_counter()
+        json_path = synthesis_report.build_synthesis_report(client_dir, options['current_round'], options.get('outDir') or False, options.get('testing', False),
+        options.get('district_report_only', False), options.get('workers', 1), options.get('multi_dict') or False, options.get('force', False))
+        stamp_modules()
+        reports = synthesis_report.build_manifest['reports']
+        result = {
+        'json_path': json_path,
+        'seconds': round(time.perf_counter() - start, 3),
+        'rebuilt': [key for key, entry in reports.items() if entry['rebuilt']],
+        'reused': [key for key, entry in reports.items() if not entry['rebuilt']]}
+        if options.get('school'):
+            result['report'] = find_report(json_path, options['school'])
+            if result['report'] is None:
+                raise LookupError('No report for {school} in {json_path}.'.format(school = options['school'], json_path = json_path))
+        service_stats['builds'] += 1
+        service_stats['last_build'] = {'client_dir': client_dir, 'current_round': options['current_round'], 'seconds': result['seconds']}
+    return result
+
+def status():
+    #what the service has loaded
+    return dict(service_stats,
+    uptime = round(time.time() - service_stats['started'], 1),
+    csv_cache = dict(synthesis_report.csv_cache_stats, csvs = len(synthesis_report.csv_cache)),
+    modules = sorted(list(synthesis_report.variables_cache) + list(synthesis_report.core_vars_cache)))
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    #GET /status, POST /build with the build options as a json object
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path == '/status':
+            self.send_json(200, status())
+        else:
+            self.send_json(404, {'error': 'Unknown path {path}. Use GET /status or POST /build.'.format(path = self.path)})
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path != '/build':
+            self.send_json(404, {'error': 'Unknown path {path}. Use GET /status or POST /build.'.format(path = self.path)})
+            return
+        try:
+            options = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            result = run_build(options)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+        except LookupError as e:
+            self.send_json(404, {'error': str(e)})
+        except (Exception, SystemExit):
+            #a build that fails (or calls sys.exit on bad data) is reported to the caller and the service keeps running
+            self.send_json(500, {'error': traceback.format_exc()})
+        else:
+            self.send_json(200, result)
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, default = str).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(host, port, poll):
+    #run the service until it's interrupted
+    if poll > 0:
+        threading.Thread(target = watch, args = (poll,), daemon = True).start()
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    print('Synthesis service listening on http://{host}:{port}'.format(host = host, port = port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def request(host, port, path, options = None):
+    #call a running service and return its json answer. Errors the service sends back end the script with their message
+    url = 'http://{host}:{port}{path}'.format(host = host, port = port, path = path)
+    data = json.dumps(options).encode() if options is not None else None
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data = data, headers = {'Content-Type': 'application/json'})) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        sys.exit(json.load(e).get('error'))
+    except urllib.error.URLError as e:
+        sys.exit("Couldn't reach the synthesis service at {url} ({error}). Start it with: python synthesis_service.py serve".format(url = url, error = e.reason))
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args.host, args.port, args.poll)
+    elif args.command == 'status':
+        print(json.dumps(request(args.host, args.port, '/status'), indent = 1))
+    else:
+        result = request(args.host, args.port, '/build', {'client_dir': args.client_dir, 'current_round': args.current_round, 'school': args.school, 'outDir': args.outDir,
+        'testing': args.testing, 'district_report_only': args.district_report_only, 'workers': args.workers, 'multi_dict': args.multi_dict, 'force': args.force})
+        print('saved json as {json_path} in {seconds}s. Rebuilt {rebuilt} reports and reused {reused}.'.format(json_path = result['json_path'], seconds = result['seconds'], rebuilt = len(result['rebuilt']), reused = len(result['reused'])))
+        if 'report' in result:
+            print(json.dumps(result['report'], indent = 1))
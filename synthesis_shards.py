@@ -0,0 +1,28 @@
+import sys
+from argparse import ArgumentParser
+import synthesis_report
+
+'''
+Works with the sharded output synthesis_report.py writes with --shard: a "Synthesis Report_<client>.shards.json" manifest and a .shards dir with one json
+per report. merge puts the shards back together into the single json a run without --shard writes, verify checks every shard against its size and sha256.
+'''
+
+parser = ArgumentParser()
+parser.add_argument('command', choices = ['merge', 'verify'], help = 'merge the shards into one json, or only verify them.')
+parser.add_argument('manifest', help = 'the .shards.json manifest of the shards.')
+parser.add_argument('-o', '--output', help = 'json to write with merge (.json.gz to gzip it). Defaults to the manifest path with .json in place of .shards.json.', required = False)
+
+def default_output(manifest):
+    #where merge writes the json if -o isn't passed
+    return manifest[:-len('.shards.json')] + '.json'
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    try:
+        if args.command == 'verify':
+            version, texts = synthesis_report.read_shards(args.manifest)
+            print('{count} shards match {manifest}.'.format(count = len(texts), manifest = args.manifest))
+        else:
+            print('saved json as {}'.format(synthesis_report.merge_shards(args.manifest, args.output or default_output(args.manifest))))
+    except (ValueError, FileNotFoundError) as e:
+        sys.exit(str(e))
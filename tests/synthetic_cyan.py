@@ -0,0 +1,146 @@
+import os
+import json
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+
+'''
+Fabricates YouthTruth report production directories with CYAN output in them so synthesis_report.py can be run and timed without client data.
+The layout is the one synthesis_report.py reads: <root>/data/synthesis_report_vars.py, <root>/data/<PRODUCT_LEVEL>/coreVars.py and
+<root>/clients/<client>/<product_level>/{agg,data,<nameStem>/agg}, plus <root>/multi_dict.json. Values are random but seeded.
+'''
+
+PRODUCTS = ['OSE', 'FAM', 'STA']
+LEVELS = ['ES', 'MS', 'HS']
+LEVEL_NAMES = {'ES': 'Elementary', 'MS': 'Middle', 'HS': 'High'}
+
+#factor variables in the order the all factors tables list them
+FACTORS = {
+'OSE': [('eng', 'Engagement'), ('rig', 'Academic Rigor'), ('rel', 'Relationships'), ('cult', 'Culture'), ('bel', 'Belonging & Peer Collaboration'),
+('inst', 'Instructional Methods'), ('ccr', 'College & Career Readiness')],
+'FAM': [('eng', 'Engagement'), ('rel', 'Relationships'), ('cult', 'Culture'), ('comm', 'Communication & Feedback'), ('res', 'Resources'), ('safe', 'School Safety')],
+'STA': [('eng', 'Engagement'), ('rel', 'Relationships'), ('cult', 'Culture'), ('pd', 'Professional Development & Support')]}
+ITEMS = ['edqual', 'respect_stu', 'respect_sta', 'discipline', 'expectations', 'differentcult']
+SCHOOL_THEMES = ['eng', 'rel', 'cult', 'rig', 'bel', 'inst', 'ccr', 'comm', 'res', 'safe', 'pd']
+
+def factor_vars(product, level):
+    #factor variable names for a product level. Elementary students don't get college & career readiness
+    factors = [name for name, display in FACTORS[product]]
+    if product == 'OSE' and level == 'ES':
+        factors.remove('ccr')
+    return ['{}_{}'.format(product.lower(), name) for name in factors]
+
+def item_vars(product):
+    #item variable names for a product
+    return ['{}_{}'.format(item, product.lower()) for item in ITEMS]
+
+def write_vars_module(data_dir):
+    #write a synthesis_report_vars.py shaped like the real one
+    lines = ['level_dict = {"es": "Elementary", "ms": "Middle", "hs": "High"}',
+    'trend_dict = {"es": "es_trend", "ms": "ms_trend", "hs": "hs_trend"}',
+    'product_dict = {"OSE": "Student", "FAM": "Family", "STA": "Staff"}',
+    'school_trend_dict = {"OSE": "ose_trend", "FAM": "fam_trend", "STA": "sta_trend"}',
+    'product_levels_list = {}'.format(['{}_{}'.format(p, l) for p in PRODUCTS for l in LEVELS]),
+    'common_themes = ["Engagement", "Relationships", "Culture"]']
+    dicts = {}
+    for item in ITEMS:
+        table = {'Group': ['Student', 'Family', 'Staff']}
+        for level in LEVELS:
+            table[LEVEL_NAMES[level]] = item_vars('OSE')[ITEMS.index(item):ITEMS.index(item) + 1] + item_vars('FAM')[ITEMS.index(item):ITEMS.index(item) + 1] + item_vars('STA')[ITEMS.index(item):ITEMS.index(item) + 1]
+            table['{}_trend'.format(level.lower())] = [None, None, None]
+        dicts[item] = table
+    lines.append('dicts = {}'.format(repr(dicts)))
+    school_dicts = {}
+    for level in LEVELS:
+        for item in ITEMS:
+            school_dicts['school_{}_{}'.format(level.lower(), item)] = {'Item': [item],
+            'Student': ['{}_ose'.format(item)], 'ose_trend': [None], 'Family': ['{}_fam'.format(item)], 'fam_trend': [None], 'Staff': ['{}_sta'.format(item)], 'sta_trend': [None]}
+    lines.append('school_dicts = {}'.format(repr(school_dicts)))
+    bar_dicts = {}
+    for theme in ['eng', 'rel', 'cult']:
+        bar_dicts['{}_theme_bar'.format(theme)] = {'{}_{}'.format(p, l): '{}_{}'.format(p.lower(), theme) for p in PRODUCTS for l in LEVELS}
+    lines.append('bar_dicts = {}'.format(repr(bar_dicts)))
+    for product in PRODUCTS:
+        for level in LEVELS:
+            factors = factor_vars(product, level)
+            lines.append('{}_{}_ordered_factors_list = {}'.format(level.lower(), product.lower(), repr(factors)))
+            school_factors = ['{}_{}'.format(product.lower(), theme) if '{}_{}'.format(product.lower(), theme) in factors else '' for theme in SCHOOL_THEMES]
+            while school_factors and not school_factors[-1]:
+                school_factors.pop()
+            lines.append('school_{}_{}_ordered_factors_list = {}'.format(level.lower(), product.lower(), repr(school_factors)))
+    with open(os.path.join(data_dir, 'synthesis_report_vars.py'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def write_core_vars(data_dir, product, level):
+    #write the coreVars.py grab_factor_names reads for a product level
+    os.makedirs(os.path.join(data_dir, '{}_{}'.format(product, level)), exist_ok = True)
+    factors = [('{}_{}'.format(product.lower(), name), display) for name, display in FACTORS[product]]
+    with open(os.path.join(data_dir, '{}_{}'.format(product, level), 'coreVars.py'), 'w') as f:
+        f.write('factors = {}\n'.format(repr({'execsum': factors})))
+
+def make_client_dir(root, n_schools = 10, product_levels = ('OSE_ES', 'OSE_MS', 'OSE_HS', 'FAM_ES', 'STA_ES'), n_rounds = 3, client = 'Synthetic Unified School District', seed = 0):
+    #builds root/data and root/clients/<client>/ and returns the client dir (with a trailing slash like the script expects) and a multi_dict path.
+    #Schools are spread over the levels in product_levels, every fourth school only has the current round. The current round is 19O
+    rng = np.random.RandomState(seed)
+    data_dir = os.path.join(root, 'data')
+    os.makedirs(data_dir, exist_ok = True)
+    write_vars_module(data_dir)
+    client_dir = os.path.join(root, 'clients', client) + '/'
+    rounds = ['{}O'.format(19 - i) for i in range(n_rounds)]
+    round_meta = pd.DataFrame({'rnd': rounds, 'RoundID': [100 - 5 * i for i in range(n_rounds)], 'SurveyPeriod': ['October 20{}'.format(19 - i) for i in range(n_rounds)]})
+    levels_used = sorted(set(pl.split('_')[1] for pl in product_levels))
+    schools = {}
+    for i in range(n_schools):
+        level = levels_used[i % len(levels_used)]
+        schools['sch{:03d}{}'.format(i, level.lower())] = (level, 'School {} {}'.format(i, LEVEL_NAMES[level]))
+    for product_level in product_levels:
+        product, level = product_level.split('_')
+        write_core_vars(data_dir, product, level)
+        pl_dir = os.path.join(client_dir, product_level)
+        os.makedirs(os.path.join(pl_dir, 'agg'), exist_ok = True)
+        os.makedirs(os.path.join(pl_dir, 'data'), exist_ok = True)
+        variables = factor_vars(product, level) + item_vars(product)
+        level_schools = [school for school, (school_level, name) in schools.items() if school_level == level]
+        mean_rows, prop_rows, pct_rows, count_rows, meta_rows = [], [], [], [], []
+        for name_stem, row_type in [(client, 'district')] + [(school, 'school') for school in level_schools]:
+            #a few schools are new and only have the current round
+            school_rounds = rounds if row_type == 'district' or int(name_stem[3:6]) % 4 else rounds[:1]
+            for rnd in school_rounds:
+                target = '{}:{}'.format(name_stem, rnd)
+                base = {'target': target, 'genTarget': name_stem}
+                mean_rows.append(dict(base, **{v: round(rng.uniform(2.5, 4.5), 4) for v in variables}))
+                prop_rows.append(dict(base, type = row_type, **{v: round(rng.uniform(0.2, 0.95), 4) for v in variables}))
+                pct_rows.append(dict(base, **{v: round(rng.uniform(0, 100), 3) for v in variables}))
+                if row_type == 'school':
+                    count_rows.append({'target': target, 'genTarget': name_stem, 'total': int(rng.randint(20, 400))})
+            if row_type == 'school':
+                meta_rows.append({'ClientName': client, 'round': rounds[0], 'genTarget': name_stem, 'SchoolName': schools[name_stem][1], 'current': 1, 'respTarget': int(rng.randint(400, 900))})
+                meta_rows.append({'ClientName': client, 'round': rounds[-1], 'genTarget': name_stem, 'SchoolName': schools[name_stem][1], 'current': 0, 'respTarget': int(rng.randint(400, 900))})
+        pd.DataFrame(mean_rows).to_csv(os.path.join(pl_dir, 'agg', 'allmean.csv'), index = False)
+        pd.DataFrame(prop_rows).to_csv(os.path.join(pl_dir, 'agg', 'highprop.csv'), index = False)
+        pd.DataFrame(count_rows).to_csv(os.path.join(pl_dir, 'agg', 'allcount.csv'), index = False)
+        pd.DataFrame(meta_rows).to_csv(os.path.join(pl_dir, 'data', 'schoolMeta.csv'), index = False)
+        round_meta.to_csv(os.path.join(pl_dir, 'data', 'roundMeta.csv'), index = False)
+        pct = pd.DataFrame(pct_rows)
+        for name_stem in [client] + level_schools:
+            os.makedirs(os.path.join(pl_dir, name_stem, 'agg'), exist_ok = True)
+            pct[pct['genTarget'] == name_stem].to_csv(os.path.join(pl_dir, name_stem, 'agg', 'pct.csv'), index = False)
+    #first two schools of different levels make up a multilevel school
+    combined = []
+    for level in levels_used[:2]:
+        combined.append(next(name for school, (school_level, name) in schools.items() if school_level == level))
+    multi_dict_path = os.path.join(root, 'multi_dict.json')
+    with open(multi_dict_path, 'w') as f:
+        json.dump({'Combined School': combined} if len(combined) > 1 else {}, f)
+    return client_dir, multi_dict_path
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('-o', '--root', help = 'dir to build the fake production dir in', required = True)
+    parser.add_argument('-n', '--schools', help = 'number of schools', type = int, default = 10)
+    parser.add_argument('-p', '--product_levels', help = 'comma separated product levels', default = 'OSE_ES,OSE_MS,OSE_HS,FAM_ES,STA_ES')
+    parser.add_argument('-r', '--rounds', help = 'number of rounds of data', type = int, default = 3)
+    parser.add_argument('-s', '--seed', type = int, default = 0)
+    args = parser.parse_args()
+    client_dir, multi_dict_path = make_client_dir(args.root, args.schools, args.product_levels.split(','), args.rounds, seed = args.seed)
+    print('made {client_dir}\nrun synthesis_report.py -c "{client_dir}" -r 19O -m "{multi_dict_path}"'.format(client_dir = client_dir, multi_dict_path = multi_dict_path))
@@ -0,0 +1,119 @@
+import io
+import os
+import copy
+import json
+import time
+import pytest
+import numpy as np
+import pandas as pd
+import synthesis_report
+import synthetic_cyan
+
+'''
+Benchmarks for synthesis_report.py on synthetic client dirs of a few sizes. They only run with SYNTHESIS_BENCHMARK=1 since they take minutes.
+Times are divided by the time of a fixed calibration workload so the baseline in benchmark_baseline.json carries across machines. A benchmark fails
+if it's more than SYNTHESIS_BENCHMARK_THRESHOLD (default 1.5) times its baseline. Run with SYNTHESIS_BENCHMARK_UPDATE=1 to rewrite the baseline
+after a change that's meant to make things slower, or to add new benchmarks to it.
+'''
+
+pytestmark = pytest.mark.skipif(not os.environ.get('SYNTHESIS_BENCHMARK'), reason = 'set SYNTHESIS_BENCHMARK=1 to run the benchmarks')
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+THRESHOLD = float(os.environ.get('SYNTHESIS_BENCHMARK_THRESHOLD', 1.5))
+UPDATE = bool(os.environ.get('SYNTHESIS_BENCHMARK_UPDATE'))
+
+SIZES = {
+'small': dict(n_schools = 10, product_levels = ('OSE_ES', 'OSE_MS', 'OSE_HS', 'FAM_ES', 'STA_ES'), n_rounds = 3),
+'medium': dict(n_schools = 40, product_levels = ('OSE_ES', 'OSE_MS', 'OSE_HS', 'FAM_ES', 'FAM_MS', 'STA_ES', 'STA_MS'), n_rounds = 4),
+'large': dict(n_schools = 120, product_levels = tuple('{}_{}'.format(p, l) for p in ['OSE', 'FAM', 'STA'] for l in ['ES', 'MS', 'HS']), n_rounds = 5)}
+
+def best_time(func, repeat = 3, min_seconds = 1):
+	#fastest run of func in seconds. Runs it at least repeat times and until min_seconds have gone by so quick functions aren't timed on one noisy run
+	times = []
+	while len(times) < repeat or sum(times) < min_seconds:
+		start = time.perf_counter()
+		func()
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+@pytest.fixture(scope = 'module')
+def calibration():
+	frame = pd.DataFrame(np.random.RandomState(0).uniform(size = (2000, 20)))
+	text = frame.to_csv()
+	def work():
+		pd.read_csv(io.StringIO(text)).groupby(lambda i: i % 7).mean()
+		sum(i * i for i in range(200000))
+	return best_time(work, 5, 2)
+
+@pytest.fixture(scope = 'module')
+def baseline():
+	try:
+		with open(BASELINE_PATH) as f:
+			results = json.load(f)
+	except FileNotFoundError:
+		results = {}
+	yield results
+	if UPDATE:
+		with open(BASELINE_PATH, 'w') as f:
+			json.dump(results, f, indent = 1, sort_keys = True)
+
+@pytest.fixture(scope = 'module', params = list(SIZES))
+def client(request, tmp_path_factory):
+	root = tmp_path_factory.mktemp(request.param)
+	client_dir, multi_dict_path = synthetic_cyan.make_client_dir(str(root), **SIZES[request.param])
+	synthesis_report.use_sidecars = False
+	synthesis_report.clear_csv_cache()
+	synthesis_report.build_client_index(client_dir)
+	vars_path = os.path.abspath(os.path.join(client_dir, '..', '..', 'data/synthesis_report_vars.py'))
+	return request.param, client_dir, multi_dict_path, synthesis_report.load_variables(vars_path), str(root)
+
+def check(name, seconds, calibration, baseline):
+	#compare a benchmark time to its baseline, or record it if there isn't one yet
+	relative = seconds / calibration
+	print('\n{name}: {seconds:.3f}s ({relative:.1f} x calibration)'.format(name = name, seconds = seconds, relative = relative))
+	if UPDATE or name not in baseline:
+		baseline[name] = round(relative, 3)
+		return
+	assert relative <= baseline[name] * THRESHOLD, '{name} took {relative:.1f} x calibration, baseline is {baseline:.1f}'.format(name = name, relative = relative, baseline = baseline[name])
+
+def test_pipeline(client, calibration, baseline):
+	size, client_dir, multi_dict_path, variables, root = client
+	def run():
+		synthesis_report.clear_csv_cache()
+		synthesis_report.build_synthesis_report(client_dir, '19O', root, multi_dict_path = multi_dict_path, force = True)
+	check('{}/pipeline'.format(size), best_time(run, 2, 0), calibration, baseline)
+
+def test_read_in_csv(client, calibration, baseline):
+	size, client_dir, multi_dict_path, variables, root = client
+	def run():
+		synthesis_report.clear_csv_cache()
+		for product_level in synthesis_report.list_product_levels(client_dir):
+			synthesis_report.read_in_csv(client_dir, os.path.join(client_dir, product_level), 'agg', 'allmean')
+			synthesis_report.read_in_csv(client_dir, os.path.join(client_dir, product_level), 'agg', 'highprop')
+	check('{}/read_in_csv'.format(size), best_time(run), calibration, baseline)
+
+def test_fill_in_data(client, calibration, baseline):
+	size, client_dir, multi_dict_path, variables, root = client
+	empty_dfs, empty_bar_dicts, empty_school_dfs, empty_school_bar_dicts, factor_dict_by_product = synthesis_report.create_empty_structures(variables, client_dir)
+	def run():
+		synthesis_report.fill_in_data(copy.deepcopy(empty_dfs), copy.deepcopy(empty_bar_dicts), factor_dict_by_product, variables, client_dir, '19O')
+	check('{}/fill_in_data'.format(size), best_time(run), calibration, baseline)
+
+def test_schools_fill_in_data(client, calibration, baseline):
+	size, client_dir, multi_dict_path, variables, root = client
+	empty_dfs, empty_bar_dicts, empty_school_dfs, empty_school_bar_dicts, factor_dict_by_product = synthesis_report.create_empty_structures(variables, client_dir)
+	dfs, bar_dicts, rr_dict, rnd_dict, total_responses, nameStems_dict, school_meta = synthesis_report.fill_in_data(empty_dfs, empty_bar_dicts, factor_dict_by_product, variables, client_dir, '19O')
+	schools_nameStems_dict = synthesis_report.invert_dict(nameStems_dict)
+	def run():
+		synthesis_report.schools_fill_in_data(empty_school_dfs, empty_school_bar_dicts, factor_dict_by_product, variables, client_dir, schools_nameStems_dict, rnd_dict)
+	check('{}/schools_fill_in_data'.format(size), best_time(run, 2, 0), calibration, baseline)
+
+def test_gen_html(client, calibration, baseline):
+	size, client_dir, multi_dict_path, variables, root = client
+	empty_dfs, empty_bar_dicts, empty_school_dfs, empty_school_bar_dicts, factor_dict_by_product = synthesis_report.create_empty_structures(variables, client_dir)
+	dfs, bar_dicts, rr_dict, rnd_dict, total_responses, nameStems_dict, school_meta = synthesis_report.fill_in_data(empty_dfs, empty_bar_dicts, factor_dict_by_product, variables, client_dir, '19O')
+	dfs = synthesis_report.deal_with_nas_in_dfs(dfs, school = False)
+	def run():
+		for df in dfs.values():
+			synthesis_report.gen_html(df)
+	check('{}/gen_html'.format(size), best_time(run), calibration, baseline)
@@ -159,6 +159,13 @@ def test_gen_report(tables, bars, rnd_dict, total_responses, subPath, cmpRange,
         report = report[cmpRange[0]: cmpRange[1]]
     assert_equal(report, expVal)
 
+def cell(df, index, column):
+	#a filled in table cell as [value, quartile] or [trend, difference] from its typed columns, difference is '' for no trend
+	if column + synthesis_report.QUARTILE in df.columns:
+		return [df.at[index, column], df.at[index, column + synthesis_report.QUARTILE]]
+	no_trend = df.at[index, column + synthesis_report.NO_TREND]
+	return [df.at[index, column], '' if no_trend else df.at[index, column + synthesis_report.DIFFERENCE]]
+
 @pytest.mark.parametrize('product_level, df_name, loc, expVal', [
 	['OSE_HS', 'edqual',[0, 'High'], ['79%', 2]],
 	['OSE_HS', 'all_factors', [4, 'High'], [3.56, 2]],
@@ -195,7 +202,7 @@ def test_fill_in_df(product_level, dfs, bar_dicts, variables, factor_dict_by_pro
 	for df in dfs.values():
 		df = synthesis_report.fill_in_df(product_level, df, district_mean, district_percentile, district_percent_pos, variables.level_dict, variables.trend_dict, mean = False)
 	print(dfs[df_name])
-	assert_equal(dfs[df_name].loc[loc[0], loc[1]], expVal)
+	assert_equal(cell(dfs[df_name], loc[0], loc[1]), expVal)
 
 @pytest.mark.parametrize('percentile, expVal', [
 	[63, 2],
@@ -298,4 +305,423 @@ def test_schools_fill_in_bar_dict(school, school_bar_dicts, bar_dict, product_le
 	school_mean, school_percentile, school_percent_pos = synthesis_report.add_trend_data_to_dfs(school_mean, school_percentile, school_percent_pos, school_rnd_dict)
 	school_bar_dict = synthesis_report.schools_fill_in_bar_dict(school, school_bar_dicts[bar_dict], product_level, school_percent_pos, school_rnd_dict, schools_nameStems_dict, variables.product_dict)
 	print(school_bar_dict)
-	assert_equal(school_bar_dict[key], expVal)
\ No newline at end of file
+	assert_equal(school_bar_dict[key], expVal)
+@pytest.mark.parametrize('nameStem, row_type', [
+	['Davis Joint Unified School District', False],
+	['Davis Joint Unified School District', 'district']
+	])
+
+def test_cube_rows(tmp_path, hs_all_percent_pos, nameStem, row_type):
+	#the cube reads an allmean too, the highprop rows are all that's looked at
+	(tmp_path / 'OSE_HS' / 'agg').mkdir(parents = True)
+	for csv_name in ['allmean', 'highprop']:
+		hs_all_percent_pos.to_csv(str(tmp_path / 'OSE_HS' / 'agg' / (csv_name + '.csv')), index = False)
+	client_dir = str(tmp_path)
+	synthesis_report.build_client_index(client_dir)
+	selected = synthesis_report.cube_rows(client_dir, 'OSE_HS', 'percent_pos', nameStem, row_type)
+	expected = hs_all_percent_pos[hs_all_percent_pos['target'].astype(str).str.split(':').str[0] == nameStem]
+	if row_type:
+		expected = expected[expected['type'] == row_type]
+	assert_frame_equal(selected, expected[selected.columns].reset_index(drop = True), check_dtype = False)
+	synthesis_report.data_cube.clear()
+	synthesis_report.client_index.clear()
+	synthesis_report.clear_csv_cache()
+
+def test_load_csv_cache(tmp_path):
+	synthesis_report.clear_csv_cache()
+	csv_path = tmp_path / 'allmean.csv'
+	csv_path.write_text('target,genTarget,var1\nclient:19O,client,3.5\n')
+	first = synthesis_report.load_csv(str(csv_path))
+	second = synthesis_report.load_csv(str(csv_path))
+	assert first is second
+	assert_equal(synthesis_report.csv_cache_stats, {'hits': 1, 'misses': 1})
+	csv_path.write_text('target,genTarget,var1\nclient:19O,client,3.6\n')
+	os.utime(str(csv_path), ns = (0, 10 ** 18))
+	third = synthesis_report.load_csv(str(csv_path))
+	assert_equal(third.loc[0, 'var1'], 3.6)
+	assert_equal(len(synthesis_report.csv_cache), 1)
+	synthesis_report.clear_csv_cache()
+
+def test_evict_changed_csvs(tmp_path):
+	synthesis_report.clear_csv_cache()
+	kept_path, changed_path, removed_path = [tmp_path / name for name in ['kept.csv', 'changed.csv', 'removed.csv']]
+	for csv_path in [kept_path, changed_path, removed_path]:
+		csv_path.write_text('target,genTarget,var1\nclient:19O,client,3.5\n')
+		synthesis_report.load_csv(str(csv_path))
+	os.utime(str(changed_path), ns = (0, 10 ** 18))
+	removed_path.unlink()
+	assert_equal(synthesis_report.evict_changed_csvs(), 2)
+	assert_equal([key[0] for key in synthesis_report.csv_cache], [os.path.realpath(str(kept_path))])
+	assert_equal(synthesis_report.evict_changed_csvs(), 0)
+	synthesis_report.clear_csv_cache()
+
+def test_prefetched(tmp_path):
+	synthesis_report.clear_csv_cache()
+	paths = {}
+	for name in ['a', 'b', 'c', 'd']:
+		csv_path = tmp_path / '{}.csv'.format(name)
+		csv_path.write_text('target,genTarget,var1\nclient:19O,client,3.5\n')
+		paths[name] = [(str(csv_path), None, None)]
+	paths['b'].append((str(tmp_path / 'missing.csv'), None, None))
+	cached = lambda name: os.path.realpath(paths[name][0][0]) in [key[0] for key in synthesis_report.csv_cache]
+	seen = []
+	for name in synthesis_report.prefetched(['a', 'b', 'c', 'd'], paths.get, depth = 1):
+		assert cached(name)
+		if name == 'a':
+			assert not cached('c') and not cached('d')
+		seen.append(name)
+	assert_equal(seen, ['a', 'b', 'c', 'd'])
+	assert_equal(list(synthesis_report.prefetched(['a', 'b'], paths.get, depth = 0)), ['a', 'b'])
+	synthesis_report.clear_csv_cache()
+
+def test_csv_sidecar(tmp_path):
+	pytest.importorskip('pyarrow')
+	synthesis_report.clear_csv_cache()
+	csv_path = tmp_path / 'highprop.csv'
+	csv_path.write_text('target,genTarget,type,var1\nclient:19O,client,district,0.55\n')
+	parsed = synthesis_report.load_csv(str(csv_path))
+	sidecars = os.listdir(str(tmp_path / synthesis_report.SIDECAR_DIR))
+	assert_equal(len(sidecars), 1)
+	synthesis_report.clear_csv_cache()
+	from_sidecar = synthesis_report.load_csv(str(csv_path), columns = ['var1', 'target'])
+	assert_frame_equal(from_sidecar, parsed[['target', 'var1']])
+	synthesis_report.purge_sidecars(str(tmp_path))
+	assert not os.path.exists(str(tmp_path / synthesis_report.SIDECAR_DIR))
+	synthesis_report.clear_csv_cache()
+
+def test_pruned_csv(tmp_path, monkeypatch):
+	synthesis_report.clear_csv_cache()
+	monkeypatch.setattr(synthesis_report, 'use_sidecars', False)
+	monkeypatch.setattr(synthesis_report, 'CSV_CHUNK_ROWS', 2)
+	csv_path = tmp_path / 'allmean.csv'
+	csv_path.write_text('target,genTarget,type,var1,var2\nclient:19O,client,district,3.5,1\nother:19O,other,district,2.5,2\nsch001:19O,client,school,3.0,3\nother:18O,other,district,2.0,4\n')
+	csv = synthesis_report.load_csv(str(csv_path), columns = ['target', 'genTarget', 'type', 'var1'], nameStems = ['client', 'sch001'])
+	assert_equal(list(csv.columns), ['target', 'genTarget', 'type', 'var1'])
+	assert_equal(list(csv['target']), ['client:19O', 'sch001:19O'])
+	assert_equal(str(csv['type'].dtype), 'category')
+	assert_equal(csv['var1'].dtype, np.float64)
+	synthesis_report.clear_csv_cache()
+
+def test_client_index(tmp_path, capsys):
+	for school in ['school_a', 'school_b']:
+		(tmp_path / 'HS' / school / 'agg').mkdir(parents = True)
+		(tmp_path / 'HS' / school / 'agg' / 'pct.csv').write_text('target,genTarget\n')
+	(tmp_path / 'HS' / 'agg').mkdir()
+	(tmp_path / 'HS' / 'agg' / 'allmean.csv').write_text('target,genTarget\n')
+	index = synthesis_report.build_client_index(str(tmp_path))
+	assert_equal(synthesis_report.list_product_levels(str(tmp_path)), ['HS'])
+	assert_equal(synthesis_report.lookup_csv(str(tmp_path / 'HS'), 'agg', 'allmean'), str(tmp_path / 'HS' / 'agg' / 'allmean.csv'))
+	with pytest.raises(FileNotFoundError):
+		synthesis_report.lookup_csv(str(tmp_path / 'HS'), 'agg', 'pct')
+	found = synthesis_report.find('pct.csv', str(tmp_path))
+	assert found in index['files']['pct.csv']
+	assert 'Found 2 pct.csv files' in capsys.readouterr().out
+	#symlinked product levels are indexed through the link and a link back up doesn't loop
+	(tmp_path / 'elsewhere' / 'agg').mkdir(parents = True)
+	(tmp_path / 'elsewhere' / 'agg' / 'allmean.csv').write_text('target,genTarget\n')
+	client_dir = tmp_path / 'client'
+	client_dir.mkdir()
+	(client_dir / 'MS').symlink_to(tmp_path / 'elsewhere', target_is_directory = True)
+	(tmp_path / 'elsewhere' / 'loop').symlink_to(tmp_path / 'elsewhere', target_is_directory = True)
+	synthesis_report.build_client_index(str(client_dir))
+	assert_equal(synthesis_report.list_product_levels(str(client_dir)), ['MS'])
+	assert_equal(synthesis_report.lookup_csv(str(client_dir / 'MS'), 'agg', 'allmean'), str(client_dir / 'MS' / 'agg' / 'allmean.csv'))
+	synthesis_report.client_index.clear()
+
+def test_incremental_build(tmp_path):
+	json_path = str(tmp_path / 'Synthesis Report_client.json')
+	rnd_dict = {0: ('19O', 'Fall 2019'), 1: ('18O', 'Fall 2018')}
+	assert_equal(synthesis_report.inputs_hash(rnd_dict), synthesis_report.inputs_hash(json.loads(json.dumps(rnd_dict))))
+	synthesis_report.start_build(json_path)
+	synthesis_report.check_run_inputs(['inputs'])
+	reports = []
+	synthesis_report.record_report('district', 'hash1', {'name': 'Batch Title'}, reports, True)
+	synthesis_report.record_report('school:sch1', 'hash3', {'name': 'Batch Title', 'title': 'Bé'}, reports, True)
+	synthesis_report.writeJSON({'version': '2.0', 'reports': reports}, json_path)
+	synthesis_report.build_manifest['offsets'] = synthesis_report.output_offsets({'version': '2.0', 'reports': reports}, json_path)
+	assert synthesis_report.build_manifest['offsets'] is not None
+	synthesis_report.finish_build(json_path)
+	#reports are read back one at a time from where they are in the json
+	synthesis_report.start_build(json_path)
+	synthesis_report.check_run_inputs(['inputs'])
+	assert_equal(synthesis_report.previous_report('school:sch1', 'hash3'), reports[1])
+	assert_equal(synthesis_report.previous_report('district', 'hash1'), {'name': 'Batch Title'})
+	assert 'output' not in synthesis_report.previous_output
+	assert synthesis_report.previous_report('district', 'hash2') is None
+	synthesis_report.start_build(json_path)
+	synthesis_report.check_run_inputs(['other inputs'])
+	assert synthesis_report.previous_report('district', 'hash1') is None
+	assert 'matches' not in synthesis_report.previous_output
+	synthesis_report.start_build(json_path, force = True)
+	assert synthesis_report.previous_report('district', 'hash1') is None
+	#a json that isn't the one the manifest was written for isn't reused from
+	with open(json_path, 'a') as f:
+		f.write(' ')
+	synthesis_report.start_build(json_path)
+	synthesis_report.check_run_inputs(['inputs'])
+	assert synthesis_report.previous_report('district', 'hash1') is None
+	synthesis_report.start_build(json_path, force = True)
+
+def test_input_file_digests(tmp_path):
+	for relpath in ['HS/agg/allmean.csv', 'HS/data/roundMeta.csv', 'HS/data/notes.txt', 'HS/sch1/agg/pct.csv', 'HS/sch1/agg/other.csv', 'HS/sch2/agg/pct.csv']:
+		(tmp_path / relpath).parent.mkdir(parents = True, exist_ok = True)
+		(tmp_path / relpath).write_text(relpath)
+	synthesis_report.build_client_index(str(tmp_path))
+	synthesis_report.start_build(str(tmp_path / 'Synthesis Report_client.json'), force = True)
+	school_files = [relpath for relpath, digest in synthesis_report.input_file_digests(['HS'], ['sch1'])]
+	assert_equal(school_files, ['HS/agg/allmean.csv', 'HS/data/roundMeta.csv', 'HS/sch1/agg/pct.csv'])
+	district_files = [relpath for relpath, digest in synthesis_report.input_file_digests(['HS'])]
+	assert_equal(district_files, ['HS/agg/allmean.csv', 'HS/data/roundMeta.csv', 'HS/sch1/agg/pct.csv', 'HS/sch2/agg/pct.csv'])
+	synthesis_report.client_index.clear()
+
+def test_profile_stages(tmp_path):
+	synthesis_report.start_profiling()
+	with synthesis_report.stage('fill_in_data'):
+		with synthesis_report.stage('OSE_HS'):
+			data = [0] * 100000
+	synthesis_report.write_profile(str(tmp_path / 'Synthesis Report_client.json'))
+	synthesis_report.profiling['enabled'] = False
+	synthesis_report.tracemalloc.stop()
+	timings = pd.read_csv(str(tmp_path / 'Synthesis Report_client.profile.csv'))
+	assert_equal(timings['stage'].tolist(), ['fill_in_data', 'fill_in_data/OSE_HS'])
+	assert_equal(timings['depth'].tolist(), [0, 1])
+	assert timings.loc[0, 'peak_memory_mb'] >= timings.loc[1, 'peak_memory_mb'] > 0.5
+
+def test_school_templates():
+	empty_school_dfs = {'school_{}_edqual'.format(level): pd.DataFrame({'Student': ['edqual_ose']}) for level in ['es', 'ms', 'hs']}
+	empty_school_bar_dicts = {'school_{}_eng_theme_bar'.format(level): {'OSE_{}'.format(level.upper()): 'ose_eng'} for level in ['es', 'ms', 'hs']}
+	school_dfs, school_bar_dicts = synthesis_report.school_templates(empty_school_dfs, empty_school_bar_dicts, ['OSE_MS', 'FAM_MS'])
+	assert_equal(list(school_dfs.keys()), ['school_ms_edqual'])
+	assert_equal(list(school_bar_dicts.keys()), ['school_ms_eng_theme_bar'])
+	assert school_dfs['school_ms_edqual'] is empty_school_dfs['school_ms_edqual']
+	written = set()
+	df = synthesis_report.write_template(school_dfs, 'school_ms_edqual', written)
+	df.at[0, 'Student'] = [3.5, 2]
+	assert synthesis_report.write_template(school_dfs, 'school_ms_edqual', written) is df
+	assert_equal(empty_school_dfs['school_ms_edqual'].at[0, 'Student'], 'edqual_ose')
+
+def test_deal_with_nas_in_dfs():
+	df = pd.DataFrame({'Group': ['Student', 'Family', 'Staff'], 'Elementary': [np.nan] * 3, 'es_trend': [None] * 3, 'Middle': [np.nan] * 3, 'ms_trend': [None] * 3,
+	'High': ['edqual_ose', 'edqual_fam', ''], 'hs_trend': [None] * 3})
+	lookup = {'edqual_ose': {'percent': ('79%', 2), 'percent_trend': (1, 4)}, 'edqual_fam': {'percent': ('-1000%', 4), 'percent_trend': (3, '')}}
+	df = synthesis_report.fill_in_template(df, 'High', 'hs_trend', lookup)
+	dfs = synthesis_report.deal_with_nas_in_dfs({'edqual': df}, school = False)
+	assert_equal(cell(dfs['edqual'], 0, 'High'), ['79%', 2])
+	assert_equal(cell(dfs['edqual'], 2, 'hs_trend'), [3, ''])
+	assert_equal(dfs['edqual']['High:quartile'].dtype, np.float64)
+	assert_equal(dfs['edqual']['hs_trend:difference'].dtype, np.float64)
+	assert_equal(dfs['edqual']['hs_trend:no_trend'].dtype, np.bool_)
+	assert np.isnan(dfs['edqual'].at[2, 'High'])
+	html = synthesis_report.gen_html(dfs['edqual'])
+	assert ':quartile' not in html and ':difference' not in html and ':no_trend' not in html
+	assert_equal(html.count('N/A'), 8)
+	assert '#2e9fd0;font-weight:bold">79%</span>' in html and '&#8593&nbsp;4' in html
+
+def test_gen_html_cache():
+	synthesis_report.clear_html_cache()
+	df = pd.DataFrame({'Item': ['edqual', 'respect'], 'Student': ['55%', 3.5], 'ose_trend': [1, 2]})
+	synthesis_report.add_cell_columns(df, ['Student'], ['ose_trend'])
+	df['Student:quartile'] = [1.0, 2.0]
+	df['ose_trend:difference'] = [4.0, 4.0]
+	html = synthesis_report.gen_html(df, school = True)
+	assert synthesis_report.gen_html(df, school = True) is html
+	synthesis_report.clear_html_cache()
+	assert_equal(synthesis_report.gen_html(df, school = True), html)
+	#percent positive differences are whole points, mean differences keep their decimals
+	assert '&#8593&nbsp;4</td>' in html and '&#8595&nbsp;4.0</td>' in html
+	df.at[1, 'ose_trend:no_trend'] = True
+	assert '&#8595&nbsp;</td>' in synthesis_report.gen_html(df, school = True)
+
+def test_report_stream(tmp_path):
+	reports = [{'name': 'Batch Title', 'title': 'A - Synthesis Report - 19O', 'elements': {'tables': {'type': 'textElement'}}}, {'name': 'Batch Title', 'title': 'Bé'}]
+	expected = str(tmp_path / 'expected.json')
+	synthesis_report.writeJSON({'version': '2.0', 'reports': reports}, expected)
+	for compress in [False, True]:
+		path = str(tmp_path / ('streamed.json.gz' if compress else 'streamed.json'))
+		stream = synthesis_report.ReportStream(path, '2.0', compress)
+		for report in reports:
+			stream.append(report)
+		assert_equal(len(stream), 2)
+		assert not os.path.exists(path)
+		assert_equal(stream.close(), path)
+		with synthesis_report.open_json(path) as f, open(expected) as g:
+			assert_equal(f.read(), g.read())
+		#an aborted stream leaves the last output as it was
+		stream = synthesis_report.ReportStream(path, '2.0', compress)
+		stream.append(reports[0])
+		stream.abort()
+		assert not os.path.exists(path + '.tmp')
+		with synthesis_report.open_json(path) as f, open(expected) as g:
+			assert_equal(f.read(), g.read())
+
+def test_write_delta(tmp_path):
+	report = lambda title, responses, bar: {'name': 'Batch Title', 'title': title, 'elements': {'tables': {'type': 'textElement', 'substitutions': {'total_responses': responses}}, 'bar_ose': bar}}
+	previous_path = str(tmp_path / 'previous.json')
+	synthesis_report.writeJSON({'version': '2.0', 'reports': [report('A', '10', [1]), report('B', '20', [2]), report('C', '30', [3])]}, previous_path)
+	json_path = str(tmp_path / 'Synthesis Report_client.json')
+	synthesis_report.writeJSON({'version': '2.0', 'reports': [report('A', '10', [1]), report('B', '21', [2]), report('D', '40', [4])]}, json_path)
+	delta_path = synthesis_report.write_delta(json_path, synthesis_report.previous_digests(previous_path), previous_path)
+	assert_equal(delta_path, str(tmp_path / 'Synthesis Report_client.delta.json'))
+	#a gzipped output next to it gets its own delta and manifest
+	assert_equal(synthesis_report.delta_path(json_path + '.gz'), str(tmp_path / 'Synthesis Report_client.gz.delta.json'))
+	assert_equal(synthesis_report.manifest_path(json_path + '.gz'), str(tmp_path / 'Synthesis Report_client.gz.manifest.json'))
+	with open(delta_path) as f:
+		delta = json.load(f)
+	assert_equal([r['title'] for r in delta['added']], ['D'])
+	assert_equal(delta['changed'], [report('B', '21', [2])])
+	assert_equal(delta['removed'], [{'name': 'Batch Title', 'title': 'C'}])
+	assert_equal(delta['summary'][1:], ['changed: B (total_responses)', 'added: D', 'removed: C'])
+	assert_equal(len(synthesis_report.previous_digests(str(tmp_path / 'missing.json'))), 0)
+	#two schools with the same name are two reports, matched in order
+	synthesis_report.writeJSON({'version': '2.0', 'reports': [report('A', '10', [1]), report('A', '11', [1])]}, json_path)
+	synthesis_report.write_delta(json_path, synthesis_report.previous_digests(previous_path), previous_path)
+	with open(delta_path) as f:
+		delta = json.load(f)
+	assert_equal(delta['added'], [report('A', '11', [1])])
+	assert_equal(delta['summary'][0].split(' since ')[0], '1 added, 0 changed, 2 removed and 1 unchanged reports')
+
+def test_shards(tmp_path):
+	reports = [{'name': 'Batch Title', 'title': 'District'}, {'name': 'Batch Title', 'title': 'School'}]
+	path = str(tmp_path / 'Synthesis Report_A.shards.json')
+	shards = synthesis_report.ShardStream(path, '2.0')
+	shards.append(reports[0], 'district')
+	shards.append(reports[1], 'school:sch001hs')
+	assert_equal(shards.close(), path)
+	assert_equal(sorted(os.listdir(str(tmp_path / 'Synthesis Report_A.shards'))), ['0000_district.json', '0001_school_sch001hs.json'])
+	assert_equal(synthesis_report.read_output(path), {'version': '2.0', 'reports': reports})
+	merged = synthesis_report.merge_shards(path, str(tmp_path / 'merged.json'))
+	expected = str(tmp_path / 'expected.json')
+	synthesis_report.writeJSON({'version': '2.0', 'reports': reports}, expected)
+	with open(merged) as f, open(expected) as g:
+		assert_equal(f.read(), g.read())
+	with open(str(tmp_path / 'Synthesis Report_A.shards' / '0001_school_sch001hs.json'), 'a') as f:
+		f.write(' ')
+	with pytest.raises(ValueError, match = 'bytes'):
+		synthesis_report.read_shards(path)
+	#same size, different contents
+	with open(str(tmp_path / 'Synthesis Report_A.shards' / '0001_school_sch001hs.json'), 'w') as f:
+		f.write(json.dumps(dict(reports[1], title = 'Schoo1')))
+	with pytest.raises(ValueError, match = 'checksum'):
+		synthesis_report.read_shards(path)
+	shards = synthesis_report.ShardStream(path, '2.0')
+	shards.append(reports[0], 'district')
+	shards.abort()
+	assert not os.path.exists(str(tmp_path / 'Synthesis Report_A.shards.tmp'))
+	assert_equal(len(os.listdir(str(tmp_path / 'Synthesis Report_A.shards'))), 2)
+
+def test_response_rates():
+	all_count = pd.DataFrame({'genTarget': ['s1', 's2', 's3', 's1', 's4'], 'target': ['C:19O:s1', 'C:19O:s2', 'C:19O:s3', 'C:18O:s1', 'C:19O:s4'], 'total': [10, 20, 5, 7, 3]})
+	school_meta = pd.DataFrame({'genTarget': ['s1', 's2', 's3', 's1', 's4'], 'current': [1, 1, 1, 0, 1], 'respTarget': [40, np.nan, 10, 99, 6], 'SchoolName': ['One', 'Two', 'Three', 'One old', 'Four']})
+	rnd_dict = {0: ('19O', 'Spring')}
+	rr_dict = {}
+	rr_dict['High School Student Responses'], responses = synthesis_report.gen_rr_table('OSE_HS', all_count, school_meta, rnd_dict, 'C', ['s1', 's2', 's3', 's9'])
+	assert_equal(responses, 35)
+	assert_equal(rr_dict['High School Student Responses']['Survey Population'].tolist(), ['40', 'N/A', '10', 'N/A'])
+	assert_equal(rr_dict['High School Student Responses']['Response Rate'].tolist(), ['25%', 'N/A%', '50%', 'N/A%'])
+	rr_dict['High School Family Responses'], responses = synthesis_report.gen_rr_table('FAM_HS', all_count, school_meta, rnd_dict, 'C', ['s1', 's4'])
+	rr_index = synthesis_report.index_response_rates(rr_dict)
+	school_rr_df, total_responses = synthesis_report.gen_school_rr_dict(rr_dict, 's1', rr_index)
+	assert_equal(total_responses, 20)
+	assert_equal(school_rr_df['Response Rate'].tolist(), ['25%', '25%', np.nan])
+	school_rr_df, total_responses = synthesis_report.gen_school_rr_dict(rr_dict, 's2', rr_index)
+	assert_equal(school_rr_df['Survey Population'].tolist(), ['N/A', '0', '0'])
+	with pytest.raises(TypeError):
+		synthesis_report.gen_rr_table('OSE_HS', pd.concat([all_count, all_count]), school_meta, rnd_dict, 'C', ['s1'])
+
+def test_data_cube(tmp_path):
+	(tmp_path / 'OSE_HS' / 'agg').mkdir(parents = True)
+	(tmp_path / 'OSE_HS' / 'client' / 'agg').mkdir(parents = True)
+	(tmp_path / 'OSE_HS' / 'agg' / 'allmean.csv').write_text('target,genTarget,ose_eng,edqual_ose\nclient:19O,client,3.5,4\nclient:18O,client,3.25,\nsch1:19O,sch1,2.5,3\n')
+	(tmp_path / 'OSE_HS' / 'agg' / 'highprop.csv').write_text('target,genTarget,type,ose_eng\nclient:19O,client,district,0.5\nclient:19O,client,school,0.75\n')
+	(tmp_path / 'OSE_HS' / 'client' / 'agg' / 'pct.csv').write_text('target,genTarget,ose_eng\nclient:19O,client,63\n')
+	client_dir = str(tmp_path)
+	synthesis_report.build_client_index(client_dir)
+	rows = synthesis_report.cube_rows(client_dir, 'OSE_HS', 'mean', 'client')
+	assert_equal(rows.columns.tolist(), ['target', 'genTarget', 'ose_eng', 'edqual_ose'])
+	assert_equal(rows['target'].tolist(), ['client:19O', 'client:18O'])
+	assert_equal(synthesis_report.cube_rows(client_dir, 'OSE_HS', 'percent_pos', 'client', row_type = 'district')['ose_eng'].tolist(), [0.5])
+	assert_equal(synthesis_report.cube_rows(client_dir, 'OSE_HS', 'percentile', 'client')['ose_eng'].tolist(), [63.0])
+	assert synthesis_report.cube_rows(client_dir, 'OSE_HS', 'mean', 'sch2').empty
+	assert_equal(rows['ose_eng'].tolist(), [3.5, 3.25])
+	assert np.isnan(rows['edqual_ose'].iloc[1])
+	synthesis_report.data_cube.clear()
+	synthesis_report.client_index.clear()
+	synthesis_report.clear_csv_cache()
+
+def test_low_memory(tmp_path, monkeypatch):
+	import synthetic_cyan
+	client_dir, multi_dict_path = synthetic_cyan.make_client_dir(str(tmp_path), n_schools = 6, product_levels = ('OSE_ES', 'OSE_MS', 'FAM_ES'), n_rounds = 2)
+	monkeypatch.setattr(synthesis_report, 'prefetch_depth', 0)
+	load_cube = synthesis_report.load_cube
+	held = []
+	def counting_load_cube(client_dir, product_level):
+		cube = load_cube(client_dir, product_level)
+		cube_csvs = [key for key in synthesis_report.csv_cache if os.path.basename(key[0]).split('.')[0] in synthesis_report.CUBE_CSVS]
+		held.append((len(synthesis_report.data_cube), len(set(os.path.dirname(os.path.dirname(key[0])) for key in cube_csvs if key[0].endswith('allmean.csv')))))
+		return cube
+	monkeypatch.setattr(synthesis_report, 'load_cube', counting_load_cube)
+	reports = {}
+	for low_memory in [False, True]:
+		synthesis_report.clear_csv_cache()
+		monkeypatch.setattr(synthesis_report, 'low_memory', low_memory)
+		del held[:]
+		out_dir = str(tmp_path / 'out_{}'.format(low_memory))
+		os.makedirs(out_dir)
+		json_path = synthesis_report.build_synthesis_report(client_dir, '19O', out_dir, multi_dict_path = multi_dict_path, force = True)
+		reports[low_memory] = synthesis_report.read_output(json_path)
+		#most product level cubes and allmean csvs held at once
+		assert_equal(max(held), (1, 1) if low_memory else (3, 3))
+	assert reports[True] == reports[False]
+	synthesis_report.clear_csv_cache()
+
+def test_service_run_build(tmp_path):
+	import synthetic_cyan
+	import synthesis_service
+	client_dir, multi_dict_path = synthetic_cyan.make_client_dir(str(tmp_path), n_schools = 6, product_levels = ('OSE_ES', 'OSE_MS', 'FAM_ES'), n_rounds = 2)
+	options = {'client_dir': client_dir, 'current_round': '19O', 'outDir': str(tmp_path), 'multi_dict': multi_dict_path}
+	first = synthesis_service.run_build(options)
+	assert_equal(first['reused'], [])
+	assert 'school:sch003ms' in first['rebuilt']
+	#nothing changed so the second build reuses every report, and -s finds the school's report in the json
+	second = synthesis_service.run_build(dict(options, school = 'sch003ms'))
+	assert_equal(second['rebuilt'], [])
+	assert_equal(sorted(second['reused']), sorted(first['rebuilt']))
+	assert second['report']['title'].startswith('School 3 Middle - ')
+	assert synthesis_service.find_report(second['json_path'], 'Combined School')['title'].startswith('Combined School - ')
+	#sch001ms is only in the multilevel report
+	with pytest.raises(LookupError):
+		synthesis_service.run_build(dict(options, school = 'sch001ms'))
+	synthesis_report.clear_csv_cache()
+
+def test_add_trend_data_to_dfs():
+	round_meta = pd.DataFrame({'rnd': ['17O', '18O', '19O'], 'RoundID': [3, 5, 7], 'SurveyPeriod': ['Fall 2017', 'Fall 2018', 'Fall 2019']})
+	mean = pd.DataFrame({'target': ['client:18O', 'client:19O', 'client:17O'], 'var1': [3.5, 3.6, 3.4]}, index = [4, 5, 6])
+	rnd_dict = synthesis_report.make_rnd_dict(mean, mean, mean, round_meta, 'OSE_HS')
+	assert_equal(rnd_dict, {0: ('19O', 'Fall 2019'), 1: ('18O', 'Fall 2018'), 2: ('17O', 'Fall 2017')})
+	#a round that isn't in the round dict takes the trend of the row above it
+	del rnd_dict[2]
+	mean, percentile, percent_pos = synthesis_report.add_trend_data_to_dfs(mean, mean.copy(), mean.copy(), rnd_dict)
+	assert_equal(mean['trend'].tolist(), [1.0, 0.0, 0.0])
+	assert_equal(mean.index.tolist(), [0, 1, 2])
+	with pytest.raises(TypeError):
+		synthesis_report.make_rnd_dict(pd.DataFrame({'target': ['client:20O']}), mean, mean, round_meta, 'OSE_HS')
+
+def test_factor_registry(tmp_path):
+	vars_path = str(tmp_path / 'synthesis_report_vars.py')
+	core_vars_path = str(tmp_path / 'OSE_HS' / 'coreVars.py')
+	(tmp_path / 'synthesis_report_vars.py').write_text("product_levels_list = ['OSE_HS', 'FAM_HS']\nlevel_dict = {'hs': 'High'}\n")
+	os.makedirs(os.path.dirname(core_vars_path))
+	with open(core_vars_path, 'w') as f:
+		f.write("factors = {'execsum': [('ose_eng', 'Engagement')]}\n")
+	variables = synthesis_report.load_variables(vars_path)
+	assert_equal(variables.level_dict, {'hs': 'High'})
+	assert_equal(synthesis_report.core_vars_cache[core_vars_path].factors['execsum'], [('ose_eng', 'Engagement')])
+	assert os.path.exists(synthesis_report.registry_path(vars_path))
+	#FAM_HS has no coreVars so it's left out, and a changed coreVars means a new registry
+	assert_equal(list(synthesis_report.load_factor_registry(vars_path)['factors']), [core_vars_path])
+	with open(core_vars_path, 'w') as f:
+		f.write("factors = {'execsum': [('ose_eng', 'Engagement'), ('ose_rel', 'Relationships')]}\n")
+	os.utime(core_vars_path, ns = (0, 10 ** 18))
+	assert_equal(len(synthesis_report.load_factor_registry(vars_path)['factors'][core_vars_path].factors['execsum']), 2)
+	del synthesis_report.variables_cache[vars_path]
+	del synthesis_report.core_vars_cache[core_vars_path]